@@ -0,0 +1,323 @@
+"""Distributes the frontend build as individual content-addressed files rather
+than a single archive, so instances only download what changed.
+
+On the build server, `publish` hashes every file in build/, adds precompressed
+`.gz` (and, if the brotli package is installed, `.br`) siblings for compressible
+files so nginx can serve them via `gzip_static`, uploads each file not already
+in S3 to `builds/frontend/objects/<sha256>`, then uploads the manifest mapping
+each path to its hash to `builds/frontend/manifest.json`.
+
+On each instance, `sync` downloads the manifest, compares it against the files
+already in the target folder, downloads only the missing or changed files in
+parallel, then swaps them into place, with index.html last so it never
+references files which aren't there yet, and finally removes files which are
+no longer in the manifest.
+
+    python build_artifacts.py publish build
+    python build_artifacts.py sync /var/www
+
+Both run outside the web server (on a fresh build server and during deploys),
+so this only depends on boto3 and the standard library, plus brotli if it's
+available, and reads the bucket from OSEH_S3_BUCKET_NAME.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple, TypedDict
+import boto3
+import botocore.exceptions
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+MANIFEST_KEY = "builds/frontend/manifest.json"
+"""The key of the manifest for the latest build"""
+
+OBJECTS_PREFIX = "builds/frontend/objects/"
+"""The prefix of the content-addressed files, each named after its sha256"""
+
+CONCURRENCY = 16
+"""The maximum number of files uploaded or downloaded at once"""
+
+COMPRESSIBLE_EXTENSIONS = frozenset(
+    (
+        ".html",
+        ".js",
+        ".css",
+        ".json",
+        ".map",
+        ".svg",
+        ".txt",
+        ".xml",
+        ".ico",
+        ".webmanifest",
+    )
+)
+"""The extensions of files we generate precompressed siblings for"""
+
+MIN_COMPRESS_SIZE = 1024
+"""Files smaller than this many bytes are not worth precompressing"""
+
+LAST_PATHS = ("index.html",)
+"""Paths which are swapped into place after every other file when syncing"""
+
+
+class ManifestEntry(TypedDict):
+    sha256: str
+    """the hex sha256 of the file, which is also its name under OBJECTS_PREFIX"""
+    size: int
+    """the size of the file in bytes"""
+
+
+class Manifest(TypedDict):
+    files: Dict[str, ManifestEntry]
+    """the entry for each file, by path relative to the build folder using
+    forward slashes
+    """
+
+
+def _sha256_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _list_files(root: str) -> List[str]:
+    """Lists the files within root, relative to it using forward slashes"""
+    result: List[str] = []
+    for dirpath, _, names in os.walk(root):
+        relative_dir = os.path.relpath(dirpath, root)
+        for name in names:
+            path = name if relative_dir == "." else os.path.join(relative_dir, name)
+            result.append(path.replace(os.path.sep, "/"))
+    return result
+
+
+def add_compressed_siblings(build_dir: str) -> int:
+    """Writes `.gz` and, if available, `.br` siblings next to every
+    compressible file in the given folder, skipping any which wouldn't be
+    smaller. Returns how many siblings were written
+    """
+    num_written = 0
+    for path in _list_files(build_dir):
+        if os.path.splitext(path)[1] not in COMPRESSIBLE_EXTENSIONS:
+            continue
+
+        local_path = os.path.join(build_dir, path)
+        if os.path.getsize(local_path) < MIN_COMPRESS_SIZE:
+            continue
+
+        with open(local_path, "rb") as f:
+            raw = f.read()
+
+        compressed = [("gz", gzip.compress(raw, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            compressed.append(("br", brotli.compress(raw, quality=11)))
+
+        for suffix, data in compressed:
+            if len(data) >= len(raw):
+                continue
+            with open(f"{local_path}.{suffix}", "wb") as f:
+                f.write(data)
+            num_written += 1
+    return num_written
+
+
+def build_manifest(build_dir: str) -> Manifest:
+    """Hashes every file within the given folder"""
+    files: Dict[str, ManifestEntry] = dict()
+    for path in sorted(_list_files(build_dir)):
+        local_path = os.path.join(build_dir, path)
+        files[path] = {
+            "sha256": _sha256_file(local_path),
+            "size": os.path.getsize(local_path),
+        }
+    return {"files": files}
+
+
+def _object_exists(s3: Any, bucket: str, key: str) -> bool:
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return False
+        raise
+    return True
+
+
+def publish(s3: Any, bucket: str, build_dir: str) -> None:
+    """Adds precompressed siblings to the given build folder, then uploads
+    any of its files not already in the given bucket and finally the manifest
+    """
+    num_compressed = add_compressed_siblings(build_dir)
+    manifest = build_manifest(build_dir)
+    print(f"Publishing {len(manifest['files'])} files ({num_compressed} precompressed)")
+
+    # identical files share an object, so upload each hash once
+    paths_by_hash: Dict[str, str] = dict()
+    for path, entry in manifest["files"].items():
+        paths_by_hash.setdefault(entry["sha256"], path)
+
+    def _upload(sha256: str, path: str) -> bool:
+        key = f"{OBJECTS_PREFIX}{sha256}"
+        if _object_exists(s3, bucket, key):
+            return False
+        s3.upload_file(os.path.join(build_dir, path), bucket, key)
+        return True
+
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+        num_uploaded = sum(
+            executor.map(lambda item: _upload(*item), paths_by_hash.items())
+        )
+
+    s3.put_object(
+        Bucket=bucket,
+        Key=MANIFEST_KEY,
+        Body=json.dumps(manifest).encode("utf-8"),
+    )
+    print(
+        f"Published manifest; uploaded {num_uploaded} of {len(paths_by_hash)} objects"
+    )
+
+
+def _diff_local(
+    manifest: Manifest, target_dir: str
+) -> Tuple[Dict[str, ManifestEntry], List[str]]:
+    """Determines which files in the manifest are missing or different in the
+    target folder, and which files in the target folder aren't in the manifest
+    """
+    changed: Dict[str, ManifestEntry] = dict()
+    for path, entry in manifest["files"].items():
+        local_path = os.path.join(target_dir, path)
+        try:
+            if os.path.getsize(local_path) == entry["size"] and (
+                _sha256_file(local_path) == entry["sha256"]
+            ):
+                continue
+        except FileNotFoundError:
+            pass
+        changed[path] = entry
+
+    stale = [
+        path
+        for path in (_list_files(target_dir) if os.path.isdir(target_dir) else [])
+        if path not in manifest["files"]
+    ]
+    return changed, stale
+
+
+def _swap_in(target_dir: str, staged: Dict[str, str], stale: List[str]) -> None:
+    """Moves the staged files (temporary path by path) into place, with
+    LAST_PATHS last, then removes the stale paths and any empty folders
+    """
+    ordered = sorted(staged.items(), key=lambda item: item[0] in LAST_PATHS)
+    for path, tmp_path in ordered:
+        final_path = os.path.join(target_dir, path)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.replace(tmp_path, final_path)
+
+    for path in stale:
+        try:
+            os.remove(os.path.join(target_dir, path))
+        except FileNotFoundError:
+            pass
+
+    for dirpath, dirnames, filenames in os.walk(target_dir, topdown=False):
+        if dirpath != target_dir and not dirnames and not filenames:
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                pass
+
+
+def _download_manifest(s3: Any, bucket: str) -> Optional[Manifest]:
+    try:
+        response = s3.get_object(Bucket=bucket, Key=MANIFEST_KEY)
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
+    return json.loads(response["Body"].read())
+
+
+def sync(s3: Any, bucket: str, target_dir: str) -> Optional[int]:
+    """Updates the given folder to match the latest published manifest,
+    downloading only the files which changed. Returns how many files were
+    downloaded, or None if no build has been published
+    """
+    manifest = _download_manifest(s3, bucket)
+    if manifest is None:
+        return None
+
+    changed, stale = _diff_local(manifest, target_dir)
+    print(
+        f"Syncing {target_dir}: {len(changed)} changed and {len(stale)} stale "
+        f"of {len(manifest['files'])} files"
+    )
+
+    os.makedirs(target_dir, exist_ok=True)
+    # staged next to the target so the final rename is atomic
+    staged: Dict[str, str] = {
+        path: os.path.join(target_dir, f".sync-{secrets.token_hex(8)}.tmp")
+        for path in changed
+    }
+
+    def _download(path: str) -> None:
+        entry = changed[path]
+        tmp_path = staged[path]
+        try:
+            s3.download_file(bucket, f"{OBJECTS_PREFIX}{entry['sha256']}", tmp_path)
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                raise Exception(f"object for {path} ({entry['sha256']}) is missing")
+            raise
+        if _sha256_file(tmp_path) != entry["sha256"]:
+            raise Exception(f"object for {path} ({entry['sha256']}) is corrupt")
+
+    try:
+        # every download must finish before the staged files are cleaned up,
+        # which leaving the executor guarantees
+        with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+            for _ in executor.map(_download, changed):
+                pass
+        _swap_in(target_dir, staged, stale)
+    finally:
+        for tmp_path in staged.values():
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+
+    return len(changed)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=("publish", "sync"))
+    parser.add_argument("folder", help="the build folder to publish or sync into")
+    args = parser.parse_args()
+
+    s3 = boto3.client("s3")
+    bucket = os.environ["OSEH_S3_BUCKET_NAME"]
+    if args.command == "publish":
+        publish(s3, bucket, args.folder)
+        return
+
+    num_downloaded = sync(s3, bucket, args.folder)
+    if num_downloaded is None:
+        print("No build has been published")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
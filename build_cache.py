@@ -0,0 +1,109 @@
+"""Responses cached in the local diskcache which are rendered from the files of
+the frontend build, e.g., index.html, are only valid for the build they were
+rendered from. Their keys are namespaced by the id of the current build via
+`key`, so entries from another build are never served and the cache can
+safely survive restarts. Entries are also tagged with the build via `get_tag`,
+so that entries from previous builds can be evicted lazily in the background
+by `collect_previous_builds`.
+"""
+
+import asyncio
+import hashlib
+from typing import List, Optional
+import anyio
+import diskcache
+from loguru import logger
+from itgs import Itgs
+import routes.journey_public_links
+
+
+BUILD_IDS_KEY = b"build_cache:build_ids"
+"""The key in the local cache containing the ids of the builds which may have
+entries in the cache
+"""
+
+LEGACY_TAG = "no-persist"
+"""The tag entries were stored with before they were tagged by build"""
+
+GC_DELAY_SECONDS = 60
+"""How long after startup we wait before evicting entries from previous
+builds, so that we don't compete with the cache warmup
+"""
+
+_build_id: Optional[str] = None
+"""the id of the current build, once computed"""
+
+
+def get_build_id() -> str:
+    """Returns an identifier for the frontend build we're serving, which is
+    the hash of its index.html. When index.html is fetched from nginx, as it
+    may be in development, this is always `dev`
+    """
+    global _build_id
+    if _build_id is not None:
+        return _build_id
+
+    if routes.journey_public_links.use_fetch_for_index_html:
+        _build_id = "dev"
+        return _build_id
+
+    hasher = hashlib.sha256()
+    with open(routes.journey_public_links.base_index_html, "rb") as f:
+        while chunk := f.read(65536):
+            hasher.update(chunk)
+    _build_id = hasher.hexdigest()[:16]
+    return _build_id
+
+
+def key(name: str) -> str:
+    """Returns the local cache key for the entry with the given name rendered
+    from the current build
+    """
+    return f"build:{get_build_id()}:{name}"
+
+
+def get_tag() -> str:
+    """Returns the tag for cache entries rendered from the current build"""
+    return f"build:{get_build_id()}"
+
+
+def register_current_build(cache: diskcache.Cache) -> None:
+    """Records that the cache may contain entries for the current build, so
+    they can be collected once it's no longer current
+    """
+    build_id = get_build_id()
+    with cache.transact():
+        build_ids: List[str] = cache.get(BUILD_IDS_KEY) or []
+        if build_id not in build_ids:
+            cache.set(BUILD_IDS_KEY, build_ids + [build_id])
+
+
+def _evict_previous_builds(cache: diskcache.Cache) -> int:
+    build_id = get_build_id()
+    build_ids: List[str] = cache.get(BUILD_IDS_KEY) or []
+
+    num_evicted = 0
+    for tag in [LEGACY_TAG] + [f"build:{b}" for b in build_ids if b != build_id]:
+        while (evicted := cache.evict(tag=tag)) > 0:
+            num_evicted += evicted
+
+    with cache.transact():
+        build_ids = cache.get(BUILD_IDS_KEY) or []
+        cache.set(BUILD_IDS_KEY, [b for b in build_ids if b == build_id])
+    return num_evicted
+
+
+async def collect_previous_builds() -> None:
+    """Registers the current build, then after a delay evicts the entries
+    from every other build off the event loop
+    """
+    try:
+        async with Itgs() as itgs:
+            cache = await itgs.local_cache()
+            register_current_build(cache)
+
+            await asyncio.sleep(GC_DELAY_SECONDS)
+            num_evicted = await anyio.to_thread.run_sync(_evict_previous_builds, cache)
+        logger.info(f"Evicted {num_evicted} local cache entries from previous builds")
+    except Exception:
+        logger.exception("Failed to evict local cache entries from previous builds")
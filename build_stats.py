@@ -0,0 +1,249 @@
+"""Records how long each phase of a frontend-web build took, and reports on
+recent builds. Each build produces a BuildRecord, which is appended to a
+capped list in redis and uploaded to S3 under `builds/frontend-web/records/`.
+
+Run this module directly to print percentiles for each phase across recent
+builds, with phases of the latest build which were unusually slow flagged:
+
+    python build_stats.py --limit 50
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import math
+import time
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+from loguru import logger
+from itgs import Itgs
+
+
+RECORDS_KEY = b"builds:frontend-web:records"
+"""The redis list containing the most recent build records as json, oldest first"""
+
+MAX_RECORDS = 200
+"""The maximum number of build records kept in redis"""
+
+REGRESSION_MIN_HISTORY = 5
+"""How many previous builds must have the phase before we flag regressions"""
+
+REGRESSION_RATIO = 1.5
+"""How many times the median of previous builds a phase must take to be a
+regression
+"""
+
+REGRESSION_MIN_SECONDS = 10
+"""How much longer than the median of previous builds a phase must take to be
+a regression, so that short phases aren't flagged over noise
+"""
+
+
+@dataclass
+class BuildRecord:
+    """How a single build went"""
+
+    started_at: float
+    """when the build started in seconds since the unix epoch"""
+    finished_at: Optional[float] = None
+    """when the build finished in seconds since the unix epoch, if it has"""
+    success: Optional[bool] = None
+    """whether the build succeeded, if it finished"""
+    error: Optional[str] = None
+    """a description of the error the build failed with, if it failed"""
+    instance_id: Optional[str] = None
+    """the id of the build server, once launched"""
+    phases: Dict[str, float] = field(default_factory=dict)
+    """how long each phase took in seconds, in the order they finished. Phases
+    reported by the build script are prefixed with `script.`
+    """
+
+    def add_phase(self, name: str, seconds: float) -> None:
+        """Records that the phase with the given name took the given duration.
+        If the phase already has a duration, the two are summed
+        """
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    @contextmanager
+    def phase(self, name: str):
+        """Times the wrapped block as the phase with the given name"""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - started_at)
+
+
+@asynccontextmanager
+async def recording(itgs: Itgs):
+    """Yields a new BuildRecord, then finishes and stores it when the block
+    exits, whether or not it raised
+    """
+    record = BuildRecord(started_at=time.time())
+    try:
+        yield record
+    except BaseException as e:
+        record.success = False
+        record.error = f"{type(e).__name__}: {e}"
+        raise
+    else:
+        record.success = True
+    finally:
+        record.finished_at = time.time()
+        try:
+            await store_build_record(itgs, record)
+        except Exception:
+            logger.exception("Failed to store build record")
+
+
+async def store_build_record(itgs: Itgs, record: BuildRecord) -> None:
+    """Appends the given record to the recent build records in redis and
+    uploads it to S3
+    """
+    serd = json.dumps(asdict(record)).encode("utf-8")
+
+    redis = await itgs.redis()
+    async with redis.pipeline() as pipe:
+        pipe.multi()
+        await pipe.rpush(RECORDS_KEY, serd)
+        await pipe.ltrim(RECORDS_KEY, -MAX_RECORDS, -1)
+        await pipe.execute()
+
+    files = await itgs.files()
+    await files.upload(
+        io.BytesIO(serd),
+        bucket=files.default_bucket,
+        key=f"builds/frontend-web/records/{int(record.started_at)}.json",
+        sync=True,
+    )
+
+
+async def load_recent_build_records(itgs: Itgs, limit: int) -> List[BuildRecord]:
+    """Loads up to the given number of the most recent build records, oldest
+    first
+    """
+    redis = await itgs.redis()
+    raw: List[bytes] = await redis.lrange(RECORDS_KEY, -limit, -1)
+    return [BuildRecord(**json.loads(item)) for item in raw]
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Returns the given percentile (0-100) of the given non-empty sorted
+    values, interpolating linearly between the closest ranks
+    """
+    rank = (len(sorted_values) - 1) * pct / 100
+    lower = math.floor(rank)
+    upper = math.ceil(rank)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (
+        rank - lower
+    )
+
+
+@dataclass
+class PhaseSummary:
+    """The distribution of how long a phase took across builds"""
+
+    name: str
+    """the name of the phase"""
+    count: int
+    """how many builds had the phase"""
+    p50: float
+    """the median duration in seconds"""
+    p90: float
+    """the 90th percentile duration in seconds"""
+    p99: float
+    """the 99th percentile duration in seconds"""
+    latest: Optional[float]
+    """how long the phase took in the most recent build, if it had the phase"""
+
+
+def summarize(records: List[BuildRecord]) -> List[PhaseSummary]:
+    """Summarizes each phase across the given records, oldest first, with
+    phases in the order they were first seen
+    """
+    durations: Dict[str, List[float]] = dict()
+    for record in records:
+        for name, seconds in record.phases.items():
+            durations.setdefault(name, []).append(seconds)
+
+    latest = records[-1].phases if records else dict()
+    result: List[PhaseSummary] = []
+    for name, values in durations.items():
+        values = sorted(values)
+        result.append(
+            PhaseSummary(
+                name=name,
+                count=len(values),
+                p50=percentile(values, 50),
+                p90=percentile(values, 90),
+                p99=percentile(values, 99),
+                latest=latest.get(name),
+            )
+        )
+    return result
+
+
+def find_regressions(records: List[BuildRecord]) -> List[str]:
+    """Returns the names of the phases in the most recent of the given records,
+    oldest first, which took much longer than in the builds before it
+    """
+    if not records:
+        return []
+
+    *history, latest = records
+    result: List[str] = []
+    for name, seconds in latest.phases.items():
+        previous = sorted(r.phases[name] for r in history if name in r.phases)
+        if len(previous) < REGRESSION_MIN_HISTORY:
+            continue
+        median = percentile(previous, 50)
+        if (
+            seconds >= median * REGRESSION_RATIO
+            and seconds - median >= REGRESSION_MIN_SECONDS
+        ):
+            result.append(name)
+    return result
+
+
+def format_report(records: List[BuildRecord]) -> str:
+    """Formats a table of the percentiles for each phase across the given
+    records, oldest first, flagging regressions in the most recent build
+    """
+    if not records:
+        return "No build records"
+
+    num_succeeded = sum(1 for r in records if r.success)
+    regressions = set(find_regressions(records))
+    summaries = summarize(records)
+    name_width = max([len("phase")] + [len(s.name) for s in summaries])
+
+    lines = [
+        f"{len(records)} builds ({num_succeeded} succeeded)",
+        f"{'phase':<{name_width}}  {'n':>4}  {'p50':>8}  {'p90':>8}  {'p99':>8}  {'latest':>8}",
+    ]
+    for s in summaries:
+        latest = f"{s.latest:.1f}" if s.latest is not None else "-"
+        flag = "  REGRESSION" if s.name in regressions else ""
+        lines.append(
+            f"{s.name:<{name_width}}  {s.count:>4}  {s.p50:>8.1f}  {s.p90:>8.1f}  {s.p99:>8.1f}  {latest:>8}{flag}"
+        )
+    return "\n".join(lines)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--limit", type=int, default=50, help="how many recent builds to include"
+    )
+    args = parser.parse_args()
+
+    async with Itgs() as itgs:
+        records = await load_recent_build_records(itgs, args.limit)
+
+    print(format_report(records))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
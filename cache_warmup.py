@@ -0,0 +1,145 @@
+"""Warms the local cache when the server starts, so the first requests after a
+deploy don't all miss. This renders the pages which don't depend on the
+request, e.g., /authorize, then the most frequently requested journey public
+link and touch link previews.
+
+How often each link is requested is counted in memory and persisted to the
+local cache periodically, so the counts survive restarts. The counts are halved
+on every startup so that links which have gone cold fall out of the top.
+"""
+
+import asyncio
+import os
+import time
+from collections import Counter
+from typing import Dict, List, Literal, Tuple
+import diskcache
+from loguru import logger
+from itgs import Itgs
+import metrics
+import readiness
+
+
+LinkKind = Literal["jpl", "touch_link"]
+
+HITS_KEY = b"cache_warmup:hits"
+"""The key in the local cache containing the persisted hit counts"""
+
+TOP_N = int(os.environ.get("OSEH_CACHE_WARMUP_TOP_N", "50"))
+"""How many of the most requested links of each kind are warmed"""
+
+MAX_TRACKED = 1000
+"""How many links of each kind we keep counts for"""
+
+CONCURRENCY = 4
+"""How many links are warmed at once"""
+
+PERSIST_INTERVAL_SECONDS = 60
+"""How often the hit counts are persisted"""
+
+READINESS_STEP = "cache_warmup"
+"""The readiness startup step marked done once warmup finishes"""
+
+_hits: Dict[LinkKind, Counter] = {"jpl": Counter(), "touch_link": Counter()}
+"""how often each link has been requested, by kind then code"""
+
+
+def record_hit(kind: LinkKind, code: str) -> None:
+    """Records that the link of the given kind with the given code was
+    requested
+    """
+    counts = _hits[kind]
+    counts[code] += 1
+    if len(counts) > 2 * MAX_TRACKED:
+        # keeps memory bounded when requests are for many distinct codes
+        _hits[kind] = Counter(dict(counts.most_common(MAX_TRACKED)))
+
+
+def _load_hits(cache: diskcache.Cache) -> None:
+    persisted: Dict[str, Dict[str, int]] = cache.get(HITS_KEY) or dict()
+    for kind, counts in _hits.items():
+        for code, count in persisted.get(kind, dict()).items():
+            if count // 2 > 0:
+                counts[code] += count // 2
+
+
+def _persist_hits(cache: diskcache.Cache) -> None:
+    cache.set(
+        HITS_KEY,
+        dict(
+            (kind, dict(counts.most_common(MAX_TRACKED)))
+            for kind, counts in _hits.items()
+        ),
+    )
+
+
+def hottest(kind: LinkKind, n: int) -> List[Tuple[str, int]]:
+    """Returns the n most requested codes of the given kind with their counts"""
+    return _hits[kind].most_common(n)
+
+
+async def warm() -> None:
+    """Loads the persisted hit counts, then renders the static pages and the
+    most requested links into the local cache, reporting how long it took.
+    The readiness step is marked done even if warming fails.
+    """
+    # imported here since the routes import this module to record hits
+    import routes.authorize
+    import routes.journey_public_links
+    import routes.update_password
+    import routes.user_touch_links
+
+    started_at = time.perf_counter()
+    num_warmed = 0
+    try:
+        async with Itgs() as itgs:
+            cache = await itgs.local_cache()
+            _load_hits(cache)
+
+            if os.environ["ENVIRONMENT"] != "dev":
+                await routes.authorize.get_authorize_html(itgs)
+                await routes.authorize.get_authorize_js(itgs)
+                await routes.update_password.get_update_password_html(itgs)
+                await routes.update_password.get_update_password_js(itgs)
+                num_warmed += 4
+
+        semaphore = asyncio.Semaphore(CONCURRENCY)
+
+        async def _warm_link(kind: LinkKind, code: str) -> None:
+            async with semaphore:
+                try:
+                    if kind == "jpl":
+                        await routes.journey_public_links.get_journey_public_link_response(
+                            code
+                        )
+                    else:
+                        await routes.user_touch_links.get_link_by_code(code)
+                except Exception:
+                    logger.exception(f"Failed to warm {kind} {code}")
+
+        links = [(kind, code) for kind in _hits for code, _ in hottest(kind, TOP_N)]
+        await asyncio.gather(*(_warm_link(kind, code) for kind, code in links))
+        num_warmed += len(links)
+    except Exception:
+        logger.exception("Failed to warm the local cache")
+    finally:
+        duration = time.perf_counter() - started_at
+        metrics.CACHE_WARMUP_SECONDS.labels().set(duration)
+        logger.info(f"Warmed {num_warmed} local cache entries in {duration:.3f}s")
+        readiness.mark_done(READINESS_STEP)
+
+
+async def persist_forever() -> None:
+    """Persists the hit counts periodically, so they survive restarts"""
+    while True:
+        await asyncio.sleep(PERSIST_INTERVAL_SECONDS)
+        await persist()
+
+
+async def persist() -> None:
+    """Persists the hit counts now"""
+    try:
+        async with Itgs() as itgs:
+            _persist_hits(await itgs.local_cache())
+    except Exception:
+        logger.exception("Failed to persist cache warmup hit counts")
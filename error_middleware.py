@@ -1,14 +1,24 @@
+import asyncio
 import io
 import traceback
 from fastapi import Request
 from fastapi.responses import Response, PlainTextResponse
-from typing import Dict, Optional
-from collections import deque
+from typing import TYPE_CHECKING, Dict, Literal, Optional, Tuple
+from collections import OrderedDict
+from redis_helpers.run_with_prep import run_with_prep
+from redis_helpers.token_bucket_try_consume import (
+    ensure_token_bucket_try_consume_script_exists,
+    token_bucket_try_consume,
+)
+import slack
 import time
 import os
 import socket
 from loguru import logger
 
+if TYPE_CHECKING:
+    from itgs import Itgs
+
 
 async def handle_request_error(request: Request, exc: Exception) -> Response:
     """Handles an error while processing a request"""
@@ -31,14 +41,10 @@ async def handle_error(exc: Exception, *, extra_info: Optional[str] = None) -> N
     if extra_info is not None:
         message += f"\n\n{extra_info}"
 
-    from itgs import Itgs
-
     try:
-        async with Itgs() as itgs:
-            slack = await itgs.slack()
-            await slack.send_web_error_message(
-                message, "an error occurred in frontend-web"
-            )
+        await send_slack_message(
+            "web_errors", message, "an error occurred in frontend-web"
+        )
     except:
         logger.exception("Failed to send slack message for error")
 
@@ -60,17 +66,10 @@ async def handle_contextless_error(*, extra_info: Optional[str] = None) -> None:
     if extra_info is not None:
         message += f"\n\n{extra_info}"
 
-    from itgs import Itgs
-
-    async with Itgs() as itgs:
-        slack = await itgs.slack()
-        await slack.send_web_error_message(
-            message, "a contextless error occurred in frontend-web"
-        )
-
+    await send_slack_message(
+        "web_errors", message, "a contextless error occurred in frontend-web"
+    )
 
-RECENT_WARNINGS: Dict[str, deque] = dict()  # deque[float] is not available on prod
-"""Maps from a warning identifier to a deque of timestamps of when the warning was sent."""
 
 WARNING_RATELIMIT_INTERVAL = 60 * 60
 """The interval in seconds we keep track of warnings for"""
@@ -78,10 +77,217 @@ WARNING_RATELIMIT_INTERVAL = 60 * 60
 MAX_WARNINGS_PER_INTERVAL = 5
 """The maximum number of warnings to send per interval for a particular identifier"""
 
+MAX_TRACKED_WARNING_IDENTIFIERS = 1024
+"""The maximum number of identifiers we keep ratelimit state for in memory; the
+least recently warned identifiers are forgotten first
+"""
+
+MAX_TOTAL_WARNINGS_PER_INTERVAL = 100
+"""The maximum number of warnings to send per interval across all identifiers, so
+that high-cardinality identifiers can't flood slack even though their individual
+state may be forgotten
+"""
+
+WARNING_RATELIMIT_CLUSTER_WIDE = (
+    os.environ.get("OSEH_WARNING_RATELIMIT_CLUSTER_WIDE", "0") == "1"
+)
+"""If true, warnings are additionally ratelimited across all instances using
+redis, so that N instances don't each send MAX_WARNINGS_PER_INTERVAL
+"""
+
+
+class WarningRateLimiter:
+    """A fixed-memory ratelimiter using a token bucket per identifier, where the
+    buckets are kept in an LRU of bounded size, plus one bucket shared by all
+    identifiers. Each check is O(1).
+    """
+
+    def __init__(
+        self,
+        *,
+        capacity: int,
+        interval: float,
+        max_identifiers: int,
+        total_capacity: int,
+    ) -> None:
+        self.capacity = capacity
+        """The maximum number of tokens in each identifiers bucket"""
+
+        self.refill_per_second = capacity / interval
+        """How many tokens are added to each bucket per second"""
+
+        self.max_identifiers = max_identifiers
+        """The maximum number of buckets we store"""
+
+        self.total_capacity = total_capacity
+        """The maximum number of tokens in the bucket shared by all identifiers"""
+
+        self.total_refill_per_second = total_capacity / interval
+        """How many tokens are added to the shared bucket per second"""
+
+        self.buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        """Maps from identifier to (tokens, updated_at), least recently used first"""
+
+        self.total_bucket: Tuple[float, float] = (float(total_capacity), time.time())
+        """The (tokens, updated_at) for the bucket shared by all identifiers"""
+
+    def try_consume(self, identifier: str, now: float) -> Optional[float]:
+        """Consumes a token for the given identifier if one is available in both its
+        bucket and the shared bucket
+
+        Returns:
+            float, None: the number of tokens remaining for the identifier if a token
+                was consumed, otherwise None
+        """
+        tokens, updated_at = self.buckets.get(identifier, (self.capacity, now))
+        tokens = min(
+            self.capacity,
+            tokens + max(0, now - updated_at) * self.refill_per_second,
+        )
+        total_tokens, total_updated_at = self.total_bucket
+        total_tokens = min(
+            self.total_capacity,
+            total_tokens
+            + max(0, now - total_updated_at) * self.total_refill_per_second,
+        )
+
+        consumed = tokens >= 1 and total_tokens >= 1
+        if consumed:
+            tokens -= 1
+            total_tokens -= 1
+
+        self.buckets[identifier] = (tokens, now)
+        self.buckets.move_to_end(identifier)
+        while len(self.buckets) > self.max_identifiers:
+            self.buckets.popitem(last=False)
+        self.total_bucket = (total_tokens, now)
+        return tokens if consumed else None
+
+
+WARNING_RATELIMITER = WarningRateLimiter(
+    capacity=MAX_WARNINGS_PER_INTERVAL,
+    interval=WARNING_RATELIMIT_INTERVAL,
+    max_identifiers=MAX_TRACKED_WARNING_IDENTIFIERS,
+    total_capacity=MAX_TOTAL_WARNINGS_PER_INTERVAL,
+)
+"""The ratelimiter for warnings within this process"""
+
+
+CLUSTER_RATELIMIT_RETRY_SECONDS = 60
+"""How long the cluster-wide ratelimiter is skipped after failing to reach redis,
+so that an outage doesn't cost a reconnect attempt per warning
+"""
+
+
+class ClusterWarningRateLimiter:
+    """Ratelimits warnings across all instances using a token bucket per
+    identifier in redis. Keeps one long-lived redis connection per event loop
+    rather than connecting for every warning. If redis is unavailable, every
+    warning is allowed for a while without trying to reconnect, since the local
+    ratelimiter still applies.
+    """
+
+    def __init__(self, *, capacity: int, interval: float, retry_after: float) -> None:
+        self.capacity = capacity
+        """The maximum number of tokens in each identifiers bucket"""
+
+        self.refill_per_second = capacity / interval
+        """How many tokens are added to each bucket per second"""
+
+        self.retry_after = retry_after
+        """How long to skip redis after failing to reach it, in seconds"""
+
+        self.unavailable_until: float = 0
+        """Until when redis is skipped, in seconds since the epoch"""
+
+        self.itgs: Optional["Itgs"] = None
+        """The integrations holding the redis connection, if it's open"""
+
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        """The event loop the connection and lock belong to"""
+
+        self.lock: Optional[asyncio.Lock] = None
+        """Prevents opening multiple connections concurrently"""
+
+    async def _get_itgs(self) -> "Itgs":
+        from itgs import Itgs
+
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # connections can't be used from another event loop; the old one,
+            # if any, is abandoned along with its loop
+            self.loop = loop
+            self.lock = asyncio.Lock()
+            self.itgs = None
+
+        async with self.lock:
+            if self.itgs is None:
+                itgs = Itgs()
+                await itgs.__aenter__()
+                self.itgs = itgs
+            return self.itgs
+
+    async def try_consume(self, identifier: str, now: float) -> bool:
+        """Consumes a token for the given identifier, returning False if none was
+        available. Returns True without checking if redis is unavailable.
+        """
+        if now < self.unavailable_until:
+            return True
+
+        try:
+            itgs = await self._get_itgs()
+            redis = await itgs.redis()
+
+            async def _prep(force: bool):
+                await ensure_token_bucket_try_consume_script_exists(redis, force=force)
+
+            async def _func():
+                return await token_bucket_try_consume(
+                    redis,
+                    f"frontend-web:warnings:ratelimit:{identifier}".encode("utf-8"),
+                    capacity=self.capacity,
+                    refill_per_second=self.refill_per_second,
+                    now=now,
+                )
+
+            result = await run_with_prep(_prep, _func)
+        except:
+            logger.exception(
+                "Failed to check cluster-wide warning ratelimit; only using the "
+                f"local ratelimiter for the next {self.retry_after} seconds"
+            )
+            self.unavailable_until = now + self.retry_after
+            await self.close()
+            return True
+
+        return result.consumed
+
+    async def close(self) -> None:
+        """Closes the redis connection, if it's open. It's reopened as needed."""
+        itgs = self.itgs
+        self.itgs = None
+        if itgs is None or self.loop is not asyncio.get_running_loop():
+            return
+
+        try:
+            await itgs.__aexit__(None, None, None)
+        except:
+            logger.exception("Failed to close cluster-wide warning ratelimiter")
+
+
+CLUSTER_WARNING_RATELIMITER = ClusterWarningRateLimiter(
+    capacity=MAX_WARNINGS_PER_INTERVAL,
+    interval=WARNING_RATELIMIT_INTERVAL,
+    retry_after=CLUSTER_RATELIMIT_RETRY_SECONDS,
+)
+"""The ratelimiter for warnings across all instances, used if
+WARNING_RATELIMIT_CLUSTER_WIDE is set
+"""
+
 
 async def handle_warning(
     identifier: str, text: str, exc: Optional[Exception] = None, is_urgent: bool = False
-) -> None:
+) -> bool:
     """Sends a warning to slack, with basic ratelimiting
 
     Args:
@@ -91,6 +297,9 @@ async def handle_warning(
           the text appropriately
         is_urgent (bool): If true, the message is sent to the #oseh-bot channel instead
           of the #web-errors channel
+
+    Returns:
+        bool: False if the warning was suppressed by the ratelimit, True otherwise
     """
 
     if exc is not None:
@@ -104,35 +313,58 @@ async def handle_warning(
 
     logger.warning(f"{identifier}: {text}")
 
-    if identifier not in RECENT_WARNINGS:
-        RECENT_WARNINGS[identifier] = deque()
-
-    recent_warnings = RECENT_WARNINGS[identifier]
     now = time.time()
-
-    while recent_warnings and recent_warnings[0] < now - WARNING_RATELIMIT_INTERVAL:
-        recent_warnings.popleft()
-
-    if len(recent_warnings) >= MAX_WARNINGS_PER_INTERVAL:
+    remaining = WARNING_RATELIMITER.try_consume(identifier, now)
+    if remaining is None or (
+        WARNING_RATELIMIT_CLUSTER_WIDE
+        and not await CLUSTER_WARNING_RATELIMITER.try_consume(identifier, now)
+    ):
         logger.debug(f"warning suppressed (ratelimit): {identifier}")
-        return
+        return False
 
-    recent_warnings.append(now)
-    total_warnings = len(recent_warnings)
+    total_warnings = MAX_WARNINGS_PER_INTERVAL - int(remaining)
 
     message = f"WARNING: `{identifier}` (warning {total_warnings}/{MAX_WARNINGS_PER_INTERVAL} per {WARNING_RATELIMIT_INTERVAL} seconds for `{socket.gethostname()}` - pid {os.getpid()})\n\n{text}"
     preview = f"WARNING: {identifier}"
 
-    from itgs import Itgs
-
     try:
-        async with Itgs() as itgs:
-            slack = await itgs.slack()
-            if is_urgent:
-                logger.debug("sending warning to #ops")
-                await slack.send_oseh_bot_message(message, preview=preview)
-            else:
-                logger.debug("sending warning to #web-errors")
-                await slack.send_web_error_message(message, preview=preview)
+        if is_urgent:
+            logger.debug("sending warning to #oseh-bot")
+            await send_slack_message("oseh_bot", message, preview)
+        else:
+            logger.debug("sending warning to #web-errors")
+            await send_slack_message("web_errors", message, preview)
     except:
         logger.exception("Failed to send slack message for warning")
+
+    return True
+
+
+SLACK_URL_ENV_BY_CHANNEL: Dict[str, str] = {
+    "web_errors": "SLACK_WEB_ERRORS_URL",
+    "oseh_bot": "SLACK_OSEH_BOT_URL",
+}
+"""The environment variable containing the incoming webhook url for each channel"""
+
+
+async def send_slack_message(
+    channel: Literal["web_errors", "oseh_bot"], message: str, preview: str
+) -> None:
+    """Sends the given markdown message to the given slack channel. If the
+    process-wide slack dispatcher is running, this only enqueues the message,
+    otherwise it's sent inline with a fresh slack connection.
+    """
+    dispatcher = slack.get_dispatcher()
+    if dispatcher is not None and dispatcher.enqueue(
+        os.environ.get(SLACK_URL_ENV_BY_CHANNEL[channel]), message, preview
+    ):
+        return
+
+    from itgs import Itgs
+
+    async with Itgs() as itgs:
+        sl = await itgs.slack()
+        if channel == "oseh_bot":
+            await sl.send_oseh_bot_message(message, preview=preview)
+        else:
+            await sl.send_web_error_message(message, preview=preview)
@@ -1,15 +1,27 @@
 from abc import ABC
 from io import BytesIO
-from typing import Union
+from typing import Any, BinaryIO, Dict, List, Optional, Union
 import aioboto3
 import botocore.exceptions
-import aiofiles
+import anyio
+import asyncio
 import os
+import stat
+import errno
+import secrets
 import logging
-from temp_files import temp_file
 import io
 
 
+LOCAL_FILES_CHUNK_SIZE = 1024 * 1024
+"""The buffer size used when copying between local files and python file-like
+objects; large so that there are few thread hops per operation
+"""
+
+LOCAL_FILES_ZERO_COPY_CHUNK_SIZE = 1024 * 1024 * 1024
+"""The maximum number of bytes to copy per copy_file_range/sendfile call"""
+
+
 class AsyncReadableBytesIO(ABC):
     """A type that represents a stream that can be read asynchronously"""
 
@@ -89,12 +101,45 @@ class S3:
     Acts as an async context manager. An instance is typically retrieved through
     `files = await itgs.files()` when in production mode, whereas in dev mode
     that will return a `LocalFiles` instance.
+
+    Uploads from anything other than a real file are streamed to S3 via a
+    multipart upload, so at most `upload_concurrency` parts of `part_size` bytes
+    are held in memory at once and nothing is spooled to disk.
     """
 
-    def __init__(self, default_bucket: str) -> None:
+    def __init__(
+        self,
+        default_bucket: str,
+        *,
+        part_size: int = 16 * 1024 * 1024,
+        upload_concurrency: int = 4,
+        download_chunk_size: int = 1024 * 1024,
+        download_concurrency: int = 1,
+    ) -> None:
+        assert part_size >= 5 * 1024 * 1024, "S3 requires parts of at least 5 MiB"
+        assert upload_concurrency >= 1
+        assert download_chunk_size >= 1
+        assert download_concurrency >= 1
+
         self.default_bucket = default_bucket
         """The recommended default bucket"""
 
+        self.part_size = part_size
+        """The size in bytes of each part in multipart uploads, and of each range
+        when downloading with ranged GETs
+        """
+
+        self.upload_concurrency = upload_concurrency
+        """The maximum number of parts uploaded at once in a multipart upload"""
+
+        self.download_chunk_size = download_chunk_size
+        """The number of bytes read from the response body at a time when downloading"""
+
+        self.download_concurrency = download_concurrency
+        """If greater than 1, objects larger than part_size are downloaded via this
+        many concurrent ranged GETs, otherwise with a single GET
+        """
+
         self._session = None
         """The session object, if we have one, i.e., if we have been aenter'd"""
 
@@ -125,37 +170,89 @@ class S3:
         sync: bool,
     ) -> None:
         logging.info(f"[file_service/s3]: upload {bucket=}, {key=}")
-        if not sync:
-            with temp_file() as tmp:
-                async with aiofiles.open(tmp, "wb") as f2:
-                    data = await f.read(8192)
-                    while data:
-                        await f2.write(data)
-                        data = await f.read(8192)
-
-                with open(tmp, "rb") as f2:
-                    await self._s3.put_object(Bucket=bucket, Key=key, Body=f2)
+        if sync and isinstance(f, io.IOBase):
+            await self._s3.put_object(Bucket=bucket, Key=key, Body=f)
             return
 
-        if not isinstance(f, io.IOBase) and hasattr(f, "read"):
-            # Typically this is from e.g., SpooledTemporaryFile, which is nearly an io-like
-            # file since introduced, but not actually one until python 3.11. We take a pretty
-            # big performance hit for converting spooled files this way, but since it goes
-            # away once our python version is higher, we can live with it.
+        # Async streams, and e.g. SpooledTemporaryFile, which is nearly an io-like
+        # file since introduced, but not actually one until python 3.11
+        await self._upload_multipart(f, bucket=bucket, key=key, sync=sync)
 
-            with temp_file() as tmp:
-                async with aiofiles.open(tmp, "wb") as f2:
-                    data = f.read(8192)
-                    while data:
-                        await f2.write(data)
-                        data = f.read(8192)
+    async def _read_part(
+        self, f: Union[BytesIO, AsyncReadableBytesIO], sync: bool
+    ) -> bytes:
+        """Reads up to part_size bytes from the given file-like object, returning
+        fewer only if the end of the stream is reached
+        """
+        result = bytearray()
+        while len(result) < self.part_size:
+            remaining = self.part_size - len(result)
+            chunk = f.read(remaining) if sync else await f.read(remaining)
+            if not chunk:
+                break
+            result.extend(chunk)
+        return bytes(result)
+
+    async def _upload_multipart(
+        self,
+        f: Union[BytesIO, AsyncReadableBytesIO],
+        *,
+        bucket: str,
+        key: str,
+        sync: bool,
+    ) -> None:
+        data = await self._read_part(f, sync)
+        if len(data) < self.part_size:
+            await self._s3.put_object(Bucket=bucket, Key=key, Body=data)
+            return
 
-                with open(tmp, "rb") as f2:
-                    await self._s3.put_object(Bucket=bucket, Key=key, Body=f2)
+        response = await self._s3.create_multipart_upload(Bucket=bucket, Key=key)
+        upload_id = response["UploadId"]
 
-            return
+        semaphore = asyncio.Semaphore(self.upload_concurrency)
+        tasks: List[asyncio.Task] = []
 
-        await self._s3.put_object(Bucket=bucket, Key=key, Body=f)
+        async def _upload_part(part_number: int, body: bytes) -> Dict[str, Any]:
+            try:
+                response = await self._s3.upload_part(
+                    Bucket=bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=part_number,
+                    Body=body,
+                )
+                return {"ETag": response["ETag"], "PartNumber": part_number}
+            finally:
+                semaphore.release()
+
+        try:
+            while data:
+                # bounds memory to upload_concurrency parts in flight plus the
+                # one being read
+                await semaphore.acquire()
+                for task in tasks:
+                    if task.done() and task.exception() is not None:
+                        semaphore.release()
+                        raise task.exception()
+
+                tasks.append(asyncio.create_task(_upload_part(len(tasks) + 1, data)))
+                data = await self._read_part(f, sync)
+
+            parts = await asyncio.gather(*tasks)
+            await self._s3.complete_multipart_upload(
+                Bucket=bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self._s3.abort_multipart_upload(
+                Bucket=bucket, Key=key, UploadId=upload_id
+            )
+            raise
 
     async def download(
         self,
@@ -167,29 +264,106 @@ class S3:
     ) -> bool:
         logging.info(f"[file_service/s3]: download {bucket=}, {key=}")
         try:
-            s3_ob = await self._s3.get_object(Bucket=bucket, Key=key)
-
-            # https://github.com/terrycain/aioboto3/issues/266
-            stream = s3_ob["Body"]
-            try:
-                data = await stream.read(8192)
-                if sync:
-                    while data:
-                        f.write(data)
-                        data = await stream.read(8192)
-                else:
-                    while data:
-                        await f.write(data)
-                        data = await stream.read(8192)
-            finally:
-                stream.close()
+            if self.download_concurrency > 1:
+                await self._download_ranged(f, bucket=bucket, key=key, sync=sync)
+                return True
 
+            s3_ob = await self._s3.get_object(Bucket=bucket, Key=key)
+            await self._copy_body(s3_ob["Body"], f, sync=sync)
             return True
         except botocore.exceptions.ClientError as e:
             if e.response["Error"]["Code"] == "NoSuchKey":
                 return False
             raise
 
+    async def _copy_body(
+        self, stream, f: Union[BytesIO, AsyncWritableBytesIO], *, sync: bool
+    ) -> None:
+        # https://github.com/terrycain/aioboto3/issues/266
+        try:
+            data = await stream.read(self.download_chunk_size)
+            if sync:
+                while data:
+                    f.write(data)
+                    data = await stream.read(self.download_chunk_size)
+            else:
+                while data:
+                    await f.write(data)
+                    data = await stream.read(self.download_chunk_size)
+        finally:
+            stream.close()
+
+    async def _download_ranged(
+        self,
+        f: Union[BytesIO, AsyncWritableBytesIO],
+        *,
+        bucket: str,
+        key: str,
+        sync: bool,
+    ) -> None:
+        """Downloads the object using concurrent ranged GETs of part_size bytes,
+        writing them to f in order. The first range also tells us the total size,
+        so small objects still only take a single request. The later ranges are
+        pinned to the etag of the first, so if the object is overwritten
+        mid-download this fails rather than mixing the two versions.
+        """
+        try:
+            s3_ob = await self._s3.get_object(
+                Bucket=bucket, Key=key, Range=f"bytes=0-{self.part_size - 1}"
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] != "InvalidRange":
+                raise
+            # empty objects cannot satisfy any range
+            s3_ob = await self._s3.get_object(Bucket=bucket, Key=key)
+            await self._copy_body(s3_ob["Body"], f, sync=sync)
+            return
+
+        content_range: Optional[str] = s3_ob.get("ContentRange")
+        total_size = (
+            int(content_range.rsplit("/", 1)[1])
+            if content_range is not None
+            else s3_ob["ContentLength"]
+        )
+
+        etag: str = s3_ob["ETag"]
+
+        async def _fetch_range(start: int) -> bytes:
+            end = min(start + self.part_size, total_size) - 1
+            response = await self._s3.get_object(
+                Bucket=bucket, Key=key, Range=f"bytes={start}-{end}", IfMatch=etag
+            )
+            stream = response["Body"]
+            try:
+                return await stream.read()
+            finally:
+                stream.close()
+
+        # sliding window so at most download_concurrency ranges are in memory
+        pending: List[asyncio.Task] = []
+        next_start = self.part_size
+        try:
+            while next_start < total_size and len(pending) < self.download_concurrency:
+                pending.append(asyncio.create_task(_fetch_range(next_start)))
+                next_start += self.part_size
+
+            await self._copy_body(s3_ob["Body"], f, sync=sync)
+
+            while pending:
+                data = await pending.pop(0)
+                if next_start < total_size:
+                    pending.append(asyncio.create_task(_fetch_range(next_start)))
+                    next_start += self.part_size
+
+                if sync:
+                    f.write(data)
+                else:
+                    await f.write(data)
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
     async def delete(self, *, bucket: str, key: str) -> bool:
         logging.info(f"[file_service/s3]: delete {bucket=}, {key=}")
         try:
@@ -225,20 +399,41 @@ class LocalFiles:
         key: str,
         sync: bool,
     ) -> None:
+        """Writes to a temporary file next to the destination and then renames it
+        into place, so readers never see a partially written file.
+        """
         dst = os.path.join(self._root, bucket, key)
-        dst_folder = os.path.dirname(dst)
-        os.makedirs(dst_folder, exist_ok=True)
-        async with aiofiles.open(dst, "wb") as f2:
+        tmp = f"{dst}.{secrets.token_hex(8)}.tmp"
+
+        def _open_tmp() -> BinaryIO:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            return open(tmp, "wb")
+
+        def _write_sync() -> None:
+            with _open_tmp() as f2:
+                _copy_fileobj(f, f2)
+            os.replace(tmp, dst)
+
+        try:
             if sync:
-                chunk = f.read(8192)
-                while chunk:
-                    await f2.write(chunk)
-                    chunk = f.read(8192)
-            else:
-                chunk = await f.read(8192)
+                await anyio.to_thread.run_sync(_write_sync)
+                return
+
+            f2 = await anyio.to_thread.run_sync(_open_tmp)
+            try:
+                chunk = await f.read(LOCAL_FILES_CHUNK_SIZE)
                 while chunk:
-                    await f2.write(chunk)
-                    chunk = await f.read(8192)
+                    await anyio.to_thread.run_sync(f2.write, chunk)
+                    chunk = await f.read(LOCAL_FILES_CHUNK_SIZE)
+            finally:
+                await anyio.to_thread.run_sync(f2.close)
+            await anyio.to_thread.run_sync(os.replace, tmp, dst)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+            raise
 
     async def download(
         self,
@@ -249,22 +444,35 @@ class LocalFiles:
         sync: bool,
     ) -> bool:
         logging.info(f"[file_service/local_files]: download {bucket=}, {key=}")
-        try:
-            async with aiofiles.open(os.path.join(self._root, bucket, key), "rb") as f2:
-                chunk = await f2.read(8192)
-                if sync:
-                    while chunk:
-                        f.write(chunk)
-                        chunk = await f2.read(8192)
-                else:
-                    while chunk:
-                        await f.write(chunk)
-                        chunk = await f2.read(8192)
+        src = os.path.join(self._root, bucket, key)
 
-            return True
+        if sync:
+
+            def _read_sync() -> bool:
+                try:
+                    f2 = open(src, "rb")
+                except FileNotFoundError:
+                    return False
+                with f2:
+                    _copy_fileobj(f2, f)
+                return True
+
+            return await anyio.to_thread.run_sync(_read_sync)
+
+        try:
+            f2: BinaryIO = await anyio.to_thread.run_sync(open, src, "rb")
         except FileNotFoundError:
             return False
 
+        try:
+            chunk = await anyio.to_thread.run_sync(f2.read, LOCAL_FILES_CHUNK_SIZE)
+            while chunk:
+                await f.write(chunk)
+                chunk = await anyio.to_thread.run_sync(f2.read, LOCAL_FILES_CHUNK_SIZE)
+        finally:
+            await anyio.to_thread.run_sync(f2.close)
+        return True
+
     async def delete(self, *, bucket: str, key: str) -> bool:
         logging.info(f"[file_service/local_files]: delete {bucket=}, {key=}")
         try:
@@ -272,3 +480,90 @@ class LocalFiles:
             return True
         except FileNotFoundError:
             return False
+
+
+def _fileno(f) -> Optional[int]:
+    """Returns the file descriptor backing the given file-like object, if it is
+    backed by a regular file, otherwise None
+    """
+    try:
+        fd = f.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+    try:
+        return fd if stat.S_ISREG(os.fstat(fd).st_mode) else None
+    except OSError:
+        return None
+
+
+def _copy_fileobj(src: BinaryIO, dst: BinaryIO) -> int:
+    """Copies the remainder of src to dst, starting at their current positions,
+    and returns the number of bytes copied. When both ends are regular files this
+    uses copy_file_range or sendfile so the data never enters userspace, otherwise
+    it copies with a large buffer. This blocks, so it should be run in a thread.
+    """
+    src_fd = _fileno(src)
+    dst_fd = _fileno(dst) if src_fd is not None else None
+    if src_fd is None or dst_fd is None:
+        return _copy_fileobj_buffered(src, dst)
+
+    dst.flush()
+    src_start = src.tell()
+    dst_start = dst.tell()
+    total = 0
+
+    # the python level objects have their own buffers and positions, so we use
+    # explicit offsets and resync the objects at the end
+    use_copy_file_range = hasattr(os, "copy_file_range")
+    use_sendfile = hasattr(os, "sendfile")
+    try:
+        while use_copy_file_range:
+            try:
+                copied = os.copy_file_range(
+                    src_fd,
+                    dst_fd,
+                    LOCAL_FILES_ZERO_COPY_CHUNK_SIZE,
+                    src_start + total,
+                    dst_start + total,
+                )
+            except OSError as e:
+                if e.errno not in (
+                    errno.EXDEV,
+                    errno.ENOSYS,
+                    errno.EINVAL,
+                    errno.EOPNOTSUPP,
+                ):
+                    raise
+                use_copy_file_range = False
+                break
+            if copied == 0:
+                return total
+            total += copied
+
+        if use_sendfile:
+            os.lseek(dst_fd, dst_start + total, os.SEEK_SET)
+            while True:
+                sent = os.sendfile(
+                    dst_fd, src_fd, src_start + total, LOCAL_FILES_ZERO_COPY_CHUNK_SIZE
+                )
+                if sent == 0:
+                    return total
+                total += sent
+    finally:
+        src.seek(src_start + total)
+        dst.seek(dst_start + total)
+
+    return total + _copy_fileobj_buffered(src, dst)
+
+
+def _copy_fileobj_buffered(src: BinaryIO, dst: BinaryIO) -> int:
+    """Copies the remainder of src to dst with a large buffer, returning the
+    number of bytes copied
+    """
+    total = 0
+    while True:
+        chunk = src.read(LOCAL_FILES_CHUNK_SIZE)
+        if not chunk:
+            return total
+        dst.write(chunk)
+        total += len(chunk)
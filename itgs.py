@@ -2,7 +2,6 @@
 the integration is only loaded upon request.
 """
 
-import json
 import random
 from typing import Callable, Coroutine, Dict, Literal, Optional
 import rqdb
@@ -11,12 +10,13 @@ import rqdb.logging
 import redis.asyncio
 import diskcache
 import os
-from error_middleware import handle_warning
 import slack
 import jobs
 import file_service
 import loguru
 import revenue_cat
+import slow_query_analyzer
+import tracing
 import asyncio
 import twilio.rest
 from loguru import logger
@@ -34,11 +34,17 @@ it's fine if:
 - this is used in different threads
 """
 
+_traced_diskcache: diskcache.Cache = tracing.traced(
+    our_diskcache, "diskcache", time_sync=True
+)
+"""our_diskcache as handed out by `Itgs.local_cache`, timing each call"""
+
 ItgsCleanupIdentifier = Literal[
     "conn",
     "redis_main",
     "slack",
     "jobs",
+    "job_waiter",
     "file_service",
     "revenue_cat",
     "twilio",
@@ -77,6 +83,9 @@ class Itgs:
         self._jobs: Optional[jobs.Jobs] = None
         """the jobs connection if it had been opened"""
 
+        self._job_waiter: Optional[jobs.JobWaiter] = None
+        """the job waiter if it had been opened"""
+
         self._file_service: Optional[file_service.FileService] = None
         """the file service connection if it had been opened"""
 
@@ -150,65 +159,6 @@ class Itgs:
 
             self._closures["conn"] = cleanup
 
-            bknd_tasks = set()
-
-            async def on_slow_query_async(
-                info: rqdb.logging.QueryInfo,
-                /,
-                *,
-                duration_seconds: float,
-                host: str,
-                response_size_bytes: int,
-                started_at: float,
-                ended_at: float,
-            ):
-                pretty_ops = "\n---\n".join(
-                    f"query: {op}\nargs: {json.dumps(args)}\n"
-                    for op, args in zip(info.operations, info.params)
-                )
-                if not await handle_warning(
-                    "backend:slow_query",
-                    f"query to {host} took {duration_seconds:.3f}s to return {response_size_bytes} bytes:"
-                    f"\n\n```\n{pretty_ops}\n```",
-                ):
-                    return
-
-                async with Itgs() as itgs:
-                    conn = await itgs.conn()
-                    cursor = conn.cursor("none")
-                    slack = await itgs.slack()
-                    for op, args in zip(info.operations, info.params):
-                        explained = await cursor.explain(op, args, out="str")
-                        await slack.send_web_error_message(
-                            f"Slow query to {host} explain query plan:\n```\nquery: {op}\nargs: {json.dumps(args)}\n{explained}\n```"
-                        )
-
-            def on_slow_query(
-                info: rqdb.logging.QueryInfo,
-                /,
-                *,
-                duration_seconds: float,
-                host: str,
-                response_size_bytes: int,
-                started_at: float,
-                ended_at: float,
-            ):
-                if len(bknd_tasks) > 2:
-                    return
-
-                task = asyncio.create_task(
-                    on_slow_query_async(
-                        info,
-                        duration_seconds=duration_seconds,
-                        host=host,
-                        response_size_bytes=response_size_bytes,
-                        started_at=started_at,
-                        ended_at=ended_at,
-                    )
-                )
-                bknd_tasks.add(task)
-                task.add_done_callback(lambda _: bknd_tasks.remove(task))
-
             def _err_log(msg: str):
                 loguru.logger.exception(msg)
 
@@ -263,14 +213,16 @@ class Itgs:
                     slow_query={
                         "enabled": True,
                         "threshold_seconds": 1,
-                        "method": on_slow_query,
+                        "method": slow_query_analyzer.get_analyzer().on_slow_query,
                     },
                     backup_start=lvl_info(),
                     backup_end=lvl_info(),
                 ),
             )
             await c.__aenter__()
-            self._conn = c
+            self._conn = tracing.traced(
+                c, "rqlite", wrap_results=frozenset(("cursor",))
+            )
 
         return self._conn
 
@@ -341,8 +293,8 @@ class Itgs:
                         len(redis_ips) // 2
                     ), f"{num_other_sentinels=}, {len(redis_ips)=}"
 
-                    self._redis_main = redis.asyncio.Redis(
-                        host=master_ip, port=master_port
+                    self._redis_main = tracing.traced(
+                        redis.asyncio.Redis(host=master_ip, port=master_port), "redis"
                     )
                     return self._redis_main
                 except:
@@ -371,7 +323,7 @@ class Itgs:
                 me._slack = None
 
             self._closures["slack"] = cleanup
-            self._slack = s
+            self._slack = tracing.traced(s, "slack")
 
         return self._slack
 
@@ -398,6 +350,31 @@ class Itgs:
 
         return self._jobs
 
+    async def job_waiter(self) -> "jobs.JobWaiter":
+        """gets or creates the job waiter, which shares a single pubsub connection
+        for waiting on any number of jobs to finish
+        """
+        if self._job_waiter is not None:
+            return self._job_waiter
+
+        _redis = await self.redis()
+        async with self._lock:
+            await self._check_guard_with_lock()
+            if self._job_waiter is not None:
+                return self._job_waiter
+
+            w = jobs.JobWaiter(_redis)
+            await w.__aenter__()
+
+            async def cleanup(me: "Itgs") -> None:
+                await w.__aexit__(None, None, None)
+                me._job_waiter = None
+
+            self._closures["job_waiter"] = cleanup
+            self._job_waiter = w
+
+        return self._job_waiter
+
     async def files(self) -> file_service.FileService:
         """gets or creates the file service for large binary blobs"""
         if self._file_service is not None:
@@ -423,7 +400,7 @@ class Itgs:
                 me._file_service = None
 
             self._closures["file_service"] = cleanup
-            self._file_service = fs
+            self._file_service = tracing.traced(fs, "files")
 
         return self._file_service
 
@@ -431,7 +408,7 @@ class Itgs:
         """gets or creates the local cache for storing files transiently on this instance"""
         async with self._lock:
             await self._check_guard_with_lock()
-        return our_diskcache
+        return _traced_diskcache
 
     async def revenue_cat(self) -> revenue_cat.RevenueCat:
         """gets or creates the revenue cat connection"""
@@ -506,6 +483,10 @@ class Itgs:
                 await self._closures["jobs"](self)
                 del self._closures["jobs"]
 
+            if self._job_waiter is not None:
+                await self._closures["job_waiter"](self)
+                del self._closures["job_waiter"]
+
             await self._closures["redis_main"](self)
             del self._closures["redis_main"]
 
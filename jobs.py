@@ -1,7 +1,11 @@
 import redis.asyncio
+import redis.asyncio.client
+import redis.exceptions
+import asyncio
 import json
+import orjson
 import time
-from typing import Optional, TypedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple, TypedDict, Union
 
 
 class Job(TypedDict):
@@ -36,6 +40,11 @@ class Jobs:
         self.queue_key: bytes = b"jobs:hot"
         """the key for the list in redis"""
 
+        self._supports_blmpop: bool = True
+        """false once redis has rejected BLMPOP as an unknown command, i.e., it's
+        older than redis 7, after which retrieve_many stops trying it
+        """
+
     async def __aenter__(self) -> "Jobs":
         return self
 
@@ -58,6 +67,24 @@ class Jobs:
         job_serd = json.dumps(job)
         await self.conn.rpush(self.queue_key, job_serd.encode("utf-8"))
 
+    async def enqueue_many(self, jobs: Iterable[Tuple[str, Dict[str, Any]]]) -> None:
+        """queues all the given jobs in a single round trip, in order. this is
+        equivalent to calling enqueue for each job, but much faster when there
+        are many jobs
+
+        Args:
+            jobs (Iterable[Tuple[str, Dict[str, Any]]]): the name and keyword arguments
+                for each job, see `enqueue`
+        """
+        queued_at = time.time()
+        jobs_serd = [
+            orjson.dumps({"name": name, "kwargs": kwargs, "queued_at": queued_at})
+            for name, kwargs in jobs
+        ]
+        if not jobs_serd:
+            return
+        await self.conn.rpush(self.queue_key, *jobs_serd)
+
     async def retrieve(self, timeout: float) -> Optional[Job]:
         """blocking retrieve of the oldest job in the queue, if there is one
 
@@ -72,9 +99,222 @@ class Jobs:
         )
         if response is None:
             return None
-        job_serd_and_encoded: bytes = response[1]
-        print(repr(job_serd_and_encoded))
-        job_serd = job_serd_and_encoded.decode("utf-8")
-        print(repr(job_serd))
-        job = json.loads(job_serd)
-        return job
+        return orjson.loads(response[1])
+
+    async def retrieve_many(self, count: int, timeout: float) -> List[Job]:
+        """blocking retrieve of up to count of the oldest jobs in the queue, in a
+        single round trip. uses BLMPOP on redis 7 or later, and otherwise a
+        pipelined BLPOP followed by LPOP with a count (redis 6.2 or later)
+
+        Args:
+            count (int): the maximum number of jobs to retrieve
+            timeout (float): maximum time in seconds to wait for a job to be enqueued
+
+        Returns:
+            List[Job]: The oldest jobs, oldest first, or an empty list if the timeout
+                was reached
+        """
+        if self._supports_blmpop:
+            try:
+                response: Optional[list] = await self.conn.blmpop(
+                    timeout, 1, self.queue_key, direction="LEFT", count=count
+                )
+            except redis.exceptions.ResponseError as e:
+                if "unknown command" not in str(e).lower():
+                    raise
+                self._supports_blmpop = False
+            else:
+                if response is None:
+                    return []
+                return [orjson.loads(job_serd) for job_serd in response[1]]
+
+        # the lpop is only executed once the blpop returns, so it takes the jobs
+        # right after the one the blpop got
+        async with self.conn.pipeline(transaction=False) as pipe:
+            await pipe.blpop(self.queue_key, timeout=timeout)
+            if count > 1:
+                await pipe.lpop(self.queue_key, count - 1)
+            responses = await pipe.execute()
+
+        first: Optional[tuple] = responses[0]
+        if first is None:
+            return []
+        result: List[Job] = [orjson.loads(first[1])]
+        if count > 1 and responses[1] is not None:
+            result.extend(orjson.loads(job_serd) for job_serd in responses[1])
+        return result
+
+
+class JobWaiter:
+    """Waits for jobs to finish using a single pubsub connection, rather than
+    one subscription per job. Jobs which are enqueued with a `job_uid` publish
+    to `ps:job:{job_uid}` when they finish; this subscribes to `ps:job:*` and
+    dispatches each message to the future registered for that job.
+
+    Acts as an asynchronous context manager. An instance is typically retrieved
+    through `job_waiter = await itgs.job_waiter()`.
+
+    Usage:
+
+    ```py
+    job_waiter = await itgs.job_waiter()
+    job_uid = secrets.token_urlsafe(16)
+    job_waiter.register(job_uid)  # must be before enqueueing
+    await jobs.enqueue("runners.example", job_uid=job_uid)
+    await job_waiter.wait(job_uid, timeout=120)
+    ```
+    """
+
+    def __init__(
+        self, conn: redis.asyncio.Redis, *, channel_prefix: bytes = b"ps:job:"
+    ) -> None:
+        """initializes a new job waiter; must be __aenter__'d before use
+
+        Args:
+            conn (redis.asyncio.Redis): the redis connection to use
+            channel_prefix (bytes): the prefix of the channels to listen to; the
+                remainder of the channel name is the identifier passed to `register`
+        """
+        self.conn: redis.asyncio.Redis = conn
+        """the redis connection the pubsub connection is created from"""
+
+        self.channel_prefix: bytes = channel_prefix
+        """the prefix of the channels we are pattern subscribed to"""
+
+        self._pubsub: Optional[redis.asyncio.client.PubSub] = None
+        """the pubsub connection, if we have been aenter'd"""
+
+        self._reader: Optional[asyncio.Task] = None
+        """the task dispatching messages to futures, if we have been aenter'd"""
+
+        self._waiting: Dict[bytes, asyncio.Future] = dict()
+        """the futures for the jobs we are waiting on, keyed by the channel suffix"""
+
+    async def __aenter__(self) -> "JobWaiter":
+        pubsub = self.conn.pubsub()
+        try:
+            await pubsub.psubscribe(self.channel_prefix + b"*")
+
+            # wait for the confirmation so that anything published after we
+            # return is guaranteed to be seen
+            started_at = time.time()
+            while True:
+                message = await pubsub.get_message(timeout=1)
+                if message is not None and message["type"] == "psubscribe":
+                    break
+                if time.time() - started_at > 10:
+                    raise TimeoutError("timed out waiting for psubscribe confirmation")
+        except BaseException:
+            await pubsub.aclose()
+            raise
+
+        self._pubsub = pubsub
+        self._reader = asyncio.create_task(self._read_forever())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        reader = self._reader
+        pubsub = self._pubsub
+        self._reader = None
+        self._pubsub = None
+
+        if reader is not None:
+            reader.cancel()
+            try:
+                await reader
+            except BaseException:
+                pass
+
+        waiting = self._waiting
+        self._waiting = dict()
+        for fut in waiting.values():
+            fut.cancel()
+
+        if pubsub is not None:
+            await pubsub.aclose()
+
+    async def _read_forever(self) -> None:
+        prefix_length = len(self.channel_prefix)
+        try:
+            async for message in self._pubsub.listen():
+                if message["type"] != "pmessage":
+                    continue
+
+                channel: bytes = message["channel"]
+                fut = self._waiting.get(channel[prefix_length:])
+                if fut is not None and not fut.done():
+                    fut.set_result(message["data"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            waiting = self._waiting
+            self._waiting = dict()
+            for fut in waiting.values():
+                if not fut.done():
+                    fut.set_exception(e)
+            raise
+
+    def register(self, job_uid: Union[str, bytes]) -> asyncio.Future:
+        """Starts listening for the job with the given uid to finish. This must
+        be called before the job is enqueued, otherwise the completion may be
+        missed.
+
+        Args:
+            job_uid (str, bytes): the uid of the job, i.e., the suffix of the channel
+
+        Returns:
+            asyncio.Future: resolves to the published message once the job finishes.
+                Generally, prefer `wait` to awaiting this directly, as `wait` also
+                handles timeouts and cleanup.
+        """
+        if self._reader is None or self._reader.done():
+            raise ValueError("JobWaiter is not running")
+
+        key = job_uid if isinstance(job_uid, bytes) else job_uid.encode("utf-8")
+        if key in self._waiting:
+            raise ValueError(f"already waiting for {job_uid=}")
+
+        fut = asyncio.get_running_loop().create_future()
+        self._waiting[key] = fut
+        return fut
+
+    async def wait(self, job_uid: Union[str, bytes], *, timeout: float) -> bytes:
+        """Waits for the previously registered job with the given uid to finish.
+
+        Args:
+            job_uid (str, bytes): the uid of the job, as passed to `register`
+            timeout (float): the maximum time in seconds to wait
+
+        Returns:
+            bytes: the message the job published when it finished
+
+        Raises:
+            KeyError: if the job was not registered, or was already waited on
+            asyncio.TimeoutError: if the job did not finish in time
+        """
+        key = job_uid if isinstance(job_uid, bytes) else job_uid.encode("utf-8")
+        fut = self._waiting.get(key)
+        if fut is None:
+            raise KeyError(f"not waiting for {job_uid=}")
+
+        try:
+            return await asyncio.wait_for(fut, timeout=timeout)
+        except asyncio.TimeoutError:
+            raise asyncio.TimeoutError(f"timed out waiting for {job_uid=} to finish")
+        finally:
+            if self._waiting.get(key) is fut:
+                del self._waiting[key]
+
+    def cancel(self, job_uid: Union[str, bytes]) -> bool:
+        """Stops waiting for the job with the given uid. Anything awaiting the
+        job will receive a CancelledError.
+
+        Returns:
+            bool: True if we were waiting for the job, False otherwise
+        """
+        key = job_uid if isinstance(job_uid, bytes) else job_uid.encode("utf-8")
+        fut = self._waiting.pop(key, None)
+        if fut is None:
+            return False
+        fut.cancel()
+        return True
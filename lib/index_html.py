@@ -0,0 +1,68 @@
+"""Renders the standard index.html with its metadata replaced"""
+import io
+import os
+from typing import Any, BinaryIO, Dict, List
+import html5lib
+
+
+class IndexHtmlTemplate:
+    """The parsed tokens of an index.html, which can be rendered any number of
+    times with different metadata without parsing it again
+    """
+
+    def __init__(self, f: BinaryIO) -> None:
+        tb = html5lib.treebuilders.getTreeBuilder("dom")
+        parser = html5lib.HTMLParser(tb, strict=False, namespaceHTMLElements=False)
+        dom = parser.parse(f)
+
+        self.tokens: List[Dict[str, Any]] = list(html5lib.getTreeWalker("dom")(dom))
+        """the tokens of the document; must not be mutated"""
+
+    def render(self, meta: Dict[str, str], title: str) -> bytes:
+        """Serializes the document with the content of the given meta tags (by
+        property or name) and the title replaced
+        """
+        tokens = iter(self.tokens)
+        result_tokens = []
+
+        while True:
+            try:
+                token = next(tokens)
+            except StopIteration:
+                break
+            if token["type"] == "EmptyTag" and token["name"] == "meta":
+                name = token["data"].get((None, "property"))
+                if name is None:
+                    name = token["data"].get((None, "name"))
+                if name is not None and name in meta:
+                    token = {
+                        **token,
+                        "data": {**token["data"], (None, "content"): meta[name]},
+                    }
+                result_tokens.append(token)
+            elif token["type"] == "StartTag" and token["name"] == "title":
+                next(tokens)
+                result_tokens.append(token)
+                result_tokens.append({"type": "Characters", "data": title})
+                result_tokens.append(next(tokens))
+            else:
+                result_tokens.append(token)
+
+        serializer = html5lib.serializer.HTMLSerializer(
+            omit_optional_tags=False, quote_attr_values="always"
+        )
+
+        result = io.BytesIO()
+        for block in serializer.serialize(result_tokens, encoding="utf-8"):
+            result.write(block)
+        result.write(bytes(os.linesep, encoding="utf-8"))
+        return result.getvalue()
+
+
+def render_index_html(f: BinaryIO, meta: Dict[str, str], title: str) -> bytes:
+    """Parses the index.html in the given file and returns it serialized with
+    the content of the given meta tags (by property or name) and the title
+    replaced. This is CPU-bound pure python and can take a while; prefer
+    IndexHtmlTemplate when rendering the same file repeatedly.
+    """
+    return IndexHtmlTemplate(f).render(meta, title)
@@ -0,0 +1,181 @@
+"""Detects when the event loop is blocked, e.g., by synchronous file io or
+parsing. A heartbeat task on the loop measures how late it's woken up, and a
+watchdog thread captures the stack of whatever is holding the loop once the
+heartbeat is overdue by more than the threshold. When the loop recovers the
+offender is reported via `handle_warning`, rate limited per distinct stack.
+"""
+
+import asyncio
+import hashlib
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import List, Optional, Set, Tuple
+from loguru import logger
+from error_middleware import handle_warning
+import metrics
+
+
+SAMPLE_INTERVAL_SECONDS = 0.5
+"""How long the heartbeat task sleeps between measurements of the loop lag"""
+
+BLOCKED_THRESHOLD_SECONDS = 0.25
+"""How overdue the heartbeat must be before we consider the loop blocked"""
+
+MAX_REPORTED_FRAMES = 20
+"""The maximum number of frames included when reporting a blocking call"""
+
+
+def _trim_to_task(stack: traceback.StackSummary) -> List[traceback.FrameSummary]:
+    """Removes the frames for the event loop itself, leaving only those within
+    the task or callback that's running
+    """
+    start = 0
+    events_file = os.path.join("asyncio", "events.py")
+    for idx, frame in enumerate(stack):
+        if frame.filename.endswith(events_file):
+            start = idx + 1
+    return list(stack)[start:][-MAX_REPORTED_FRAMES:]
+
+
+def _fingerprint(frames: List[traceback.FrameSummary]) -> str:
+    """Fingerprints the given frames by function rather than line, so that
+    the same stall is recognized regardless of exactly where it was captured
+    """
+    joined = "\n".join(f"{frame.filename}:{frame.name}" for frame in frames)
+    return hashlib.sha1(joined.encode("utf-8")).hexdigest()[:12]
+
+
+class LoopMonitor:
+    """Monitors the event loop it's started on. Use `start` and `stop`."""
+
+    def __init__(self) -> None:
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        """the loop being monitored, once started"""
+
+        self._loop_thread_id: Optional[int] = None
+        """the id of the thread running the loop"""
+
+        self._heartbeat: Optional[asyncio.Task] = None
+        """the task measuring lag, once started"""
+
+        self._watchdog: Optional[threading.Thread] = None
+        """the thread capturing stacks, once started"""
+
+        self._stopping = threading.Event()
+        """set to stop the watchdog thread"""
+
+        self._beat: int = 0
+        """incremented each time the heartbeat goes to sleep"""
+
+        self._beat_due_at: float = 0
+        """time.monotonic() when the heartbeat should next wake up"""
+
+        self._captured: Optional[Tuple[int, List[traceback.FrameSummary]]] = None
+        """the beat and stack captured by the watchdog while the loop was blocked"""
+
+        self._reports: Set[asyncio.Task] = set()
+        """the reports currently being sent"""
+
+    def start(self) -> None:
+        """Starts monitoring the running event loop"""
+        if self._heartbeat is not None:
+            return
+
+        self.loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stopping.clear()
+        self._beat_due_at = time.monotonic() + SAMPLE_INTERVAL_SECONDS
+        self._heartbeat = asyncio.create_task(self._heartbeat_forever())
+        self._watchdog = threading.Thread(
+            target=self._watch_forever, name="loop_monitor", daemon=True
+        )
+        self._watchdog.start()
+
+    async def stop(self) -> None:
+        """Stops monitoring"""
+        if self._heartbeat is None:
+            return
+
+        self._stopping.set()
+        self._heartbeat.cancel()
+        try:
+            await self._heartbeat
+        except asyncio.CancelledError:
+            pass
+        self._heartbeat = None
+        self._watchdog = None
+
+    async def _heartbeat_forever(self) -> None:
+        while True:
+            self._beat += 1
+            beat = self._beat
+            self._beat_due_at = time.monotonic() + SAMPLE_INTERVAL_SECONDS
+            await asyncio.sleep(SAMPLE_INTERVAL_SECONDS)
+            lag = max(time.monotonic() - self._beat_due_at, 0)
+            metrics.EVENT_LOOP_LAG_SECONDS.labels().observe(lag)
+
+            captured = self._captured
+            if captured is None or captured[0] != beat:
+                continue
+
+            self._captured = None
+            metrics.EVENT_LOOP_BLOCKED.labels().inc()
+            report = asyncio.create_task(self._report(lag, captured[1]))
+            self._reports.add(report)
+            report.add_done_callback(self._reports.discard)
+
+    def _watch_forever(self) -> None:
+        while not self._stopping.wait(BLOCKED_THRESHOLD_SECONDS / 2):
+            beat = self._beat
+            overdue = time.monotonic() - self._beat_due_at
+            if overdue < BLOCKED_THRESHOLD_SECONDS:
+                continue
+
+            captured = self._captured
+            if captured is not None and captured[0] == beat:
+                continue
+
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+
+            self._captured = (beat, _trim_to_task(traceback.extract_stack(frame)))
+            del frame
+
+    async def _report(self, lag: float, frames: List[traceback.FrameSummary]) -> None:
+        try:
+            fingerprint = _fingerprint(frames)
+            formatted = "".join(traceback.format_list(frames))
+            await handle_warning(
+                f"{__name__}:blocked:{fingerprint}",
+                f"Event loop blocked for at least {lag:.3f}s; captured while blocked:"
+                f"\n\n```\n{formatted}```",
+            )
+        except Exception:
+            logger.exception("Failed to report blocked event loop")
+
+
+_monitor: Optional[LoopMonitor] = None
+"""the monitor for this process, if started"""
+
+
+def start() -> None:
+    """Starts monitoring the running event loop, if not already started"""
+    global _monitor
+    if _monitor is not None:
+        return
+    _monitor = LoopMonitor()
+    _monitor.start()
+
+
+async def stop() -> None:
+    """Stops monitoring the event loop, if it's being monitored"""
+    global _monitor
+    if _monitor is None:
+        return
+    monitor = _monitor
+    _monitor = None
+    await monitor.stop()
@@ -8,19 +8,30 @@ necessary to run this server. However, the rerouting rules are often still helpf
 """
 
 import os
-from itgs import Itgs
 import updater
 from fastapi import FastAPI, Request, Response
 from typing import cast
 from starlette.middleware.cors import CORSMiddleware
-from error_middleware import handle_request_error
+from error_middleware import handle_request_error, CLUSTER_WARNING_RATELIMITER
 import routes.journey_public_links
 import routes.favorites
 import routes.authorize
 import routes.user_touch_links
 import routes.update_password
+import routes.readiness
 import asyncio
+import slack
 import requests
+import tracing
+import metrics
+import loop_monitor
+import renderer
+import static_previews
+import prerendered_journey_public_links
+import readiness
+import build_cache
+import cache_warmup
+import slow_query_analyzer
 
 app = FastAPI(
     title="oseh frontend",
@@ -44,11 +55,15 @@ if os.environ.get("ENVIRONMENT") == "dev":
     serve_static = os.path.exists("build")
     print("serve_static:", serve_static)
 
+app.add_middleware(tracing.TracingMiddleware)
+app.add_middleware(readiness.InFlightMiddleware)
+
 app.include_router(routes.journey_public_links.router)
 app.include_router(routes.favorites.router)
 app.include_router(routes.authorize.router)
 app.include_router(routes.user_touch_links.router)
 app.include_router(routes.update_password.router)
+app.include_router(routes.readiness.router)
 app.router.redirect_slashes = False
 
 
@@ -187,9 +202,39 @@ background_tasks = set()
 
 @app.on_event("startup")
 async def register_background_tasks():
-    async with Itgs() as itgs:
-        cache = await itgs.local_cache()
-        while cache.evict(tag="no-persist") > 0:
-            pass
-
+    await slack.start_dispatcher()
+    await metrics.start_server()
+    loop_monitor.start()
+
+    readiness.require("static_previews")
+    readiness.require(cache_warmup.READINESS_STEP)
+    if not routes.journey_public_links.use_fetch_for_index_html:
+        readiness.require(prerendered_journey_public_links.READINESS_STEP)
+    readiness.start_checking()
+
+    await static_previews.ensure_built()
+    readiness.mark_done("static_previews")
+
+    background_tasks.add(asyncio.create_task(build_cache.collect_previous_builds()))
+    background_tasks.add(asyncio.create_task(cache_warmup.warm()))
+    background_tasks.add(asyncio.create_task(cache_warmup.persist_forever()))
     background_tasks.add(asyncio.create_task(updater.listen_forever()))
+    background_tasks.add(asyncio.create_task(slow_query_analyzer.report_forever()))
+    if not routes.journey_public_links.use_fetch_for_index_html:
+        background_tasks.add(
+            asyncio.create_task(
+                prerendered_journey_public_links.refresh_forever(
+                    routes.journey_public_links.base_index_html
+                )
+            )
+        )
+
+
+@app.on_event("shutdown")
+async def flush_slack_dispatcher():
+    await cache_warmup.persist()
+    await loop_monitor.stop()
+    renderer.shutdown()
+    await metrics.stop_server()
+    await CLUSTER_WARNING_RATELIMITER.close()
+    await slack.stop_dispatcher()
@@ -1,59 +1,358 @@
-import os
-
-
-FONTS = [
-    ("OpenSans", "Open Sans"),
-    ("OpenSans_Condensed", "Open Sans Condensed"),
-    ("OpenSans_SemiCondensed", "Open Sans SemiCondensed"),
-    ("RobotoMono", "Roboto Mono"),
-]
-
-WEIGHTS = {
-    "Thin": 100,
-    "ExtraLight": 200,
-    "Light": 300,
-    "Regular": 400,
-    "Medium": 500,
-    "SemiBold": 600,
-    "ExtraBold": 800,  # needs to be before bold
-    "Bold": 700,
-}
-DEFAULT_WEIGHT = 400
-
-STYLES = {"Italic": "italic"}
-DEFAULT_STYLE = "normal"
-
-
-def main():
-    with open(os.path.join("public", "fonts.css"), "w") as f:
-        for diskname, name in FONTS:
-            for file in os.listdir(os.path.join("public", "fonts", diskname)):
-                if file.startswith(f"{diskname}-") and file.endswith(".ttf"):
-                    suffix = file[len(diskname) + 1 : -4]
-
-                    weight = DEFAULT_WEIGHT
-                    for identifier, value in WEIGHTS.items():
-                        if identifier in suffix:
-                            weight = value
-                            break
-
-                    style = DEFAULT_STYLE
-                    for identifier, value in STYLES.items():
-                        if identifier in suffix:
-                            style = value
-                            break
-
-                    print("@font-face {", file=f)
-                    print(f"  font-family: '{name}';", file=f)
-                    print(f"  font-style: {style};", file=f)
-                    print(f"  font-weight: {weight};", file=f)
-                    print(f"  font-display: swap;", file=f)
-                    print(
-                        f"  src: url('/fonts/{diskname}/{file}') format('truetype');",
-                        file=f,
-                    )
-                    print("}", file=f)
-
-
-if __name__ == "__main__":
-    main()
+"""Generates the web fonts and public/fonts.css from the ttf files in
+public/fonts.
+
+Each face is split by unicode-range into a subset with the Latin basics plus
+every other character which appears in the frontend source, which is what
+nearly every page needs, and a subset with the rest of the font, which the
+browser only downloads if a page actually contains one of those characters.
+Both are emitted as WOFF2 named after the hash of their inputs, so they can be
+cached forever, and the most used faces are preloaded from index.html.
+
+Subsetting is slow, so the outputs for each face are recorded in
+.fonts_cache.json by the hash of its inputs and reused when it hasn't changed.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Set, Tuple, TypedDict
+from fontTools import subset
+from fontTools.ttLib import TTFont
+
+
+FONTS = [
+    ("OpenSans", "Open Sans"),
+    ("OpenSans_Condensed", "Open Sans Condensed"),
+    ("OpenSans_SemiCondensed", "Open Sans SemiCondensed"),
+    ("RobotoMono", "Roboto Mono"),
+]
+
+WEIGHTS = {
+    "Thin": 100,
+    "ExtraLight": 200,
+    "Light": 300,
+    "Regular": 400,
+    "Medium": 500,
+    "SemiBold": 600,
+    "ExtraBold": 800,  # needs to be before bold
+    "Bold": 700,
+}
+DEFAULT_WEIGHT = 400
+
+STYLES = {"Italic": "italic"}
+DEFAULT_STYLE = "normal"
+
+LATIN_RANGES = [
+    (0x0020, 0x007E),
+    (0x00A0, 0x00FF),
+    (0x0131, 0x0131),
+    (0x0152, 0x0153),
+    (0x02BB, 0x02BC),
+    (0x02C6, 0x02C6),
+    (0x02DA, 0x02DA),
+    (0x02DC, 0x02DC),
+    (0x2000, 0x206F),
+    (0x2074, 0x2074),
+    (0x20AC, 0x20AC),
+    (0x2122, 0x2122),
+    (0x2191, 0x2191),
+    (0x2193, 0x2193),
+    (0x2212, 0x2212),
+    (0x2215, 0x2215),
+    (0xFEFF, 0xFEFF),
+    (0xFFFD, 0xFFFD),
+]
+"""The codepoints always included in the primary subset, since text from the
+server, e.g., names, isn't in the source
+"""
+
+SOURCE_FOLDERS = ["src"]
+"""The folders scanned for characters to include in the primary subset"""
+
+SOURCE_FILES = [os.path.join("public", "index.html")]
+"""Additional files scanned for characters to include in the primary subset"""
+
+SOURCE_EXTENSIONS = frozenset((".ts", ".tsx", ".js", ".jsx", ".css", ".html", ".json"))
+"""The extensions of the files scanned for characters"""
+
+PRELOAD = [("OpenSans", "Regular"), ("OpenSans", "SemiBold")]
+"""The faces, as (folder, suffix), whose primary subset is preloaded from
+index.html since nearly every page uses them
+"""
+
+INDEX_HTML_PATH = os.path.join("public", "index.html")
+"""The html file the preload hints are written into"""
+
+PRELOAD_START_MARKER = "<!-- make_fonts: preload -->"
+PRELOAD_END_MARKER = "<!-- /make_fonts: preload -->"
+
+CACHE_PATH = ".fonts_cache.json"
+"""Where the outputs for each face are recorded by the hash of its inputs. Kept
+outside of public/ so it isn't deployed
+"""
+
+PIPELINE_VERSION = 1
+"""Included in the input hashes; bump when subsetting changes so every face is
+regenerated
+"""
+
+
+class Subset(TypedDict):
+    name: str
+    """the name of the subset, e.g., latin"""
+    file: str
+    """the WOFF2 file, relative to the folder of the face"""
+    unicode_range: str
+    """the css unicode-range of the codepoints in the subset"""
+
+
+class CacheEntry(TypedDict):
+    hash: str
+    """the hash of the inputs the subsets were generated from"""
+    subsets: List[Subset]
+    """the generated subsets"""
+
+
+def scan_source_codepoints() -> Set[int]:
+    """Finds every printable character used in the frontend source"""
+    paths: List[str] = list(SOURCE_FILES)
+    for folder in SOURCE_FOLDERS:
+        for dirpath, _, names in os.walk(folder):
+            for name in names:
+                if os.path.splitext(name)[1] in SOURCE_EXTENSIONS:
+                    paths.append(os.path.join(dirpath, name))
+
+    result: Set[int] = set()
+    for path in paths:
+        with open(path, encoding="utf-8", errors="ignore") as f:
+            result.update(ord(c) for c in f.read() if ord(c) >= 0x20)
+    return result
+
+
+def latin_codepoints() -> Set[int]:
+    return set(cp for start, end in LATIN_RANGES for cp in range(start, end + 1))
+
+
+def format_unicode_range(codepoints: Iterable[int]) -> str:
+    """Formats the given codepoints as a css unicode-range, merging runs"""
+    ranges: List[Tuple[int, int]] = []
+    for cp in sorted(codepoints):
+        if ranges and ranges[-1][1] == cp - 1:
+            ranges[-1] = (ranges[-1][0], cp)
+        else:
+            ranges.append((cp, cp))
+
+    return ", ".join(
+        f"U+{start:04X}" if start == end else f"U+{start:04X}-{end:04X}"
+        for start, end in ranges
+    )
+
+
+def hash_inputs(ttf_path: str, primary: Set[int]) -> str:
+    hasher = hashlib.sha256()
+    hasher.update(f"v{PIPELINE_VERSION}:".encode("utf-8"))
+    with open(ttf_path, "rb") as f:
+        while chunk := f.read(65536):
+            hasher.update(chunk)
+    hasher.update(",".join(str(cp) for cp in sorted(primary)).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def make_subsets(ttf_path: str, primary: Set[int], inputs_hash: str) -> List[Subset]:
+    """Writes the WOFF2 subsets of the given ttf next to it, with the given
+    codepoints in the primary subset and the rest of the font in the other.
+    Runs in a worker process
+    """
+    with TTFont(ttf_path, lazy=True) as font:
+        available = set(cp for cp in font.getBestCmap().keys() if cp >= 0x20)
+
+    folder = os.path.dirname(ttf_path)
+    stem = os.path.splitext(os.path.basename(ttf_path))[0]
+    result: List[Subset] = []
+    for name, codepoints in (
+        ("latin", available & primary),
+        ("extended", available - primary),
+    ):
+        if not codepoints:
+            continue
+
+        options = subset.Options()
+        options.flavor = "woff2"
+        options.layout_features = ["*"]
+        options.notdef_outline = True
+        font = subset.load_font(ttf_path, options)
+        subsetter = subset.Subsetter(options)
+        subsetter.populate(unicodes=codepoints)
+        subsetter.subset(font)
+
+        filename = f"{stem}.{name}.{inputs_hash[:12]}.woff2"
+        subset.save_font(font, os.path.join(folder, filename), options)
+        result.append(
+            {
+                "name": name,
+                "file": filename,
+                "unicode_range": format_unicode_range(codepoints),
+            }
+        )
+    return result
+
+
+def parse_suffix(suffix: str) -> Tuple[int, str]:
+    """Determines the weight and style of the face with the given file suffix"""
+    weight = DEFAULT_WEIGHT
+    for identifier, value in WEIGHTS.items():
+        if identifier in suffix:
+            weight = value
+            break
+
+    style = DEFAULT_STYLE
+    for identifier, value in STYLES.items():
+        if identifier in suffix:
+            style = value
+            break
+
+    return weight, style
+
+
+def _load_cache() -> Dict[str, CacheEntry]:
+    try:
+        with open(CACHE_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return dict()
+
+
+def _remove_stale_woff2(folder: str, keep: Set[str]) -> None:
+    for file in os.listdir(folder):
+        if file.endswith(".woff2") and file not in keep:
+            os.remove(os.path.join(folder, file))
+
+
+def write_preload_hints(hrefs: List[str]) -> None:
+    """Replaces the preload hints between the markers in index.html"""
+    with open(INDEX_HTML_PATH) as f:
+        html = f.read()
+
+    start = html.index(PRELOAD_START_MARKER) + len(PRELOAD_START_MARKER)
+    end = html.index(PRELOAD_END_MARKER)
+    links = "".join(
+        f'\n    <link rel="preload" href="%REACT_APP_PUBLIC_URL%{href}" as="font" type="font/woff2" crossorigin />'
+        for href in hrefs
+    )
+    html = html[:start] + links + "\n    " + html[end:]
+
+    with open(INDEX_HTML_PATH, "w") as f:
+        f.write(html)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="regenerate every face, even if its inputs haven't changed",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="how many processes to subset with; defaults to the number of cpus",
+    )
+    args = parser.parse_args()
+
+    started_at = time.perf_counter()
+    primary = latin_codepoints() | scan_source_codepoints()
+    old_cache = dict() if args.force else _load_cache()
+    new_cache: Dict[str, CacheEntry] = dict()
+
+    # (font index, ttf path relative to public, suffix, inputs hash)
+    faces: List[Tuple[int, str, str, str]] = []
+    for font_idx, (diskname, _) in enumerate(FONTS):
+        for file in sorted(os.listdir(os.path.join("public", "fonts", diskname))):
+            if file.startswith(f"{diskname}-") and file.endswith(".ttf"):
+                suffix = file[len(diskname) + 1 : -4]
+                path = f"fonts/{diskname}/{file}"
+                faces.append(
+                    (
+                        font_idx,
+                        path,
+                        suffix,
+                        hash_inputs(os.path.join("public", path), primary),
+                    )
+                )
+
+    jobs = [
+        (path, inputs_hash)
+        for _, path, _, inputs_hash in faces
+        if old_cache.get(path, {}).get("hash") != inputs_hash
+        or not all(
+            os.path.exists(os.path.join("public", os.path.dirname(path), s["file"]))
+            for s in old_cache[path]["subsets"]
+        )
+    ]
+    print("subsetting", len(jobs), "of", len(faces), "faces")
+
+    for _, path, _, inputs_hash in faces:
+        if path in old_cache and old_cache[path]["hash"] == inputs_hash:
+            new_cache[path] = old_cache[path]
+
+    if jobs:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = [
+                (
+                    path,
+                    inputs_hash,
+                    executor.submit(
+                        make_subsets, os.path.join("public", path), primary, inputs_hash
+                    ),
+                )
+                for path, inputs_hash in jobs
+            ]
+            for path, inputs_hash, future in futures:
+                new_cache[path] = {"hash": inputs_hash, "subsets": future.result()}
+                print("subset", path)
+
+    for diskname, _ in FONTS:
+        prefix = f"fonts/{diskname}/"
+        _remove_stale_woff2(
+            os.path.join("public", "fonts", diskname),
+            set(
+                s["file"]
+                for path, entry in new_cache.items()
+                if path.startswith(prefix)
+                for s in entry["subsets"]
+            ),
+        )
+
+    with open(CACHE_PATH, "w") as f:
+        json.dump(new_cache, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+    preload: List[str] = []
+    with open(os.path.join("public", "fonts.css"), "w") as f:
+        for font_idx, path, suffix, _ in faces:
+            diskname, name = FONTS[font_idx]
+            weight, style = parse_suffix(suffix)
+            for s in new_cache[path]["subsets"]:
+                href = f"/fonts/{diskname}/{s['file']}"
+                if s["name"] == "latin" and (diskname, suffix) in PRELOAD:
+                    preload.append(href)
+
+                print("@font-face {", file=f)
+                print(f"  font-family: '{name}';", file=f)
+                print(f"  font-style: {style};", file=f)
+                print(f"  font-weight: {weight};", file=f)
+                print(f"  font-display: swap;", file=f)
+                print(f"  src: url('{href}') format('woff2');", file=f)
+                print(f"  unicode-range: {s['unicode_range']};", file=f)
+                print("}", file=f)
+
+    write_preload_hints(preload)
+    print(f"all done in {time.perf_counter() - started_at:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
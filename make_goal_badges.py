@@ -1,10 +1,15 @@
+import argparse
+import hashlib
 import io
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 import math
-from typing import List, Literal
+from typing import Dict, List, Literal, Tuple
 import cairosvg
 import os
-from PIL import Image
+from PIL import Image, ImageChops
 
 
 @dataclass
@@ -285,38 +290,123 @@ def make_svg(filled: int, goal: int, *, target: Literal["cairo", "standard"]) ->
     )
 
 
+OUTPUT_FOLDER = "public/goalBadge"
+"""The folder the rasterized badges are written to"""
+
+HASHES_PATH = ".goal_badge_hashes.json"
+"""Where the hash of the source of each badge is stored, by output filename, so
+that badges whose source hasn't changed can be skipped. Kept outside of public/
+so it isn't deployed
+"""
+
+HEIGHT = 192
+"""The height in pixels of the rasterized badges"""
+
+RASTERIZE_VERSION = 1
+"""Included in the source hashes; bump when rasterize_svg changes how the same
+svg is converted, so every badge is regenerated
+"""
+
+
+def source_hash(svg: Svg, height: int) -> str:
+    """Hashes everything which determines the rasterized output of the given
+    svg at the given height
+    """
+    hasher = hashlib.sha256()
+    hasher.update(f"v{RASTERIZE_VERSION}:{height}:".encode("utf-8"))
+    hasher.update(svg.src.encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def _mask(band: Image.Image, *, positive: bool) -> Image.Image:
+    """A mask which is 255 where the band is positive (or zero, if not
+    positive) and 0 elsewhere
+    """
+    if positive:
+        return band.point(lambda v: 255 if v > 0 else 0)
+    return band.point(lambda v: 255 if v == 0 else 0)
+
+
 def rasterize_svg(svg: Svg, height: int, outpath: str):
     width = int((height / svg.view_box.h) * svg.view_box.w)
-    cairosvg.svg2png(
+    png = cairosvg.svg2png(
         bytestring=svg.src.encode("utf-8"),
-        write_to=outpath,
         output_width=width,
         output_height=height,
         background_color="transparent",
     )
 
-    # Convert the red and green to the correct colors
-    img = Image.open(outpath)
-    data = img.getdata()
-
-    new_data = []
-    for pixel in data:
-        if pixel[0] > 0 and pixel[1] == 0 and pixel[2] == 0:
-            # red to #EAEAEB, keep alpha
-            new_data.append((234, 234, 235, pixel[3]))
-        elif pixel[0] == 0 and pixel[1] > 0 and pixel[2] == 0:
-            # green to #FFFFFF, multiply alpha by 0.35
-            new_data.append((255, 255, 255, int(pixel[3] * 0.35)))
-        else:
-            # keep all other pixels
-            new_data.append(pixel)
-
-    img.putdata(new_data)
+    # Convert the red and green to the correct colors, using masks over the
+    # whole image rather than visiting each pixel
+    img = Image.open(io.BytesIO(png)).convert("RGBA")
+    r, g, b, a = img.split()
+    r_pos, g_pos = _mask(r, positive=True), _mask(g, positive=True)
+    r_zero, g_zero = _mask(r, positive=False), _mask(g, positive=False)
+    b_zero = _mask(b, positive=False)
+
+    # red to #EAEAEB, keep alpha
+    red = ImageChops.multiply(ImageChops.multiply(r_pos, g_zero), b_zero)
+    img.paste(
+        Image.merge(
+            "RGBA",
+            (
+                Image.new("L", img.size, 234),
+                Image.new("L", img.size, 234),
+                Image.new("L", img.size, 235),
+                a,
+            ),
+        ),
+        mask=red,
+    )
+
+    # green to #FFFFFF, multiply alpha by 0.35
+    green = ImageChops.multiply(ImageChops.multiply(r_zero, g_pos), b_zero)
+    white = Image.new("L", img.size, 255)
+    img.paste(
+        Image.merge("RGBA", (white, white, white, a.point(lambda v: int(v * 0.35)))),
+        mask=green,
+    )
+
     img.save(outpath)
 
 
+def _rasterize_badge(filled: int, goal: int, outpath: str) -> float:
+    """Rasterizes the badge for the given progress to the given path, returning
+    how long it took in seconds. Runs in a worker process
+    """
+    started_at = time.perf_counter()
+    rasterize_svg(make_svg(filled, goal, target="cairo"), HEIGHT, outpath)
+    return time.perf_counter() - started_at
+
+
+def _load_hashes() -> Dict[str, str]:
+    try:
+        with open(HASHES_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return dict()
+
+
 def main():
-    os.makedirs("public/goalBadge", exist_ok=True)
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="rasterize every badge, even if its source hasn't changed",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="how many processes to rasterize with; defaults to the number of cpus",
+    )
+    args = parser.parse_args()
+
+    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+    started_at = time.perf_counter()
+    old_hashes = dict() if args.force else _load_hashes()
+    new_hashes: Dict[str, str] = dict()
+    jobs: List[Tuple[int, int, str]] = []
 
     for goal in range(1, 8):
         for filled in range(0, goal + 1):
@@ -325,11 +415,32 @@ def main():
             # with open(f"public/goalBadge/{filled}of{goal}.svg", "w") as f:
             #     f.write(std_svg.src)
 
-            cairo_svg = make_svg(filled, goal, target="cairo")
-            print("rasterizing", filled, "of", goal)
-            rasterize_svg(cairo_svg, 192, f"public/goalBadge/{filled}of{goal}-192h.png")
-
-    print("all done")
+            filename = f"{filled}of{goal}-{HEIGHT}h.png"
+            outpath = os.path.join(OUTPUT_FOLDER, filename)
+            new_hashes[filename] = source_hash(
+                make_svg(filled, goal, target="cairo"), HEIGHT
+            )
+            if old_hashes.get(filename) == new_hashes[filename] and os.path.exists(
+                outpath
+            ):
+                continue
+            jobs.append((filled, goal, outpath))
+
+    print("rasterizing", len(jobs), "of", len(new_hashes), "badges")
+    if jobs:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = [
+                (filled, goal, executor.submit(_rasterize_badge, filled, goal, outpath))
+                for filled, goal, outpath in jobs
+            ]
+            for filled, goal, future in futures:
+                print(f"rasterized {filled} of {goal} in {future.result():.3f}s")
+
+    with open(HASHES_PATH, "w") as f:
+        json.dump(new_hashes, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+    print(f"all done in {time.perf_counter() - started_at:.3f}s")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,584 @@
+"""Operational metrics (request rates, cache hit ratios, integration latency,
+etc.) in the prometheus text exposition format. Business metrics continue to
+go through `lib.redis_stats_preparer`.
+
+Each process stores its values in its own memory-mapped file within
+`OSEH_METRICS_DIR` (default `tmp/metrics`), with every series preallocated as
+a fixed slot in that file the first time it's used. Updating a metric is just
+writing a float at a known offset. The exposition endpoint, served on
+`OSEH_METRICS_HOST:OSEH_METRICS_PORT` (default `127.0.0.1:9102`) by every worker
+with SO_REUSEPORT, reads every process' file and aggregates them, so any
+worker can answer a scrape for all of them.
+
+Usage:
+
+```py
+import metrics
+
+metrics.HTTP_REQUESTS.labels("get_journey_public_link", "200").inc()
+```
+"""
+
+import asyncio
+import json
+import mmap
+import os
+import struct
+import threading
+from typing import Dict, Iterator, List, Literal, Optional, Sequence, Tuple
+from loguru import logger
+
+
+METRICS_DIR = os.environ.get("OSEH_METRICS_DIR", "tmp/metrics")
+"""The directory containing one metrics file per process"""
+
+INITIAL_FILE_SIZE = 64 * 1024
+"""The initial size of each process' metrics file; it doubles as needed"""
+
+MAX_SERIES_PER_METRIC = 512
+"""The maximum number of label combinations for a single metric; observations
+for additional label combinations are dropped to bound memory
+"""
+
+DEFAULT_BUCKETS_SECONDS: Tuple[float, ...] = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+"""The default upper bounds for latency histograms; there is an implicit +Inf
+bucket for everything larger
+"""
+
+_HEADER = struct.Struct("<Q")
+"""the file header: the number of bytes used, including the header"""
+
+_KEY_LENGTH = struct.Struct("<I")
+"""the prefix of each entry: the length of the key in bytes"""
+
+_VALUE = struct.Struct("<d")
+"""the value of each entry, which is 8-byte aligned"""
+
+
+class _ValuesFile:
+    """A memory-mapped file of (key, float64) entries written by a single
+    process. Entries are only ever appended, and the used size in the header is
+    updated after the entry is fully written, so readers in other processes
+    always see complete entries.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        """where the file is stored"""
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.ftruncate(self._fd, INITIAL_FILE_SIZE)
+        self._capacity = INITIAL_FILE_SIZE
+        self._mmap = mmap.mmap(self._fd, self._capacity)
+        self._used = _HEADER.size
+        _HEADER.pack_into(self._mmap, 0, self._used)
+
+    def allocate(self, key: str) -> int:
+        """Appends a new entry with the given key and a value of 0, returning
+        the offset of its value
+        """
+        encoded = key.encode("utf-8")
+        value_offset = _align8(self._used + _KEY_LENGTH.size + len(encoded))
+        new_used = value_offset + _VALUE.size
+        if new_used > self._capacity:
+            new_capacity = self._capacity
+            while new_capacity < new_used:
+                new_capacity *= 2
+            os.ftruncate(self._fd, new_capacity)
+            self._mmap.close()
+            self._mmap = mmap.mmap(self._fd, new_capacity)
+            self._capacity = new_capacity
+
+        _KEY_LENGTH.pack_into(self._mmap, self._used, len(encoded))
+        start = self._used + _KEY_LENGTH.size
+        self._mmap[start : start + len(encoded)] = encoded
+        _VALUE.pack_into(self._mmap, value_offset, 0.0)
+        self._used = new_used
+        _HEADER.pack_into(self._mmap, 0, self._used)
+        return value_offset
+
+    def get(self, offset: int) -> float:
+        return _VALUE.unpack_from(self._mmap, offset)[0]
+
+    def set(self, offset: int, value: float) -> None:
+        _VALUE.pack_into(self._mmap, offset, value)
+
+    def close(self) -> None:
+        self._mmap.close()
+        os.close(self._fd)
+
+
+def _align8(n: int) -> int:
+    return (n + 7) & ~7
+
+
+def _read_values_file(path: str) -> Iterator[Tuple[str, float]]:
+    """Reads the (key, value) entries of the metrics file at the given path"""
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if len(data) < _HEADER.size:
+        return
+    used = min(_HEADER.unpack_from(data, 0)[0], len(data))
+    pos = _HEADER.size
+    while pos + _KEY_LENGTH.size <= used:
+        key_length = _KEY_LENGTH.unpack_from(data, pos)[0]
+        key_start = pos + _KEY_LENGTH.size
+        value_offset = _align8(key_start + key_length)
+        if value_offset + _VALUE.size > used:
+            return
+        key = data[key_start : key_start + key_length].decode("utf-8")
+        yield key, _VALUE.unpack_from(data, value_offset)[0]
+        pos = value_offset + _VALUE.size
+
+
+_lock = threading.Lock()
+"""protects _values and the slots of every metric"""
+
+_values: Optional[_ValuesFile] = None
+"""the metrics file for this process, once opened"""
+
+
+def _get_values() -> _ValuesFile:
+    global _values
+    if _values is None:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        _values = _ValuesFile(os.path.join(METRICS_DIR, f"{os.getpid()}.metrics"))
+    return _values
+
+
+def _reset_after_fork() -> None:
+    global _values, _lock
+    _values = None
+    _lock = threading.Lock()
+    for metric in REGISTRY.values():
+        metric._series = dict()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+MetricType = Literal["counter", "gauge", "histogram"]
+
+
+class _Metric:
+    type: MetricType
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str]):
+        if name in REGISTRY:
+            raise ValueError(f"metric {name} already registered")
+
+        self.name = name
+        """the name of the metric, e.g., `frontend_http_requests_total`"""
+
+        self.documentation = documentation
+        """the help text for the metric"""
+
+        self.labelnames: Tuple[str, ...] = tuple(labelnames)
+        """the names of the labels for this metric, in order"""
+
+        self._series: Dict[Tuple[str, ...], "_Series"] = dict()
+        """the series for this process by label values"""
+
+        REGISTRY[name] = self
+
+    def _subkeys(self) -> Sequence[str]:
+        return ("",)
+
+    def labels(self, *labelvalues: str) -> "_Series":
+        """Returns the series for the given label values, in the same order
+        as labelnames
+        """
+        series = self._series.get(labelvalues)
+        if series is not None:
+            return series
+
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(
+                f"{self.name} expects labels {self.labelnames}, got {labelvalues}"
+            )
+
+        with _lock:
+            series = self._series.get(labelvalues)
+            if series is not None:
+                return series
+
+            if len(self._series) >= MAX_SERIES_PER_METRIC:
+                return _DROPPED_SERIES
+
+            values = _get_values()
+            offsets = [
+                values.allocate(json.dumps([self.name, list(labelvalues), subkey]))
+                for subkey in self._subkeys()
+            ]
+            series = _Series(self, offsets)
+            self._series[labelvalues] = series
+            return series
+
+
+class _Series:
+    """The slots for a single label combination of a metric"""
+
+    def __init__(self, metric: Optional[_Metric], offsets: List[int]) -> None:
+        self.metric = metric
+        """the metric this series is for, or None if observations are dropped"""
+
+        self.offsets = offsets
+        """the offsets of the values for this series within the metrics file"""
+
+    def inc(self, amount: float = 1) -> None:
+        """Increments a counter or gauge by the given amount"""
+        if self.metric is None:
+            return
+        with _lock:
+            values = _get_values()
+            values.set(self.offsets[0], values.get(self.offsets[0]) + amount)
+
+    def dec(self, amount: float = 1) -> None:
+        """Decrements a gauge by the given amount"""
+        self.inc(-amount)
+
+    def set(self, value: float) -> None:
+        """Sets a gauge to the given value"""
+        if self.metric is None:
+            return
+        with _lock:
+            _get_values().set(self.offsets[0], value)
+
+    def observe(self, value: float) -> None:
+        """Adds an observation to a histogram"""
+        metric = self.metric
+        if metric is None:
+            return
+        assert isinstance(metric, Histogram)
+
+        bucket = len(metric.buckets)
+        for idx, upper_bound in enumerate(metric.buckets):
+            if value <= upper_bound:
+                bucket = idx
+                break
+
+        # layout: one slot per bucket including +Inf, then sum, then count
+        with _lock:
+            values = _get_values()
+            for offset, amount in (
+                (self.offsets[bucket], 1),
+                (self.offsets[-2], value),
+                (self.offsets[-1], 1),
+            ):
+                values.set(offset, values.get(offset) + amount)
+
+
+_DROPPED_SERIES = _Series(None, [])
+"""returned when a metric has too many series; ignores all updates"""
+
+
+class Counter(_Metric):
+    """A value which only goes up. Aggregated across processes by summing"""
+
+    type = "counter"
+
+
+class Gauge(_Metric):
+    """A value which can go up or down. Aggregated across live processes using
+    the given aggregation
+    """
+
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str],
+        *,
+        aggregation: Literal["sum", "max", "min"] = "sum",
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.aggregation = aggregation
+        """how values from different processes are combined"""
+
+
+class Histogram(_Metric):
+    """A distribution of observations in fixed buckets. Aggregated across
+    processes by summing
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str],
+        *,
+        buckets: Sequence[float] = DEFAULT_BUCKETS_SECONDS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        """the upper bounds of the buckets, excluding +Inf"""
+
+    def _subkeys(self) -> Sequence[str]:
+        return [f"bucket:{idx}" for idx in range(len(self.buckets) + 1)] + [
+            "sum",
+            "count",
+        ]
+
+
+REGISTRY: Dict[str, _Metric] = dict()
+"""All the metrics by name"""
+
+
+HTTP_REQUESTS = Counter(
+    "frontend_http_requests_total",
+    "HTTP requests handled, by route and status code",
+    ("route", "status"),
+)
+
+REQUEST_SPAN_SECONDS = Histogram(
+    "frontend_request_span_seconds",
+    "Time spent per request in each integration (e.g., rqlite, redis, diskcache), "
+    "by route; the span `total` is the entire request",
+    ("route", "span"),
+)
+
+CACHE_REQUESTS = Counter(
+    "frontend_cache_requests_total",
+    "Lookups in local caches, by cache and result (hit or miss)",
+    ("cache", "result"),
+)
+
+
+EVENT_LOOP_LAG_SECONDS = Histogram(
+    "frontend_event_loop_lag_seconds",
+    "How much later than scheduled the event loop woke a sleeping task",
+    (),
+)
+
+EVENT_LOOP_BLOCKED = Counter(
+    "frontend_event_loop_blocked_total",
+    "How many times the event loop was blocked for longer than the threshold",
+    (),
+)
+
+CACHE_WARMUP_SECONDS = Gauge(
+    "frontend_cache_warmup_seconds",
+    "How long the local cache warmup took when the server last started",
+    (),
+    aggregation="max",
+)
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _list_files() -> Iterator[Tuple[int, str]]:
+    try:
+        names = os.listdir(METRICS_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if not name.endswith(".metrics"):
+            continue
+        try:
+            pid = int(name[: -len(".metrics")])
+        except ValueError:
+            continue
+        yield pid, os.path.join(METRICS_DIR, name)
+
+
+def remove_stale_files() -> None:
+    """Removes the metrics files of processes which are no longer running.
+    Should be called on startup, so that values from previous deployments
+    don't accumulate forever
+    """
+    for pid, path in _list_files():
+        if pid != os.getpid() and not _is_alive(pid):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def collect() -> Dict[Tuple[str, Tuple[str, ...], str], float]:
+    """Reads and aggregates the values from every process' metrics file,
+    keyed by (metric name, label values, subkey)
+    """
+    result: Dict[Tuple[str, Tuple[str, ...], str], float] = dict()
+    for pid, path in _list_files():
+        alive: Optional[bool] = None
+        try:
+            entries = list(_read_values_file(path))
+        except FileNotFoundError:
+            continue
+
+        for key, value in entries:
+            name, labelvalues, subkey = json.loads(key)
+            metric = REGISTRY.get(name)
+            if metric is None:
+                continue
+
+            full_key = (name, tuple(labelvalues), subkey)
+            if not isinstance(metric, Gauge):
+                result[full_key] = result.get(full_key, 0) + value
+                continue
+
+            if alive is None:
+                alive = _is_alive(pid)
+            if not alive:
+                continue
+
+            existing = result.get(full_key)
+            if existing is None or metric.aggregation == "sum":
+                result[full_key] = (existing or 0) + value
+            elif metric.aggregation == "max":
+                result[full_key] = max(existing, value)
+            else:
+                result[full_key] = min(existing, value)
+    return result
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    parts = []
+    for name, value in zip(names, values):
+        escaped = value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{name}="{escaped}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def render() -> str:
+    """Renders the aggregated metrics of every process in the prometheus text
+    exposition format
+    """
+    values = collect()
+    label_values_by_metric: Dict[str, List[Tuple[str, ...]]] = dict()
+    for name, labelvalues, _ in values.keys():
+        seen = label_values_by_metric.setdefault(name, [])
+        if labelvalues not in seen:
+            seen.append(labelvalues)
+
+    lines: List[str] = []
+    for name, metric in REGISTRY.items():
+        lines.append(f"# HELP {name} {metric.documentation}")
+        lines.append(f"# TYPE {name} {metric.type}")
+        for labelvalues in sorted(label_values_by_metric.get(name, [])):
+            if not isinstance(metric, Histogram):
+                labels = _format_labels(metric.labelnames, labelvalues)
+                value = values.get((name, labelvalues, ""), 0)
+                lines.append(f"{name}{labels} {_format_value(value)}")
+                continue
+
+            cumulative = 0.0
+            for idx, upper_bound in enumerate(metric.buckets + (float("inf"),)):
+                cumulative += values.get((name, labelvalues, f"bucket:{idx}"), 0)
+                labels = _format_labels(
+                    metric.labelnames + ("le",),
+                    labelvalues + (_format_value(float(upper_bound)),),
+                )
+                lines.append(f"{name}_bucket{labels} {_format_value(cumulative)}")
+            labels = _format_labels(metric.labelnames, labelvalues)
+            for subkey in ("sum", "count"):
+                value = values.get((name, labelvalues, subkey), 0)
+                lines.append(f"{name}_{subkey}{labels} {_format_value(value)}")
+    lines.append("")
+    return "\n".join(lines)
+
+
+async def _handle_connection(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while True:
+            header = await asyncio.wait_for(reader.readline(), timeout=5)
+            if header in (b"\r\n", b"\n", b""):
+                break
+
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[0] == b"GET" and parts[1] == b"/metrics":
+            status = b"200 OK"
+            body = render().encode("utf-8")
+        else:
+            status = b"404 Not Found"
+            body = b""
+
+        writer.write(
+            b"HTTP/1.1 "
+            + status
+            + b"\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            + b"Content-Length: "
+            + str(len(body)).encode("ascii")
+            + b"\r\nConnection: close\r\n\r\n"
+            + body
+        )
+        await writer.drain()
+    except Exception:
+        logger.exception("Failed to serve metrics")
+    finally:
+        writer.close()
+
+
+_server: Optional[asyncio.AbstractServer] = None
+"""the exposition server for this process, if it's been started"""
+
+
+async def start_server() -> None:
+    """Starts serving the exposition endpoint at /metrics on the internal
+    port. Every worker listens on the same port with SO_REUSEPORT, and any of
+    them can answer for all of them
+    """
+    global _server
+    if _server is not None:
+        return
+
+    remove_stale_files()
+    host = os.environ.get("OSEH_METRICS_HOST", "127.0.0.1")
+    port = int(os.environ.get("OSEH_METRICS_PORT", "9102"))
+    try:
+        _server = await asyncio.start_server(
+            _handle_connection, host, port, reuse_port=True
+        )
+    except OSError:
+        logger.exception(f"Failed to start metrics server on {host}:{port}")
+
+
+async def stop_server() -> None:
+    """Stops serving the exposition endpoint, if it's being served"""
+    global _server
+    if _server is None:
+        return
+    server = _server
+    _server = None
+    server.close()
+    await server.wait_closed()
@@ -0,0 +1,331 @@
+"""The set of journey public links is finite and changes rarely, so rather than
+rendering `/jpl?code=...` on demand, a background job renders every link's page
+ahead of time into `tmp/journey_public_links/builds/<build id>/pages/`, where
+each file is named after the hash of its content. An index file in the same
+build folder maps each code to its page. The build id is derived from
+index.html, so a worker never loads an index rendered for another build, e.g.,
+the one from before a deploy, and a worker isn't ready until it has loaded the
+index for its build.
+
+Every worker runs the job, but only the one which acquires the lock file
+rebuilds the index; the others just reload it when it changes. Each rebuild is
+incremental: pages are only rendered again when the journey's metadata or the
+index.html changes. Codes which aren't in the index yet are served via the
+database as before.
+"""
+
+import asyncio
+import fcntl
+import hashlib
+import io
+import json
+import os
+import secrets
+import shutil
+import time
+from typing import Dict, List, Optional, Set, Tuple
+import anyio
+from fastapi.responses import FileResponse
+from loguru import logger
+from error_middleware import handle_warning
+from itgs import Itgs
+from lib.index_html import IndexHtmlTemplate
+import readiness
+
+
+PRERENDER_ROOT = os.path.join("tmp", "journey_public_links")
+"""The folder containing the lock file and a folder for each build with its
+index and pages
+"""
+
+PAGE_SIZE = 500
+"""How many links we fetch per query when rebuilding"""
+
+REFRESH_INTERVAL_SECONDS = 300
+"""How long we wait between rebuilds or checks for a new index"""
+
+STARTUP_RETRY_SECONDS = 5
+"""How long we wait between refreshes until we've loaded the index for our
+build, e.g., while another worker is rendering it
+"""
+
+READINESS_STEP = "prerendered_journey_public_links"
+"""The readiness startup step marked done once we've loaded the index for our
+build
+"""
+
+DEAD_BUILD_SECONDS = 2 * REFRESH_INTERVAL_SECONDS
+"""Builds whose index hasn't been rewritten in this long have no workers left,
+so their folders are removed
+"""
+
+_index: Dict[str, str] = dict()
+"""The path to the page for each code, as of the last time we loaded the index"""
+
+_index_build_id: Optional[str] = None
+"""The build the index we last loaded is for"""
+
+_index_mtime_ns: Optional[int] = None
+"""The modification time of the index file when we last loaded it"""
+
+
+def get_build_id(index_html_path: str) -> str:
+    """Returns the id of the build with the index.html at the given path"""
+    with open(index_html_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+
+def _builds_dir() -> str:
+    return os.path.join(PRERENDER_ROOT, "builds")
+
+
+def _index_path(build_id: str) -> str:
+    return os.path.join(_builds_dir(), build_id, "index.json")
+
+
+def _previous_index_path(build_id: str) -> str:
+    return os.path.join(_builds_dir(), build_id, "previous.json")
+
+
+def _pages_dir(build_id: str) -> str:
+    return os.path.join(_builds_dir(), build_id, "pages")
+
+
+def get_prerendered_response(code: str) -> Optional[FileResponse]:
+    """Returns the prerendered page for the given journey public link code, if
+    there is one, otherwise None
+    """
+    path = _index.get(code)
+    if path is None:
+        return None
+    try:
+        # our copy of the index may be older than the pages on disk
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return FileResponse(path, media_type="text/html", stat_result=stat_result)
+
+
+async def refresh_forever(index_html_path: str) -> None:
+    """Keeps the prerendered pages for the index.html at the given path and our
+    copy of the index up to date. Loading the index for this build is a
+    readiness startup step; until then, we retry frequently
+    """
+    build_id = await anyio.to_thread.run_sync(get_build_id, index_html_path)
+    while True:
+        try:
+            await refresh_once(index_html_path, build_id)
+        except Exception as e:
+            await handle_warning(
+                f"{__name__}:refresh", "Failed to refresh prerendered pages", e
+            )
+
+        if _index_build_id != build_id:
+            await asyncio.sleep(STARTUP_RETRY_SECONDS)
+            continue
+
+        readiness.mark_done(READINESS_STEP)
+        await asyncio.sleep(REFRESH_INTERVAL_SECONDS)
+
+
+async def refresh_once(index_html_path: str, build_id: str) -> None:
+    """Rebuilds the index for the given build if it's due and no other worker
+    is currently doing so, then reloads our copy of the index if it has changed
+    """
+    os.makedirs(_pages_dir(build_id), exist_ok=True)
+    with open(os.path.join(PRERENDER_ROOT, "rebuild.lock"), "a") as lock_file:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.debug("Another worker is rebuilding prerendered pages")
+        else:
+            try:
+                if _is_rebuild_due(build_id):
+                    await _rebuild(index_html_path, build_id)
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    await anyio.to_thread.run_sync(_reload_index_if_changed, build_id)
+
+
+def _is_rebuild_due(build_id: str) -> bool:
+    """True unless another worker rebuilt the index for the given build within
+    half the refresh interval, so that workers which just loaded it don't
+    immediately rebuild it again
+    """
+    try:
+        mtime = os.stat(_index_path(build_id)).st_mtime
+    except FileNotFoundError:
+        return True
+    return time.time() - mtime >= REFRESH_INTERVAL_SECONDS / 2
+
+
+def _read_index(path: str) -> Dict[str, Dict[str, str]]:
+    try:
+        with open(path, "rb") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return dict()
+
+
+def _reload_index_if_changed(build_id: str) -> None:
+    global _index, _index_build_id, _index_mtime_ns
+
+    try:
+        mtime_ns = os.stat(_index_path(build_id)).st_mtime_ns
+    except FileNotFoundError:
+        return
+    if build_id == _index_build_id and mtime_ns == _index_mtime_ns:
+        return
+
+    pages_dir = _pages_dir(build_id)
+    _index = dict(
+        (code, os.path.join(pages_dir, entry["file"]))
+        for code, entry in _read_index(_index_path(build_id)).items()
+    )
+    _index_build_id = build_id
+    _index_mtime_ns = mtime_ns
+    logger.info(f"Loaded {len(_index)} prerendered journey public links")
+
+
+async def _rebuild(index_html_path: str, build_id: str) -> None:
+    with open(index_html_path, "rb") as f:
+        index_html = f.read()
+    build_hash = hashlib.sha256(index_html).hexdigest()
+
+    old_index = await anyio.to_thread.run_sync(_read_index, _index_path(build_id))
+    previous_index = await anyio.to_thread.run_sync(
+        _read_index, _previous_index_path(build_id)
+    )
+    new_index: Dict[str, Dict[str, str]] = dict()
+    num_rendered = 0
+
+    async with Itgs() as itgs:
+        conn = await itgs.conn()
+        cursor = conn.cursor("none")
+
+        last_id = 0
+        while True:
+            response = await cursor.execute(
+                """
+                SELECT
+                    journey_public_links.id,
+                    journey_public_links.code,
+                    journeys.title,
+                    journeys.description
+                FROM journey_public_links, journeys
+                WHERE
+                    journey_public_links.id > ?
+                    AND journeys.id = journey_public_links.journey_id
+                ORDER BY journey_public_links.id ASC
+                LIMIT ?
+                """,
+                (last_id, PAGE_SIZE),
+            )
+            rows = response.results or []
+
+            to_render: List[Tuple[str, str, str, str]] = []
+            for _, code, title, description in rows:
+                meta_hash = hashlib.sha256(
+                    json.dumps([build_hash, title, description]).encode("utf-8")
+                ).hexdigest()
+                existing = old_index.get(code)
+                if existing is not None and existing["meta_hash"] == meta_hash:
+                    new_index[code] = existing
+                else:
+                    to_render.append((code, meta_hash, title, description))
+
+            if to_render:
+                new_index.update(
+                    await anyio.to_thread.run_sync(
+                        _render_pages, index_html, build_id, to_render
+                    )
+                )
+                num_rendered += len(to_render)
+
+            if len(rows) < PAGE_SIZE:
+                break
+            last_id = rows[-1][0]
+
+    await anyio.to_thread.run_sync(_write_index, _index_path(build_id), new_index)
+    await anyio.to_thread.run_sync(
+        _write_index, _previous_index_path(build_id), old_index
+    )
+    # other workers reload the index up to a refresh interval after it's
+    # written, so pages are kept until two rebuilds no longer reference them
+    await anyio.to_thread.run_sync(
+        _remove_unreferenced_pages, build_id, previous_index, old_index, new_index
+    )
+    await anyio.to_thread.run_sync(_remove_dead_builds, build_id)
+    logger.info(
+        f"Prerendered journey public links: {len(new_index)} total, {num_rendered} rendered"
+    )
+
+
+def _render_pages(
+    index_html: bytes, build_id: str, to_render: List[Tuple[str, str, str, str]]
+) -> Dict[str, Dict[str, str]]:
+    """Renders the pages for the given (code, meta_hash, title, description)
+    tuples, returning the index entries for them
+    """
+    template = IndexHtmlTemplate(io.BytesIO(index_html))
+    result: Dict[str, Dict[str, str]] = dict()
+    for code, meta_hash, title, description in to_render:
+        rendered = template.render(
+            {
+                "og:title": title,
+                "description": description,
+                "og:description": description,
+            },
+            title,
+        )
+        file_name = f"{hashlib.sha256(rendered).hexdigest()}.html"
+        path = os.path.join(_pages_dir(build_id), file_name)
+        if not os.path.exists(path):
+            tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(rendered)
+            os.replace(tmp_path, path)
+        result[code] = {"file": file_name, "meta_hash": meta_hash}
+    return result
+
+
+def _write_index(path: str, index: Dict[str, Dict[str, str]]) -> None:
+    tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, path)
+
+
+def _remove_unreferenced_pages(
+    build_id: str, *indices: Dict[str, Dict[str, str]]
+) -> None:
+    referenced: Set[str] = set()
+    for index in indices:
+        referenced.update(entry["file"] for entry in index.values())
+
+    pages_dir = _pages_dir(build_id)
+    for file_name in os.listdir(pages_dir):
+        if file_name not in referenced and not file_name.endswith(".tmp"):
+            try:
+                os.remove(os.path.join(pages_dir, file_name))
+            except FileNotFoundError:
+                pass
+
+
+def _remove_dead_builds(build_id: str) -> None:
+    """Removes the folders of other builds once they haven't been rebuilt in a
+    while
+    """
+    now = time.time()
+
+    def _is_dead(index_path: str) -> bool:
+        try:
+            return now - os.stat(index_path).st_mtime >= DEAD_BUILD_SECONDS
+        except FileNotFoundError:
+            return True
+
+    for other_id in os.listdir(_builds_dir()):
+        if other_id != build_id and _is_dead(_index_path(other_id)):
+            shutil.rmtree(os.path.join(_builds_dir(), other_id), ignore_errors=True)
+            logger.info(f"Removed prerendered journey public links for {other_id}")
@@ -0,0 +1,132 @@
+"""Tracks whether this process should receive traffic. The process starts out
+not ready until every startup step which was registered via `require` has
+called `mark_done`, e.g., building the static previews, and stops being ready
+once `drain` is called before restarting.
+
+The load balancer health check should target `/readyz`, which returns 200 only
+while the process is ready.
+"""
+
+import asyncio
+import time
+from typing import Optional, Set
+from loguru import logger
+
+
+_pending: Set[str] = set()
+"""the startup steps which have been required but aren't done yet"""
+
+_checking: bool = False
+"""true once every startup step has been required"""
+
+_ready_at: Optional[float] = None
+"""time.time() when every required step finished, once they have"""
+
+_ready_event: Optional[asyncio.Event] = None
+"""set once every required step is done; created lazily on the event loop"""
+
+_draining: bool = False
+"""true once we've started draining, after which we're never ready again"""
+
+_in_flight: int = 0
+"""the number of http requests currently being handled"""
+
+
+def _get_ready_event() -> asyncio.Event:
+    global _ready_event
+    if _ready_event is None:
+        _ready_event = asyncio.Event()
+        if _ready_at is not None:
+            _ready_event.set()
+    return _ready_event
+
+
+def require(name: str) -> None:
+    """Registers a startup step which must call `mark_done` with the same name
+    before the process is ready. Must be called before `start_checking`.
+    """
+    if _checking:
+        raise ValueError(f"cannot require {name=} after start_checking")
+    _pending.add(name)
+
+
+def mark_done(name: str) -> None:
+    """Marks the startup step with the given name as done"""
+    _pending.discard(name)
+    logger.debug(f"readiness: {name} done; waiting for {sorted(_pending)}")
+    _check_ready()
+
+
+def start_checking() -> None:
+    """Called once every startup step has been required, so that the process
+    can become ready once they're done, even if there were none
+    """
+    global _checking
+    _checking = True
+    _check_ready()
+
+
+def _check_ready() -> None:
+    global _ready_at
+    if not _checking or _pending or _ready_at is not None:
+        return
+    _ready_at = time.time()
+    logger.info("readiness: ready for traffic")
+    if _ready_event is not None:
+        _ready_event.set()
+
+
+def is_ready() -> bool:
+    """True if the process should receive traffic"""
+    return _ready_at is not None and not _pending and not _draining
+
+
+async def wait_ready(timeout: float) -> bool:
+    """Waits until every required startup step is done, returning False if
+    that didn't happen within the given number of seconds
+    """
+    try:
+        await asyncio.wait_for(_get_ready_event().wait(), timeout=timeout)
+        return True
+    except asyncio.TimeoutError:
+        logger.warning(f"readiness: still waiting for {sorted(_pending)}")
+        return False
+
+
+async def drain(*, grace_seconds: float, timeout: float) -> None:
+    """Stops reporting ready, waits the given grace period so the load balancer
+    notices and stops sending new requests, then waits for requests which are
+    already in flight to finish, up to the given timeout in total
+    """
+    global _draining
+    _draining = True
+    started_at = time.time()
+    logger.info(f"readiness: draining ({_in_flight} requests in flight)")
+    await asyncio.sleep(grace_seconds)
+    while _in_flight > 0 and time.time() - started_at < timeout:
+        await asyncio.sleep(0.1)
+    logger.info(
+        f"readiness: drained in {time.time() - started_at:.1f}s "
+        f"({_in_flight} requests still in flight)"
+    )
+
+
+class InFlightMiddleware:
+    """Pure ASGI middleware counting the http requests being handled, so that
+    `drain` can wait for them
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        global _in_flight
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        _in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _in_flight -= 1
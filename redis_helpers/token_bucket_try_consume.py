@@ -0,0 +1,132 @@
+from typing import Optional, List, Union
+import hashlib
+import time
+import redis.asyncio.client
+import dataclasses
+
+TOKEN_BUCKET_TRY_CONSUME_LUA_SCRIPT = """
+local key = KEYS[1]
+local capacity = tonumber(ARGV[1])
+local refill_per_second = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+
+local state = redis.call("HMGET", key, "tokens", "updated_at")
+local tokens = tonumber(state[1])
+local updated_at = tonumber(state[2])
+if tokens == nil or updated_at == nil then
+    tokens = capacity
+    updated_at = now
+end
+
+if now > updated_at then
+    tokens = math.min(capacity, tokens + (now - updated_at) * refill_per_second)
+end
+
+local consumed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    consumed = 1
+end
+
+redis.call("HSET", key, "tokens", tostring(tokens), "updated_at", tostring(now))
+redis.call("EXPIRE", key, math.ceil(capacity / refill_per_second) + 60)
+return {consumed, tostring(tokens)}
+"""
+
+TOKEN_BUCKET_TRY_CONSUME_LUA_SCRIPT_HASH = hashlib.sha1(
+    TOKEN_BUCKET_TRY_CONSUME_LUA_SCRIPT.encode("utf-8")
+).hexdigest()
+
+
+_last_token_bucket_try_consume_ensured_at: Optional[float] = None
+
+
+async def ensure_token_bucket_try_consume_script_exists(
+    redis: redis.asyncio.client.Redis, *, force: bool = False
+) -> None:
+    """Ensures the token_bucket_try_consume lua script is loaded into redis."""
+    global _last_token_bucket_try_consume_ensured_at
+
+    now = time.time()
+    if (
+        not force
+        and _last_token_bucket_try_consume_ensured_at is not None
+        and (now - _last_token_bucket_try_consume_ensured_at < 5)
+    ):
+        return
+
+    loaded: List[bool] = await redis.script_exists(
+        TOKEN_BUCKET_TRY_CONSUME_LUA_SCRIPT_HASH
+    )
+    if not loaded[0]:
+        correct_hash = await redis.script_load(TOKEN_BUCKET_TRY_CONSUME_LUA_SCRIPT)
+        assert (
+            correct_hash == TOKEN_BUCKET_TRY_CONSUME_LUA_SCRIPT_HASH
+        ), f"{correct_hash=} != {TOKEN_BUCKET_TRY_CONSUME_LUA_SCRIPT_HASH=}"
+
+    if (
+        _last_token_bucket_try_consume_ensured_at is None
+        or _last_token_bucket_try_consume_ensured_at < now
+    ):
+        _last_token_bucket_try_consume_ensured_at = now
+
+
+@dataclasses.dataclass
+class TokenBucketTryConsumeResult:
+    consumed: bool
+    """True if a token was available and was consumed, False otherwise"""
+    tokens: float
+    """The number of tokens remaining in the bucket after this call"""
+
+
+async def token_bucket_try_consume(
+    redis: redis.asyncio.client.Redis,
+    key: Union[str, bytes],
+    *,
+    capacity: int,
+    refill_per_second: float,
+    now: Optional[float] = None,
+) -> Optional[TokenBucketTryConsumeResult]:
+    """Refills the token bucket stored in the hash at the given key based on the
+    time since it was last updated, then consumes one token if one is available.
+    A bucket which doesn't exist yet starts full, and the key expires once the
+    bucket would have refilled.
+
+    Args:
+        redis (redis.asyncio.client.Redis): The redis client
+        key (str, bytes): The key of the hash containing the bucket
+        capacity (int): The maximum number of tokens in the bucket
+        refill_per_second (float): How many tokens are added per second
+        now (float, None): The current time in seconds since the epoch; defaults
+            to the current time
+
+    Returns:
+        TokenBucketTryConsumeResult, None: The result. None if executed
+            within a transaction, since the result is not known until the
+            transaction is executed.
+
+    Raises:
+        NoScriptError: If the script is not loaded into redis
+    """
+    if now is None:
+        now = time.time()
+
+    res = await redis.evalsha(
+        TOKEN_BUCKET_TRY_CONSUME_LUA_SCRIPT_HASH,
+        1,
+        key,
+        capacity,
+        refill_per_second,
+        now,
+    )
+    if res is redis:
+        return None
+    return token_bucket_try_consume_parse_result(res)
+
+
+def token_bucket_try_consume_parse_result(res) -> TokenBucketTryConsumeResult:
+    """Parses the result of the token_bucket_try_consume lua script."""
+    assert isinstance(res, list)
+    assert len(res) == 2
+    assert res[0] in (0, 1)
+    return TokenBucketTryConsumeResult(consumed=res[0] == 1, tokens=float(res[1]))
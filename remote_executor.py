@@ -1,89 +1,252 @@
+import gzip
 import io
 import os
+import posixpath
+import select
+import socket
+import tarfile
 import time
-from typing import Dict, Optional, Tuple
+from typing import BinaryIO, Callable, Dict, List, Literal, Optional, Set, Tuple
 import paramiko
 
 
-def exec_simple(
-    client: paramiko.SSHClient, command: str, timeout=15, cmd_timeout=3600
-) -> Tuple[str, str]:
-    """Executes the given command on the paramiko client, waiting for
-    the command to finish before returning the stdout and stderr
-    """
-    chan = client.get_transport().open_session(timeout=timeout)
-    chan.settimeout(cmd_timeout)
-    chan.exec_command(command)
-    stdout = chan.makefile("r", 8192)
-    stderr = chan.makefile_stderr("r", 8192)
-
-    all_stdout = io.BytesIO()
-    all_stderr = io.BytesIO()
-
-    while not chan.exit_status_ready():
-        time.sleep(0.1)
-
-        from_stdout = stdout.read(4096)
-        from_stderr = stderr.read(4096)
+READ_SIZE = 64 * 1024
+"""The maximum number of bytes read from a stream at once"""
 
-        if from_stdout is not None:
-            all_stdout.write(from_stdout)
+DEFAULT_MAX_BUFFERED_BYTES = 8 * 1024 * 1024
+"""The default number of bytes of each stream's output kept in memory"""
 
-        if from_stderr is not None:
-            all_stderr.write(from_stderr)
+StreamName = Literal["stdout", "stderr"]
 
-    while from_stdout := stdout.read(4096):
-        all_stdout.write(from_stdout)
 
-    while from_stderr := stderr.read(4096):
-        all_stderr.write(from_stderr)
+class OutputBuffer:
+    """Collects the output of one stream of a remote command. Only the most
+    recent max_bytes are kept in memory; if spill_path is set, everything is
+    also written to that file as it arrives
+    """
 
-    return all_stdout.getvalue().decode(
-        "utf-8", errors="replace"
-    ), all_stderr.getvalue().decode("utf-8", errors="replace")
+    def __init__(self, max_bytes: int, spill_path: Optional[str] = None) -> None:
+        self.max_bytes = max_bytes
+        """the maximum number of bytes kept in memory"""
+
+        self.total_bytes = 0
+        """the total number of bytes written"""
+
+        self._buffer = bytearray()
+        """the most recent output; deleting from the front is amortized O(1)"""
+
+        self._spill: Optional[BinaryIO] = (
+            open(spill_path, "wb") if spill_path is not None else None
+        )
+        """the file everything is written to, if spilling"""
+
+    def write(self, data: bytes) -> None:
+        self.total_bytes += len(data)
+        if self._spill is not None:
+            self._spill.write(data)
+        self._buffer += data
+        overflow = len(self._buffer) - self.max_bytes
+        if overflow > 0:
+            del self._buffer[:overflow]
+
+    def getvalue(self) -> bytes:
+        """Returns the output kept in memory, prefixed with a note about how
+        much was dropped, if any
+        """
+        dropped = self.total_bytes - len(self._buffer)
+        if dropped <= 0:
+            return bytes(self._buffer)
+        return f"[{dropped} earlier bytes dropped]\n".encode("utf-8") + self._buffer
+
+    def close(self) -> None:
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+
+class _LineSplitter:
+    """Calls the callback for each complete line written"""
+
+    def __init__(self, stream: StreamName, on_line: Callable[[StreamName, str], None]):
+        self.stream = stream
+        self.on_line = on_line
+        self._partial = bytearray()
+
+    def write(self, data: bytes) -> None:
+        self._partial += data
+        start = 0
+        while (end := self._partial.find(b"\n", start)) != -1:
+            self._emit(self._partial[start:end])
+            start = end + 1
+        del self._partial[:start]
+
+    def flush(self) -> None:
+        if self._partial:
+            self._emit(self._partial)
+            self._partial = bytearray()
+
+    def _emit(self, line: bytes) -> None:
+        self.on_line(self.stream, line.rstrip(b"\r").decode("utf-8", errors="replace"))
 
 
-def write_echo_commands_for_folder(
-    infile_path: str,
-    echo_path: str,
-    writer: io.StringIO,
-) -> None:
-    """Writes the appropriate commands to echo the local folder at infile_path
-    to the remote folder at echo_path. Only supports text files.
+def exec_simple(
+    client: paramiko.SSHClient,
+    command: str,
+    timeout=15,
+    cmd_timeout=3600,
+    *,
+    on_line: Optional[Callable[[StreamName, str], None]] = None,
+    max_buffered_bytes: int = DEFAULT_MAX_BUFFERED_BYTES,
+    stdout_path: Optional[str] = None,
+    stderr_path: Optional[str] = None,
+) -> Tuple[str, str]:
+    """Executes the given command on the paramiko client, waiting for
+    the command to finish before returning the stdout and stderr. Both
+    streams are drained as data arrives, until both are at EOF and the exit
+    status has been received.
+
+    Args:
+        client (paramiko.SSHClient): the connected client
+        command (str): the command to execute
+        timeout (float): the timeout for opening the session
+        cmd_timeout (float): the maximum time the command may run for before
+            socket.timeout is raised
+        on_line (callable, None): if specified, called with the stream name and
+            the line (without the newline) for each line of output as it
+            arrives. Called on the thread running this function.
+        max_buffered_bytes (int): the maximum number of bytes of each stream
+            that are kept in memory; only the most recent output is returned
+        stdout_path (str, None): if specified, all of stdout is written here
+        stderr_path (str, None): if specified, all of stderr is written here
+
+    Returns:
+        (str, str): the most recent stdout and stderr, up to max_buffered_bytes
+            each
+    """
+    chan = client.get_transport().open_session(timeout=timeout)
+    chan.exec_command(command)
+    deadline = time.monotonic() + cmd_timeout
+
+    buffers: Dict[StreamName, OutputBuffer] = {
+        "stdout": OutputBuffer(max_buffered_bytes, stdout_path),
+        "stderr": OutputBuffer(max_buffered_bytes, stderr_path),
+    }
+    splitters: Dict[StreamName, _LineSplitter] = (
+        {
+            "stdout": _LineSplitter("stdout", on_line),
+            "stderr": _LineSplitter("stderr", on_line),
+        }
+        if on_line is not None
+        else dict()
+    )
+
+    def _handle(stream: StreamName, data: bytes) -> None:
+        buffers[stream].write(data)
+        splitter = splitters.get(stream)
+        if splitter is not None:
+            splitter.write(data)
+
+    def _at_eof() -> bool:
+        return chan.eof_received or chan.closed
+
+    try:
+        # the exit status can arrive while output is still buffered, so we
+        # keep reading until each stream is at EOF, i.e., recv returns b""
+        open_streams: Set[StreamName] = {"stdout", "stderr"}
+        while open_streams or not chan.exit_status_ready():
+            made_progress = False
+            if "stdout" in open_streams and (chan.recv_ready() or _at_eof()):
+                data = chan.recv(READ_SIZE)
+                if data:
+                    _handle("stdout", data)
+                else:
+                    open_streams.discard("stdout")
+                made_progress = True
+            if "stderr" in open_streams and (chan.recv_stderr_ready() or _at_eof()):
+                data = chan.recv_stderr(READ_SIZE)
+                if data:
+                    _handle("stderr", data)
+                else:
+                    open_streams.discard("stderr")
+                made_progress = True
+            if made_progress:
+                continue
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout(f"command did not finish within {cmd_timeout}s")
+
+            # the exit status doesn't wake select, hence the short timeout
+            select.select([chan], [], [], min(remaining, 0.5))
+
+        for splitter in splitters.values():
+            splitter.flush()
+
+        return buffers["stdout"].getvalue().decode("utf-8", errors="replace"), buffers[
+            "stderr"
+        ].getvalue().decode("utf-8", errors="replace")
+    finally:
+        for buffer in buffers.values():
+            buffer.close()
+        chan.close()
+
+
+def build_tar_gz_bundle(entries: List[Tuple[str, str]]) -> bytes:
+    """Packs the given (local path, path within the archive) entries into a
+    gzip-compressed tar archive, recursing into folders. Every file is marked
+    executable. The archive is reproducible: entries are sorted and
+    timestamps and owners are cleared, so the same inputs always produce the
+    same bytes and hence the same checksum. Binary files are supported.
     """
-    writer.write(f"mkdir -p {echo_path.replace(os.path.sep, '/')}\n")
-    for root, _, files in os.walk(infile_path):
-        relative_root = os.path.relpath(root, infile_path)
-        if relative_root != ".":
-            writer.write(
-                f"mkdir -p {os.path.join(echo_path, relative_root).replace(os.path.sep, '/')}\n"
-            )
-
-        for file in files:
-            infile_filepath = os.path.join(root, file)
-            echo_file_path = os.path.join(
-                echo_path, relative_root if relative_root != "." else "", file
-            )
-            write_echo_commands_for_file(infile_filepath, echo_file_path, writer)
-
-
-def write_echo_commands_for_file(
-    infile_path: str,
-    echo_file_path: str,
-    writer: io.StringIO,
-    mark_executable: bool = True,
+    files: List[Tuple[str, str]] = []
+    for local_path, archive_path in entries:
+        archive_path = archive_path.replace(os.path.sep, "/")
+        if not os.path.isdir(local_path):
+            files.append((local_path, archive_path))
+            continue
+
+        for root, _, names in os.walk(local_path):
+            relative_root = os.path.relpath(root, local_path)
+            for name in names:
+                files.append(
+                    (
+                        os.path.join(root, name),
+                        posixpath.normpath(
+                            posixpath.join(
+                                archive_path,
+                                relative_root.replace(os.path.sep, "/"),
+                                name,
+                            )
+                        ),
+                    )
+                )
+
+    raw = io.BytesIO()
+    with tarfile.open(fileobj=raw, mode="w", format=tarfile.PAX_FORMAT) as tar:
+        for local_path, archive_path in sorted(files, key=lambda f: f[1]):
+            info = tarfile.TarInfo(archive_path)
+            info.size = os.path.getsize(local_path)
+            info.mode = 0o755
+            info.mtime = 0
+            with open(local_path, "rb") as f:
+                tar.addfile(info, f)
+
+    return gzip.compress(raw.getvalue(), compresslevel=9, mtime=0)
+
+
+def write_extract_commands(
+    bundle_path: str, sha256: str, dest_path: str, writer: io.StringIO
 ) -> None:
-    """Writes the appropriate commands to echo the local file at infile_path
-    to the remote file at echo_file_path. Only supports text files.
+    """Writes the appropriate commands to verify that the remote file at
+    bundle_path has the given sha256 hex digest, exiting if it doesn't, and
+    then extract it into the remote folder at dest_path
     """
-    echo_file_path = echo_file_path.replace(os.path.sep, "/")
-    with open(infile_path, "r") as infile:
-        for line in infile:
-            cleaned_line = line.rstrip().replace("\\", "\\\\").replace("'", "\\'")
-            writer.write(f"echo $'{cleaned_line}' >> {echo_file_path}\n")
-
-    if mark_executable:
-        writer.write(f"chmod +x {echo_file_path}\n")
-    writer.write(f'echo "finished writing {echo_file_path}"\n')
-    # print file size:
-    writer.write(f"du -sh {echo_file_path}\n")
+    writer.write(
+        f'if ! echo "{sha256}  {bundle_path}" | sha256sum --check --status; then\n'
+    )
+    writer.write(f'  echo "checksum mismatch for {bundle_path}" >&2\n')
+    writer.write("  exit 1\n")
+    writer.write("fi\n")
+    writer.write(f"mkdir -p {dest_path}\n")
+    writer.write(f"tar -xzf {bundle_path} -C {dest_path} --no-same-owner --touch\n")
+    writer.write(f'echo "finished extracting {bundle_path}"\n')
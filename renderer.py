@@ -0,0 +1,157 @@
+"""Runs CPU-bound page renders off the event loop. The backend is selected via
+`OSEH_RENDER_BACKEND`:
+
+- `inline` (default): render directly on the event loop
+- `process`: render in a pool of `OSEH_RENDER_WORKERS` processes, which avoids
+  stalling unrelated requests even for pure-python renders like html5lib
+- `thread`: render in a pool of threads, which only helps when the render
+  releases the GIL
+
+For the pooled backends at most `MAX_PENDING_RENDERS` renders may be queued or
+running at once, and each render must finish within `RENDER_TIMEOUT_SECONDS`.
+Otherwise `RenderUnavailable` is raised, and callers should fall back to the
+unmodified index.html rather than waiting.
+"""
+
+import asyncio
+import concurrent.futures
+import concurrent.futures.process
+import multiprocessing
+import os
+from typing import Callable, Literal, Optional, Set, TypeVar
+from loguru import logger
+import tracing
+
+
+RenderBackend = Literal["inline", "process", "thread"]
+
+RENDER_BACKEND: RenderBackend = os.environ.get("OSEH_RENDER_BACKEND", "inline")  # type: ignore
+"""How renders are run; see the module documentation"""
+
+RENDER_WORKERS = int(os.environ.get("OSEH_RENDER_WORKERS", "2"))
+"""The number of processes or threads renders are run in for pooled backends"""
+
+MAX_PENDING_RENDERS = 16
+"""The maximum number of renders queued or running at once for pooled backends"""
+
+RENDER_TIMEOUT_SECONDS = 5
+"""How long we wait for a render for pooled backends before giving up"""
+
+
+class RenderUnavailable(Exception):
+    """Raised when a render is rejected because too many are pending, or it
+    took too long, or the pool failed
+    """
+
+
+T = TypeVar("T")
+
+_executor: Optional[concurrent.futures.Executor] = None
+"""the pool renders are run in, once created"""
+
+_pending: int = 0
+"""the number of renders submitted to the pool which haven't finished"""
+
+_futures: Set[concurrent.futures.Future] = set()
+"""the renders submitted to the pool which haven't finished, so they can be
+cancelled when the pool is shut down
+"""
+
+
+def _get_executor() -> concurrent.futures.Executor:
+    global _executor
+    if _executor is None:
+        if RENDER_BACKEND == "process":
+            # forkserver avoids forking the threads of the web worker
+            _executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=RENDER_WORKERS,
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+        else:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=RENDER_WORKERS, thread_name_prefix="renderer"
+            )
+    return _executor
+
+
+def _on_render_done(future: concurrent.futures.Future) -> None:
+    global _pending
+    _pending -= 1
+    _futures.discard(future)
+
+
+def _shutdown_executor(executor: concurrent.futures.Executor) -> None:
+    """Shuts down the given pool without waiting, cancelling renders which
+    haven't started. Equivalent to `shutdown(cancel_futures=True)`, which isn't
+    available on python 3.8
+    """
+    for future in list(_futures):
+        future.cancel()
+    executor.shutdown(wait=False)
+
+
+def _call_soon_threadsafe(loop: asyncio.AbstractEventLoop, fn, *args) -> None:
+    try:
+        loop.call_soon_threadsafe(fn, *args)
+    except RuntimeError:
+        # the loop was closed; there's nothing left to release
+        pass
+
+
+async def render(fn: Callable[..., T], *args) -> T:
+    """Calls the given function with the given arguments using the configured
+    backend. For pooled backends, the function and arguments must be picklable,
+    i.e., the function must be defined at the top level of a module.
+
+    Raises:
+        RenderUnavailable: if the render was rejected or timed out
+    """
+    global _executor, _pending
+
+    with tracing.span("render"):
+        if RENDER_BACKEND == "inline":
+            return fn(*args)
+
+        if _pending >= MAX_PENDING_RENDERS:
+            raise RenderUnavailable(f"{_pending} renders already pending")
+
+        loop = asyncio.get_running_loop()
+        try:
+            future = _get_executor().submit(fn, *args)
+        except concurrent.futures.process.BrokenProcessPool as e:
+            _executor = None
+            raise RenderUnavailable("render pool is broken") from e
+
+        _pending += 1
+        _futures.add(future)
+        # the pending count is released only once the pool is actually done,
+        # so renders which time out still count against the limit
+        future.add_done_callback(
+            lambda f: _call_soon_threadsafe(loop, _on_render_done, f)
+        )
+        try:
+            return await asyncio.wait_for(
+                asyncio.wrap_future(future), timeout=RENDER_TIMEOUT_SECONDS
+            )
+        except asyncio.TimeoutError as e:
+            raise RenderUnavailable(
+                f"render took longer than {RENDER_TIMEOUT_SECONDS}s"
+            ) from e
+        except concurrent.futures.process.BrokenProcessPool as e:
+            logger.exception("render pool broke; it will be recreated")
+            if _executor is not None:
+                _shutdown_executor(_executor)
+            _executor = None
+            raise RenderUnavailable("render pool is broken") from e
+
+
+def shutdown() -> None:
+    """Shuts down the render pool, if one was created, without waiting for
+    pending renders
+    """
+    global _executor
+    if _executor is None:
+        return
+    executor = _executor
+    _executor = None
+    _shutdown_executor(executor)
@@ -3,6 +3,7 @@ from typing import Optional
 from itgs import Itgs
 from fastapi import APIRouter, Response
 import csrf
+import build_cache
 
 router = APIRouter()
 
@@ -57,7 +58,7 @@ async def get_authorize_html(itgs: Itgs) -> bytes:
     """
     Returns the authorize.html page, after substitutions, with caching
     """
-    cache_key = "authorize:html"
+    cache_key = build_cache.key("authorize:html")
     cache = await itgs.local_cache()
 
     cached = cache.get(cache_key)
@@ -67,7 +68,7 @@ async def get_authorize_html(itgs: Itgs) -> bytes:
     html = create_authorize_html()
     if os.environ["ENVIRONMENT"] != "dev":
         # we want live reloads
-        cache.set(cache_key, html, tag="no-persist")
+        cache.set(cache_key, html, tag=build_cache.get_tag())
     return html
 
 
@@ -85,7 +86,7 @@ def create_authorize_html() -> bytes:
 
 
 async def get_authorize_js(itgs: Itgs) -> bytes:
-    cache_key = "authorize:js"
+    cache_key = build_cache.key("authorize:js")
     cache = await itgs.local_cache()
 
     cached = cache.get(cache_key)
@@ -95,7 +96,7 @@ async def get_authorize_js(itgs: Itgs) -> bytes:
     js = create_authorize_js()
     if os.environ["ENVIRONMENT"] != "dev":
         # we want live reloads
-        cache.set(cache_key, js, tag="no-persist")
+        cache.set(cache_key, js, tag=build_cache.get_tag())
     return js
 
 
@@ -1,30 +1,39 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Request
 from fastapi.responses import Response
 from itgs import Itgs
+import renderer
+import static_previews
 from routes.journey_public_links import (
     get_cached,
     set_cached,
     create_journey_public_link_response,
+    get_base_index_html,
 )
 
 router = APIRouter()
 
 
 @router.get("/favorites")
-async def get_favorites():
+async def get_favorites(request: Request):
+    static_response = static_previews.get_static_preview_response(
+        "favorites", request.headers.get("accept-encoding")
+    )
+    if static_response is not None:
+        return static_response
+
     cache_key = "favorites"
+    preview = static_previews.STATIC_PREVIEWS["favorites"]
     async with Itgs() as itgs:
         cached = await get_cached(itgs, cache_key)
         if cached is not None:
             return cached
 
-        raw_response = await create_journey_public_link_response(
-            meta={
-                "og:title": "Oseh: Favorites",
-                "og:description": "View your history and your favorite classes on Oseh",
-            },
-            title="Oseh: Favorites",
-        )
+        try:
+            raw_response = await create_journey_public_link_response(
+                meta=preview.meta, title=preview.title
+            )
+        except renderer.RenderUnavailable:
+            return await get_base_index_html()
         await set_cached(itgs, cache_key, raw_response)
         return Response(
             content=raw_response, status_code=200, headers={"Content-Type": "text/html"}
@@ -5,8 +5,13 @@ import requests
 from itgs import Itgs
 import aiofiles
 import io
-import html5lib
 import os
+import renderer
+from lib.index_html import render_index_html
+import metrics
+import prerendered_journey_public_links
+import build_cache
+import cache_warmup
 
 router = APIRouter()
 
@@ -24,11 +29,24 @@ async def get_journey_public_link(code: Optional[str] = None):
     linked to with the given journey public link code, if the code is provided
     and valid. Otherwise, returns the standard index page.
 
-    Caches for 5m on success, 15s on failure.
+    Served from the prerendered pages when available. Otherwise, caches for
+    5m on success, 15s on failure.
     """
     if code is None or len(code) == 0 or len(code) > 255:
         return await get_base_index_html()
 
+    cache_warmup.record_hit("jpl", code)
+    return await get_journey_public_link_response(code)
+
+
+async def get_journey_public_link_response(code: str) -> Response:
+    """Returns the response for the journey public link with the given code,
+    populating the cache, without recording the request for warmup
+    """
+    prerendered = prerendered_journey_public_links.get_prerendered_response(code)
+    if prerendered is not None:
+        return prerendered
+
     cache_key = f"journey_public_link:{code}"
     bad_code_cache_key = f"journey_public_link:bad_code:{code}"
     async with Itgs() as itgs:
@@ -60,19 +78,22 @@ async def get_journey_public_link(code: Optional[str] = None):
             (code,),
         )
         if not response.results:
-            cache.set(bad_code_cache_key, b"1", expire=15, tag="no-persist")
+            cache.set(bad_code_cache_key, b"1", expire=15, tag=build_cache.get_tag())
             return await get_base_index_html()
 
         journey_title: str = response.results[0][0]
         journey_description: str = response.results[0][1]
-        raw_response = await create_journey_public_link_response(
-            meta={
-                "og:title": journey_title,
-                "description": journey_description,
-                "og:description": journey_description,
-            },
-            title=journey_title,
-        )
+        try:
+            raw_response = await create_journey_public_link_response(
+                meta={
+                    "og:title": journey_title,
+                    "description": journey_description,
+                    "og:description": journey_description,
+                },
+                title=journey_title,
+            )
+        except renderer.RenderUnavailable:
+            return await get_base_index_html()
         await set_cached(itgs, cache_key, raw_response)
         return Response(
             content=raw_response, status_code=200, headers={"Content-Type": "text/html"}
@@ -82,44 +103,19 @@ async def get_journey_public_link(code: Optional[str] = None):
 async def create_journey_public_link_response(
     meta: Dict[str, str], title: str
 ) -> bytes:
-    tb = html5lib.treebuilders.getTreeBuilder("dom")
-    parser = html5lib.HTMLParser(tb, strict=False, namespaceHTMLElements=False)
+    """Renders index.html with the given meta tag contents and title using the
+    configured render backend
 
-    with open_base_index_html() as f:
-        dom = parser.parse(f)
+    Raises:
+        renderer.RenderUnavailable: if the render backend is overloaded, in which
+            case the caller should serve the base index.html instead
+    """
+    return await renderer.render(_render_journey_public_link, meta, title)
 
-    tokens = iter(html5lib.getTreeWalker("dom")(dom))
-    result_tokens = []
 
-    while True:
-        try:
-            token = next(tokens)
-        except StopIteration:
-            break
-        if token["type"] == "EmptyTag" and token["name"] == "meta":
-            name = token["data"].get((None, "property"))
-            if name is None:
-                name = token["data"].get((None, "name"))
-            if name is not None and name in meta:
-                token["data"][(None, "content")] = meta[name]
-            result_tokens.append(token)
-        elif token["type"] == "StartTag" and token["name"] == "title":
-            next(tokens)
-            result_tokens.append(token)
-            result_tokens.append({"type": "Characters", "data": title})
-            result_tokens.append(next(tokens))
-        else:
-            result_tokens.append(token)
-
-    serializer = html5lib.serializer.HTMLSerializer(
-        omit_optional_tags=False, quote_attr_values="always"
-    )
-
-    result = io.BytesIO()
-    for block in serializer.serialize(result_tokens, encoding="utf-8"):
-        result.write(block)
-    result.write(bytes(os.linesep, encoding="utf-8"))
-    return result.getvalue()
+def _render_journey_public_link(meta: Dict[str, str], title: str) -> bytes:
+    with open_base_index_html() as f:
+        return render_index_html(f, meta, title)
 
 
 async def _yield_from_file(path: str) -> AsyncIterable[bytes]:
@@ -133,13 +129,16 @@ async def _yield_from_file(path: str) -> AsyncIterable[bytes]:
 
 async def get_cached(itgs: Itgs, key: str) -> Optional[Response]:
     """Returns the cached response for the given key in the corresponding
-    response, if it exists, otherwise returns None.
+    response, if it exists, otherwise returns None. The key is namespaced by
+    the current build, so responses rendered from another build are ignored.
     """
     cache = await itgs.local_cache()
-    raw: Union[bytes, io.BytesIO, None] = cache.get(key, read=True)
+    raw: Union[bytes, io.BytesIO, None] = cache.get(build_cache.key(key), read=True)
     if raw is None:
+        metrics.CACHE_REQUESTS.labels("rendered_pages", "miss").inc()
         return None
 
+    metrics.CACHE_REQUESTS.labels("rendered_pages", "hit").inc()
     if isinstance(raw, bytes):
         return Response(
             content=raw, status_code=200, headers={"Content-Type": "text/html"}
@@ -156,7 +155,7 @@ async def get_cached(itgs: Itgs, key: str) -> Optional[Response]:
 
 async def set_cached(itgs: Itgs, key: str, val: bytes) -> None:
     cache = await itgs.local_cache()
-    cache.set(key, val, expire=60 * 5, tag="no-persist")
+    cache.set(build_cache.key(key), val, expire=60 * 5, tag=build_cache.get_tag())
 
 
 async def get_base_index_html() -> Response:
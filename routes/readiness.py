@@ -0,0 +1,16 @@
+from fastapi import APIRouter
+from fastapi.responses import Response
+import readiness
+
+router = APIRouter()
+
+
+@router.get("/readyz")
+async def get_readiness():
+    """Returns 200 while this instance should receive traffic, and 503 while
+    it's starting up or draining before a restart
+    """
+    return Response(
+        status_code=200 if readiness.is_ready() else 503,
+        headers={"Cache-Control": "no-store"},
+    )
@@ -3,6 +3,7 @@ from typing import Optional
 from itgs import Itgs
 from fastapi import APIRouter, Response
 import csrf
+import build_cache
 
 router = APIRouter()
 
@@ -57,7 +58,7 @@ async def get_update_password_html(itgs: Itgs) -> bytes:
     """
     Returns the update-password.html page, after substitutions, with caching
     """
-    cache_key = "update-password:html"
+    cache_key = build_cache.key("update-password:html")
     cache = await itgs.local_cache()
 
     cached = cache.get(cache_key)
@@ -67,7 +68,7 @@ async def get_update_password_html(itgs: Itgs) -> bytes:
     html = create_update_password_html()
     if os.environ["ENVIRONMENT"] != "dev":
         # we want live reloads
-        cache.set(cache_key, html, tag="no-persist")
+        cache.set(cache_key, html, tag=build_cache.get_tag())
     return html
 
 
@@ -85,7 +86,7 @@ def create_update_password_html() -> bytes:
 
 
 async def get_update_password_js(itgs: Itgs) -> bytes:
-    cache_key = "update-password:js"
+    cache_key = build_cache.key("update-password:js")
     cache = await itgs.local_cache()
 
     cached = cache.get(cache_key)
@@ -95,7 +96,7 @@ async def get_update_password_js(itgs: Itgs) -> bytes:
     js = create_update_password_js()
     if os.environ["ENVIRONMENT"] != "dev":
         # we want live reloads
-        cache.set(cache_key, js, tag="no-persist")
+        cache.set(cache_key, js, tag=build_cache.get_tag())
     return js
 
 
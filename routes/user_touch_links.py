@@ -1,5 +1,5 @@
 import os
-from fastapi import APIRouter
+from fastapi import APIRouter, Request
 from fastapi.responses import Response
 from error_middleware import handle_contextless_error, handle_warning
 from itgs import Itgs
@@ -8,24 +8,39 @@ from lib.touch.links import click_link
 from routes.journey_public_links import (
     create_journey_public_link_response,
     get_base_index_html,
+    get_cached,
+    set_cached,
 )
-from typing import Dict, Any, cast
+from typing import Dict, Any, Optional, cast
+import cache_warmup
+import renderer
+import static_previews
 
 router = APIRouter()
 
 
 @router.get("/l/{code}")
-async def get_maybe_web_only_link_by_code(code: str):
-    return await get_link_by_code(code)
+async def get_maybe_web_only_link_by_code(code: str, request: Request):
+    cache_warmup.record_hit("touch_link", code)
+    return await get_link_by_code(code, request.headers.get("accept-encoding"))
 
 
 @router.get("/a/{code}")
-async def get_app_link_by_code(code: str):
-    return await get_link_by_code(code)
+async def get_app_link_by_code(code: str, request: Request):
+    cache_warmup.record_hit("touch_link", code)
+    return await get_link_by_code(code, request.headers.get("accept-encoding"))
 
 
-async def get_link_by_code(code: str):
+async def get_link_by_code(code: str, accept_encoding: Optional[str] = None):
+    """Returns the preview page for the touch link with the given code. Pages
+    which had to be rendered are cached for 5m
+    """
+    cache_key = f"touch_link:{code}"
     async with Itgs() as itgs:
+        cached = await get_cached(itgs, cache_key)
+        if cached is not None:
+            return cached
+
         link = await click_link(
             itgs,
             code=code,
@@ -45,40 +60,52 @@ async def get_link_by_code(code: str):
             preview_identifier = link.preview_identifier
             preview_extra = link.preview_extra
 
-        if preview_identifier == "example":
-            raw_response = await create_journey_public_link_response(
-                meta={
-                    "og:title": "Oseh: Example Link",
-                    "og:description": "Look at this custom description!",
-                },
-                title="Oseh: Example Link",
-            )
-        elif preview_identifier == "unsubscribe":
-            raw_response = await create_journey_public_link_response(
-                meta={
-                    "og:title": "Oseh: Unsubscribe",
-                    "og:description": f"Unsubscribe from {preview_extra.get('list', 'this list')}",
-                },
-                title="Oseh: Unsubscribe",
-            )
-        elif preview_identifier == "share_journey" and isinstance(
-            preview_extra.get("journey_uid"), str
+        if preview_identifier == "example" or (
+            preview_identifier == "unsubscribe" and preview_extra.get("list") is None
         ):
-            try:
-                raw_response = await create_share_journey_response(
-                    itgs, uid=preview_extra["journey_uid"], touch_uid=link.touch_uid
-                )
-            except Exception as e:
-                await handle_contextless_error(
-                    extra_info=f"failed to create share journey response using uid `{preview_extra['journey_uid']}`: {e}"
+            static_response = static_previews.get_static_preview_response(
+                preview_identifier, accept_encoding
+            )
+            if static_response is not None:
+                return static_response
+
+        try:
+            if preview_identifier == "example":
+                preview = static_previews.STATIC_PREVIEWS["example"]
+                raw_response = await create_journey_public_link_response(
+                    meta=preview.meta, title=preview.title
                 )
-                return Response(
-                    status_code=302,
-                    headers={"Location": os.environ["ROOT_FRONTEND_URL"]},
+            elif preview_identifier == "unsubscribe":
+                raw_response = await create_journey_public_link_response(
+                    meta={
+                        "og:title": "Oseh: Unsubscribe",
+                        "og:description": f"Unsubscribe from {preview_extra.get('list', 'this list')}",
+                    },
+                    title="Oseh: Unsubscribe",
                 )
-        else:
+            elif preview_identifier == "share_journey" and isinstance(
+                preview_extra.get("journey_uid"), str
+            ):
+                try:
+                    raw_response = await create_share_journey_response(
+                        itgs, uid=preview_extra["journey_uid"], touch_uid=link.touch_uid
+                    )
+                except renderer.RenderUnavailable:
+                    raise
+                except Exception as e:
+                    await handle_contextless_error(
+                        extra_info=f"failed to create share journey response using uid `{preview_extra['journey_uid']}`: {e}"
+                    )
+                    return Response(
+                        status_code=302,
+                        headers={"Location": os.environ["ROOT_FRONTEND_URL"]},
+                    )
+            else:
+                return await get_base_index_html()
+        except renderer.RenderUnavailable:
             return await get_base_index_html()
 
+        await set_cached(itgs, cache_key, raw_response)
         return Response(
             content=raw_response, status_code=200, headers={"Content-Type": "text/html"}
         )
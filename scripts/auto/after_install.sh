@@ -58,17 +58,17 @@ install_python_requirements() {
     deactivate
 }
 
+# downloads only the files which changed since the last build into /var/www;
+# see build_artifacts.py
 update_website_code() {
+    cd /usr/local/src/webapp
     source /home/ec2-user/config.sh
-    rm -rf build/
-    if ! aws s3 cp s3://$OSEH_S3_BUCKET_NAME/builds/frontend/build.tar.gz build.tar.gz
+    . venv/bin/activate
+    if ! python build_artifacts.py sync /var/www
     then
         echo "Build not available, skipping"
-        return
     fi
-    
-    tar -xzf build.tar.gz
-    rsync --recursive --perms --times --checksum --group --owner --inplace --delete --delete-during --force build/ /var/www
+    deactivate
 }
 
 install_basic_dependencies
@@ -0,0 +1,374 @@
+"""Throughput benchmarks for the file services, which don't need credentials or
+network access.
+
+`s3` runs S3 against an in-process fake client which simulates a fixed latency
+per request and a fixed bandwidth per connection, comparing streaming
+multipart uploads and ranged downloads against spooling the upload to disk
+and reading the download 8 KiB at a time, as was done before.
+
+`local` runs LocalFiles against a temporary folder, comparing its copies
+against copying through aiofiles 8 KiB at a time, as was done before.
+
+Each case is run twice: once for its duration, and once under tracemalloc for
+the peak memory allocated by python while it ran, since tracing slows it down.
+
+    python -m scripts.bench_file_service s3 --size-mib 64
+    python -m scripts.bench_file_service local --size-mib 256
+"""
+
+import argparse
+import asyncio
+import hashlib
+import io
+import os
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+import aiofiles
+import botocore.exceptions
+from file_service import S3, LocalFiles
+from temp_files import temp_file
+
+
+MIB = 1024 * 1024
+
+
+def _report(name: str, size: int, duration: float, peak: int) -> None:
+    print(
+        f"{name:<36} {duration * 1000:>9.1f}ms  {size / MIB / duration:>8.1f} MiB/s"
+        f"  peak {peak / MIB:>7.1f} MiB"
+    )
+
+
+async def _time(name: str, size: int, fn: Callable[[], Awaitable[Any]]) -> float:
+    started_at = time.perf_counter()
+    await fn()
+    duration = time.perf_counter() - started_at
+
+    tracemalloc.start()
+    try:
+        await fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    _report(name, size, duration, peak)
+    return duration
+
+
+class _FakeBody:
+    """A response body which becomes readable at the simulated bandwidth"""
+
+    def __init__(self, data: bytes, bandwidth: float) -> None:
+        self.data = data
+        self.bandwidth = bandwidth
+        self.position = 0
+        self.started_at = time.perf_counter()
+
+    async def read(self, n: int = -1) -> bytes:
+        end = len(self.data) if n < 0 else min(len(self.data), self.position + n)
+        available_at = self.started_at + end / self.bandwidth
+        delay = available_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        result = self.data[self.position : end]
+        self.position = end
+        return result
+
+    def close(self) -> None:
+        pass
+
+
+def _digest(parts: Iterable[bytes]) -> str:
+    """How the fake client identifies uploaded content without keeping it, so
+    that it doesn't count towards the peak memory of uploads
+    """
+    return hashlib.sha256(
+        b"".join(hashlib.sha256(part).digest() for part in parts)
+    ).hexdigest()
+
+
+class _FakeS3Client:
+    """Just enough of the aioboto3 s3 client for S3 uploads and downloads.
+    Downloads are served from `objects`, which is filled in directly, whereas
+    uploads are only recorded by their digest in `uploaded`
+    """
+
+    def __init__(self, latency: float, bandwidth: float) -> None:
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.objects: Dict[str, bytes] = dict()
+        self.etags: Dict[str, str] = dict()
+        self.uploaded: Dict[str, str] = dict()
+        self.uploads: Dict[str, Dict[int, str]] = dict()
+
+    async def _transfer(self, num_bytes: int) -> None:
+        await asyncio.sleep(self.latency + num_bytes / self.bandwidth)
+
+    def store(self, key: str, data: bytes) -> None:
+        """Stores the given object for downloads, with a new etag"""
+        self.objects[key] = data
+        self.etags[key] = f'"{len(self.etags)}"'
+
+    async def put_object(self, *, Bucket: str, Key: str, Body: Any) -> dict:
+        hasher = hashlib.sha256()
+        size = 0
+        while chunk := Body.read(MIB):
+            hasher.update(chunk)
+            size += len(chunk)
+        await self._transfer(size)
+        self.uploaded[Key] = hasher.hexdigest()
+        return dict()
+
+    async def create_multipart_upload(self, *, Bucket: str, Key: str) -> dict:
+        await self._transfer(0)
+        upload_id = f"upload-{len(self.uploads)}"
+        self.uploads[upload_id] = dict()
+        return {"UploadId": upload_id}
+
+    async def upload_part(
+        self, *, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body: bytes
+    ) -> dict:
+        await self._transfer(len(Body))
+        self.uploads[UploadId][PartNumber] = hashlib.sha256(Body).hexdigest()
+        return {"ETag": f'"{PartNumber}"'}
+
+    async def complete_multipart_upload(
+        self, *, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict
+    ) -> dict:
+        await self._transfer(0)
+        parts = self.uploads.pop(UploadId)
+        self.uploaded[Key] = hashlib.sha256(
+            b"".join(
+                bytes.fromhex(parts[p["PartNumber"]]) for p in MultipartUpload["Parts"]
+            )
+        ).hexdigest()
+        return dict()
+
+    async def abort_multipart_upload(
+        self, *, Bucket: str, Key: str, UploadId: str
+    ) -> dict:
+        self.uploads.pop(UploadId, None)
+        return dict()
+
+    async def get_object(
+        self,
+        *,
+        Bucket: str,
+        Key: str,
+        Range: Optional[str] = None,
+        IfMatch: Optional[str] = None,
+    ) -> dict:
+        await asyncio.sleep(self.latency)
+        data = self.objects.get(Key)
+        if data is None:
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "NoSuchKey"}}, "GetObject"
+            )
+        etag = self.etags[Key]
+        if IfMatch is not None and IfMatch != etag:
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "PreconditionFailed"}}, "GetObject"
+            )
+        if Range is None:
+            return {
+                "Body": _FakeBody(data, self.bandwidth),
+                "ContentLength": len(data),
+                "ETag": etag,
+            }
+
+        start, end = (int(v) for v in Range[len("bytes=") :].split("-"))
+        end = min(end, len(data) - 1)
+        return {
+            "Body": _FakeBody(data[start : end + 1], self.bandwidth),
+            "ContentLength": end + 1 - start,
+            "ContentRange": f"bytes {start}-{end}/{len(data)}",
+            "ETag": etag,
+        }
+
+
+class _AsyncStream:
+    """An async stream over the given data which returns at most chunk_size
+    bytes per read, like a request body
+    """
+
+    def __init__(self, data: bytes, chunk_size: int) -> None:
+        self.data = io.BytesIO(data)
+        self.chunk_size = chunk_size
+
+    async def read(self, n: int) -> bytes:
+        return self.data.read(min(n, self.chunk_size))
+
+
+class _AsyncSink:
+    def __init__(self) -> None:
+        self.size = 0
+
+    async def write(self, b: bytes) -> int:
+        self.size += len(b)
+        return len(b)
+
+
+async def _spooled_upload(client: _FakeS3Client, stream: _AsyncStream) -> None:
+    """How S3.upload handled async streams before multipart uploads"""
+    with temp_file() as tmp:
+        async with aiofiles.open(tmp, "wb") as f2:
+            data = await stream.read(8192)
+            while data:
+                await f2.write(data)
+                data = await stream.read(8192)
+
+        with open(tmp, "rb") as f2:
+            await client.put_object(Bucket="bench", Key="spooled", Body=f2)
+
+
+def _make_s3(client: _FakeS3Client, **kwargs) -> S3:
+    s3 = S3("bench", **kwargs)
+    s3._s3 = client
+    return s3
+
+
+async def bench_s3(args: argparse.Namespace) -> None:
+    size = args.size_mib * MIB
+    data = bytes(range(256)) * (size // 256)
+    client = _FakeS3Client(args.latency_ms / 1000, args.bandwidth_mib * MIB)
+    print(
+        f"s3: {args.size_mib} MiB object, {args.latency_ms}ms per request, "
+        f"{args.bandwidth_mib} MiB/s per connection"
+    )
+
+    def _stream() -> _AsyncStream:
+        return _AsyncStream(data, args.stream_chunk_kib * 1024)
+
+    await _time(
+        "upload spooled (before)", size, lambda: _spooled_upload(client, _stream())
+    )
+    for concurrency in (1, 4):
+        s3 = _make_s3(client, upload_concurrency=concurrency)
+        await _time(
+            f"upload multipart x{concurrency}",
+            size,
+            lambda: s3.upload(_stream(), bucket="bench", key="object", sync=False),
+        )
+        assert client.uploaded["object"] == _digest(
+            data[i : i + s3.part_size] for i in range(0, size, s3.part_size)
+        )
+
+    client.store("object", data)
+    for name, kwargs in (
+        ("download 8 KiB reads (before)", {"download_chunk_size": 8192}),
+        ("download 1 MiB reads", dict()),
+        ("download ranged x4", {"download_concurrency": 4}),
+    ):
+        s3 = _make_s3(client, **kwargs)
+
+        async def _download():
+            sink = _AsyncSink()
+            await s3.download(sink, bucket="bench", key="object", sync=False)
+            assert sink.size == size
+
+        await _time(name, size, _download)
+
+
+async def _aiofiles_upload(f, dst: str) -> None:
+    """How LocalFiles.upload copied synchronous file objects before"""
+    async with aiofiles.open(dst, "wb") as f2:
+        chunk = f.read(8192)
+        while chunk:
+            await f2.write(chunk)
+            chunk = f.read(8192)
+
+
+async def _aiofiles_download(src: str, f) -> None:
+    """How LocalFiles.download copied into synchronous file objects before"""
+    async with aiofiles.open(src, "rb") as f2:
+        chunk = await f2.read(8192)
+        while chunk:
+            f.write(chunk)
+            chunk = await f2.read(8192)
+
+
+async def bench_local(args: argparse.Namespace) -> None:
+    size = args.size_mib * MIB
+    print(f"local: {args.size_mib} MiB file")
+    with tempfile.TemporaryDirectory() as root:
+        files = LocalFiles(root, "bench")
+        src = os.path.join(root, "src.bin")
+        with open(src, "wb") as f:
+            for _ in range(args.size_mib):
+                f.write(os.urandom(MIB))
+        os.makedirs(os.path.join(root, "bench"))
+        stored = os.path.join(root, "bench", "object")
+
+        async def _upload_before():
+            with open(src, "rb") as f:
+                await _aiofiles_upload(f, stored)
+
+        async def _upload_file():
+            with open(src, "rb") as f:
+                await files.upload(f, bucket="bench", key="object", sync=True)
+
+        async def _upload_stream():
+            with open(src, "rb") as f:
+                stream = _AsyncStream(f.read(), args.stream_chunk_kib * 1024)
+            await files.upload(stream, bucket="bench", key="object", sync=False)
+
+        async def _download_before():
+            with open(os.path.join(root, "dst.bin"), "wb") as f:
+                await _aiofiles_download(stored, f)
+
+        async def _download_file():
+            with open(os.path.join(root, "dst.bin"), "wb") as f:
+                await files.download(f, bucket="bench", key="object", sync=True)
+
+        async def _download_bytesio():
+            await files.download(io.BytesIO(), bucket="bench", key="object", sync=True)
+
+        async def _download_stream():
+            sink = _AsyncSink()
+            await files.download(sink, bucket="bench", key="object", sync=False)
+            assert sink.size == size
+
+        await _time("upload aiofiles 8 KiB (before)", size, _upload_before)
+        await _time("upload file", size, _upload_file)
+        await _time("upload async stream", size, _upload_stream)
+        await _time("download aiofiles 8 KiB (before)", size, _download_before)
+        await _time("download to file", size, _download_file)
+        await _time("download to BytesIO", size, _download_bytesio)
+        await _time("download to async stream", size, _download_stream)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    s3_parser = subparsers.add_parser("s3", help="benchmark S3 against a fake client")
+    s3_parser.add_argument("--size-mib", type=int, default=64)
+    s3_parser.add_argument("--latency-ms", type=float, default=20)
+    s3_parser.add_argument("--bandwidth-mib", type=float, default=100)
+    s3_parser.add_argument(
+        "--stream-chunk-kib",
+        type=int,
+        default=64,
+        help="the size of each read from the uploaded stream",
+    )
+
+    local_parser = subparsers.add_parser("local", help="benchmark LocalFiles")
+    local_parser.add_argument("--size-mib", type=int, default=256)
+    local_parser.add_argument(
+        "--stream-chunk-kib",
+        type=int,
+        default=64,
+        help="the size of each read from the uploaded stream",
+    )
+
+    args = parser.parse_args()
+    if args.command == "s3":
+        await bench_s3(args)
+    else:
+        await bench_local(args)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,77 @@
+"""Microbenchmark comparing enqueueing and retrieving jobs one at a time
+against the batch methods, against a local redis (6.2 or later; 7 or later to
+exercise BLMPOP rather than the pipelined fallback in retrieve_many).
+Uses its own queue key, so it's safe to run against a development redis.
+
+    python -m scripts.bench_jobs --url redis://localhost:6379 --jobs 10000
+"""
+
+import argparse
+import asyncio
+import time
+from typing import Awaitable, Callable
+import redis.asyncio
+from jobs import Jobs
+
+
+QUEUE_KEY = b"jobs:bench"
+"""The list the benchmark queues into, instead of the real queue"""
+
+
+async def _time(name: str, num_jobs: int, fn: Callable[[], Awaitable[None]]) -> float:
+    started_at = time.perf_counter()
+    await fn()
+    duration = time.perf_counter() - started_at
+    print(f"{name:<24} {duration * 1000:>9.1f}ms  {num_jobs / duration:>10.0f} jobs/s")
+    return duration
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="redis://localhost:6379")
+    parser.add_argument("--jobs", type=int, default=10000, help="jobs per run")
+    parser.add_argument(
+        "--batch", type=int, default=500, help="jobs per retrieve_many call"
+    )
+    args = parser.parse_args()
+
+    conn = redis.asyncio.Redis.from_url(args.url)
+    try:
+        jobs = Jobs(conn)
+        jobs.queue_key = QUEUE_KEY
+        await conn.delete(QUEUE_KEY)
+        kwargs = {"uid": "oseh_if_bench", "file_size": 12345}
+
+        async def enqueue_one_at_a_time():
+            for _ in range(args.jobs):
+                await jobs.enqueue("runners.bench", **kwargs)
+
+        async def retrieve_one_at_a_time():
+            for _ in range(args.jobs):
+                assert await jobs.retrieve(timeout=1) is not None
+
+        async def enqueue_many():
+            await jobs.enqueue_many(("runners.bench", kwargs) for _ in range(args.jobs))
+
+        async def retrieve_many():
+            remaining = args.jobs
+            while remaining > 0:
+                batch = await jobs.retrieve_many(min(args.batch, remaining), timeout=1)
+                assert batch
+                remaining -= len(batch)
+
+        enqueue = await _time("enqueue", args.jobs, enqueue_one_at_a_time)
+        retrieve = await _time("retrieve", args.jobs, retrieve_one_at_a_time)
+        enqueue_batched = await _time("enqueue_many", args.jobs, enqueue_many)
+        retrieve_batched = await _time("retrieve_many", args.jobs, retrieve_many)
+        print(
+            f"speedup: enqueue {enqueue / enqueue_batched:.1f}x, "
+            f"retrieve {retrieve / retrieve_batched:.1f}x"
+        )
+    finally:
+        await conn.delete(QUEUE_KEY)
+        await conn.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,4 +1,6 @@
-# Builds the website code to build/
+# Builds the website code to build/, restoring node_modules and the npm cache
+# from S3 when available
+. ./timing.sh
 
 activate_nvm() {
     source /root/.bashrc
@@ -29,14 +31,102 @@ activate_node_installing_if_necessary() {
     fi
 }
 
+# node_modules depends on the lockfile, node version, and architecture, whereas
+# the npm cache is content-addressed and so can be reused across lockfiles
+DEPENDENCY_CACHE_PREFIX="builds/frontend/cache"
+
+dependency_cache_key() {
+    (cat package-lock.json; node --version; uname -m) | sha256sum | cut -d' ' -f1
+}
+
+lockfile_hash() {
+    sha256sum package-lock.json | cut -d' ' -f1
+}
+
+# usage: restore_from_s3 <key> <folder>
+# downloads the tar.gz at the given key and extracts it into the given folder,
+# returning non-zero if it doesn't exist
+restore_from_s3() {
+    rm -f /tmp/dependency-cache.tar.gz
+    if ! aws s3 cp "s3://$OSEH_S3_BUCKET_NAME/$1" /tmp/dependency-cache.tar.gz --only-show-errors
+    then
+        return 1
+    fi
+    mkdir -p "$2"
+    tar -xzf /tmp/dependency-cache.tar.gz -C "$2"
+    local rc=$?
+    rm -f /tmp/dependency-cache.tar.gz
+    return $rc
+}
+
+# usage: store_in_s3 <folder> <name> <key> [<key>...]
+# compresses the given entry within the folder and uploads it to each key
+store_in_s3() {
+    local folder=$1
+    local name=$2
+    shift 2
+    tar -czf /tmp/dependency-cache.tar.gz -C "$folder" "$name" || return 1
+    for key in "$@"
+    do
+        aws s3 cp /tmp/dependency-cache.tar.gz "s3://$OSEH_S3_BUCKET_NAME/$key" --only-show-errors
+    done
+    rm -f /tmp/dependency-cache.tar.gz
+}
+
+# the keys are computed before installing, since npm install may rewrite the lockfile
+restore_dependency_cache() {
+    DEPENDENCY_CACHE_KEY=$(dependency_cache_key)
+    LOCKFILE_HASH=$(lockfile_hash)
+    NODE_MODULES_CACHE_HIT=0
+    if restore_from_s3 "$DEPENDENCY_CACHE_PREFIX/node_modules/$DEPENDENCY_CACHE_KEY.tar.gz" /usr/local/src/webapp
+    then
+        echo "node_modules cache hit"
+        NODE_MODULES_CACHE_HIT=1
+        return 0
+    fi
+    echo "node_modules cache miss"
+    rm -rf /usr/local/src/webapp/node_modules
+
+    if restore_from_s3 "$DEPENDENCY_CACHE_PREFIX/npm-cache/$LOCKFILE_HASH.tar.gz" /root \
+        || restore_from_s3 "$DEPENDENCY_CACHE_PREFIX/npm-cache/latest.tar.gz" /root
+    then
+        echo "npm cache restored"
+    else
+        echo "npm cache miss"
+    fi
+}
+
+install_dependencies() {
+    npm install --prefer-offline --no-audit --no-fund
+}
+
+save_dependency_cache() {
+    if [ "$NODE_MODULES_CACHE_HIT" = "1" ]
+    then
+        return 0
+    fi
+    store_in_s3 /usr/local/src/webapp node_modules "$DEPENDENCY_CACHE_PREFIX/node_modules/$DEPENDENCY_CACHE_KEY.tar.gz"
+    store_in_s3 /root .npm \
+        "$DEPENDENCY_CACHE_PREFIX/npm-cache/$LOCKFILE_HASH.tar.gz" \
+        "$DEPENDENCY_CACHE_PREFIX/npm-cache/latest.tar.gz"
+}
+
+build_website() {
+    export REACT_APP_VERSION=$(git rev-parse HEAD)
+    npm run build
+}
+
 update_website_code() {
     . /home/ec2-user/config.sh
     cd /usr/local/src/webapp
     nvm use node
-    npm install
-    export REACT_APP_VERSION=$(git rev-parse HEAD)
-    npm run build
+    timed_phase restore_dependency_cache restore_dependency_cache
+    # only a successful install and build may be cached, since the cache key
+    # only depends on the lockfile
+    timed_phase npm_install install_dependencies || return 1
+    timed_phase npm_build build_website || return 1
+    timed_phase save_dependency_cache save_dependency_cache
 }
 
-activate_node_installing_if_necessary
+timed_phase setup_node activate_node_installing_if_necessary
 update_website_code
\ No newline at end of file
@@ -1,15 +1,20 @@
-# compresses build/ to build.tar.gz
-compress_code() {
+# publishes build/ to S3 as content-addressed files plus a manifest, adding
+# precompressed siblings; see build_artifacts.py
+publish_code() {
     cd /usr/local/src/webapp
-    tar -czf build.tar.gz build
-}
-
-# stores build.tar.gz in S3 under s3_files/builds/frontend/build.tar.gz
-upload_code() {
+    if [ ! -d venv ]
+    then
+        python3 -m venv venv
+    fi
+    . venv/bin/activate
     . /home/ec2-user/config.sh
-    cd /usr/local/src/webapp
-    aws s3 cp build.tar.gz s3://$OSEH_S3_BUCKET_NAME/builds/frontend/build.tar.gz
+    
+    # build_artifacts.py only needs boto3 (and brotli for the .br siblings), so
+    # install just those, at the versions pinned in requirements.txt
+    python -m pip install -U pip
+    tr -d '\r' < requirements.txt | grep -iE '^(boto3|botocore|brotli)==' > /tmp/publish-requirements.txt
+    pip install -r /tmp/publish-requirements.txt
+    python build_artifacts.py publish build
 }
 
-compress_code
-upload_code
\ No newline at end of file
+publish_code
\ No newline at end of file
@@ -1,11 +1,12 @@
+. ./timing.sh
 echo Waiting for boot finished..
-bash wait_boot_finished.sh
+timed_phase wait_boot_finished bash wait_boot_finished.sh
 echo Cloning repo..
-bash clone_repo.sh
+timed_phase clone_repo bash clone_repo.sh
 echo Building website code..
-bash build_website_code.sh
+timed_phase build_website_code bash build_website_code.sh
 echo Compressing and storing code..
-bash compress_and_store_code.sh
+timed_phase compress_and_store_code bash compress_and_store_code.sh
 echo Informing instances..
-bash inform_instances.sh
+timed_phase inform_instances bash inform_instances.sh
 echo All done!
\ No newline at end of file
@@ -0,0 +1,13 @@
+# usage: timed_phase <name> <command> [args...]
+# runs the command and then prints how long it took on a line of the form
+# `BUILD_PHASE <name> <milliseconds> <exit code>`, which trigger_build collects
+timed_phase() {
+    local name=$1
+    shift
+    local start=$(date +%s%3N)
+    "$@"
+    local rc=$?
+    local end=$(date +%s%3N)
+    echo "BUILD_PHASE $name $(($end - $start)) $rc"
+    return $rc
+}
@@ -0,0 +1,449 @@
+"""Runs trigger_build against fake EC2, SSH, redis, and S3 layers, then checks
+that each build's BuildRecord has the expected phases, and that
+find_regressions flags a phase of the latest build exactly when it was
+unusually slow. Needs no credentials or network access.
+
+    python -m scripts.check_build_timing
+"""
+
+import asyncio
+import functools
+import hashlib
+import io
+import json
+import os
+import tempfile
+from typing import Dict, List, Optional
+import anyio
+import anyio.from_thread
+import build_stats
+import trigger_build
+from build_stats import BuildRecord
+
+
+NORMAL_SCRIPT_PHASE_MS = {
+    "wait_boot_finished": 5000,
+    "clone_repo": 8000,
+    "setup_node": 2000,
+    "npm_install": 40000,
+    "npm_build": 60000,
+    "build_website_code": 102000,
+    "compress_and_store_code": 9000,
+    "inform_instances": 500,
+}
+"""How long each phase of the fake build script takes in a normal build"""
+
+EXPECTED_PHASES = {
+    "create_key_pair",
+    "launch",
+    "wait_running",
+    "connect",
+    "script",
+    "wait_build_ready",
+    "upload_logs",
+    "terminate",
+    "delete_key_pair",
+    *(f"script.{name}" for name in NORMAL_SCRIPT_PHASE_MS),
+}
+"""The phases every successful build must record"""
+
+
+class FakePubSub:
+    def __init__(self, redis: "FakeRedis") -> None:
+        self.redis = redis
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.pattern: Optional[bytes] = None
+
+    async def psubscribe(self, pattern: bytes) -> None:
+        self.pattern = pattern
+        self.redis.pubsubs.append(self)
+        await self.queue.put({"type": "psubscribe"})
+
+    async def get_message(self, timeout: float) -> Optional[dict]:
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def listen(self):
+        while True:
+            yield await self.queue.get()
+
+    async def aclose(self) -> None:
+        self.redis.pubsubs.remove(self)
+
+
+class FakePipeline:
+    def __init__(self, redis: "FakeRedis") -> None:
+        self.redis = redis
+
+    async def __aenter__(self) -> "FakePipeline":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        pass
+
+    def multi(self) -> None:
+        pass
+
+    async def rpush(self, key: bytes, *values: bytes) -> None:
+        await self.redis.rpush(key, *values)
+
+    async def ltrim(self, key: bytes, start: int, end: int) -> None:
+        self.redis.lists[key] = self.redis.lists[key][start:]
+
+    async def execute(self) -> None:
+        pass
+
+
+class FakeRedis:
+    def __init__(self) -> None:
+        self.lists: Dict[bytes, List[bytes]] = dict()
+        self.pubsubs: List[FakePubSub] = []
+        self.published: List[bytes] = []
+
+    def pubsub(self) -> FakePubSub:
+        return FakePubSub(self)
+
+    def pipeline(self) -> FakePipeline:
+        return FakePipeline(self)
+
+    async def rpush(self, key: bytes, *values: bytes) -> None:
+        self.lists.setdefault(key, []).extend(values)
+
+    async def lrange(self, key: bytes, start: int, end: int) -> List[bytes]:
+        return self.lists.get(key, [])[start:]
+
+    async def publish(self, channel, data) -> None:
+        channel = channel.encode("utf-8") if isinstance(channel, str) else channel
+        self.published.append(channel)
+        for pubsub in self.pubsubs:
+            if channel.startswith(pubsub.pattern.rstrip(b"*")):
+                await pubsub.queue.put(
+                    {"type": "pmessage", "channel": channel, "data": data}
+                )
+
+
+class FakeSlack:
+    async def send_ops_message(self, message: str) -> None:
+        pass
+
+
+class FakeFiles:
+    default_bucket = "bucket"
+
+    def __init__(self) -> None:
+        self.objects: Dict[str, bytes] = dict()
+
+    async def upload(self, f, *, bucket: str, key: str, sync: bool) -> None:
+        self.objects[key] = f.read()
+
+
+class FakeItgs:
+    def __init__(self) -> None:
+        self._redis = FakeRedis()
+        self._files = FakeFiles()
+
+    async def slack(self) -> FakeSlack:
+        return FakeSlack()
+
+    async def redis(self) -> FakeRedis:
+        return self._redis
+
+    async def files(self) -> FakeFiles:
+        return self._files
+
+    async def ensure_redis_liveliness(self) -> None:
+        pass
+
+
+class FakeEC2Client:
+    """An instance which is running on the second check and terminated on the
+    first check after terminating it
+    """
+
+    def __init__(self) -> None:
+        self.state = "pending"
+        self.key_pairs: List[str] = []
+
+    async def __aenter__(self) -> "FakeEC2Client":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        pass
+
+    async def create_key_pair(self, *, KeyName: str, **kwargs) -> dict:
+        self.key_pairs.append(KeyName)
+        return {"KeyMaterial": "fake", "KeyName": KeyName}
+
+    async def delete_key_pair(self, *, KeyName: str) -> None:
+        self.key_pairs.remove(KeyName)
+
+    async def run_instances(self, **kwargs) -> dict:
+        return {
+            "Instances": [
+                {
+                    "InstanceId": "i-fake",
+                    "PrivateIpAddress": "10.0.0.1",
+                    "State": {"Name": self.state},
+                }
+            ]
+        }
+
+    async def describe_instances(self, *, InstanceIds: List[str]) -> dict:
+        if self.state == "pending":
+            self.state = "running"
+        elif self.state == "shutting-down":
+            self.state = "terminated"
+        return {"Reservations": [{"Instances": [{"State": {"Name": self.state}}]}]}
+
+    async def terminate_instances(self, *, InstanceIds: List[str]) -> dict:
+        self.state = "shutting-down"
+        return {"TerminatingInstances": [{"CurrentState": {"Name": self.state}}]}
+
+
+class FakeSession:
+    def __init__(self) -> None:
+        self.clients: List[FakeEC2Client] = []
+
+    def client(self, name: str) -> FakeEC2Client:
+        assert name == "ec2"
+        client = FakeEC2Client()
+        self.clients.append(client)
+        return client
+
+
+class FakeChannel:
+    """Replays the given stdout in small chunks, with the exit status and EOF
+    already received, so the output must be drained after the exit status
+    """
+
+    def __init__(self, redis: FakeRedis, stdout: bytes, stderr: bytes) -> None:
+        self.redis = redis
+        self.stdout = stdout
+        self.stderr = stderr
+        self.command: Optional[str] = None
+        self.eof_received = True
+        self.closed = False
+        self._read_fd, self._write_fd = os.pipe()
+        os.write(self._write_fd, b"x")
+
+    def fileno(self) -> int:
+        return self._read_fd
+
+    def exec_command(self, command: str) -> None:
+        self.command = command
+
+    def recv_ready(self) -> bool:
+        return bool(self.stdout)
+
+    def recv_stderr_ready(self) -> bool:
+        return bool(self.stderr)
+
+    def recv(self, n: int) -> bytes:
+        result, self.stdout = self.stdout[:7], self.stdout[7:]
+        if result and not self.stdout:
+            # the last step of the build script publishes build_ready
+            anyio.from_thread.run(
+                self.redis.publish, b"updates:frontend-web:build_ready", b"1"
+            )
+        return result
+
+    def recv_stderr(self, n: int) -> bytes:
+        result, self.stderr = self.stderr, b""
+        return result
+
+    def exit_status_ready(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            os.close(self._read_fd)
+            os.close(self._write_fd)
+
+
+class FakeTransport:
+    def __init__(self, channel: FakeChannel) -> None:
+        self.channel = channel
+
+    def open_session(self, timeout: float) -> FakeChannel:
+        return self.channel
+
+
+class FakeRemoteFile(io.StringIO):
+    def __init__(self, files: Dict[str, bytes], path: str) -> None:
+        super().__init__()
+        self.files = files
+        self.path = path
+
+    def close(self) -> None:
+        self.files[self.path] = self.getvalue().encode("utf-8")
+        super().close()
+
+
+class FakeSFTP:
+    def __init__(self, files: Dict[str, bytes]) -> None:
+        self.files = files
+
+    def putfo(self, f, path: str) -> None:
+        self.files[path] = f.read()
+
+    def open(self, path: str, mode: str) -> FakeRemoteFile:
+        return FakeRemoteFile(self.files, path)
+
+    def chmod(self, path: str, mode: int) -> None:
+        assert path in self.files, path
+
+    def close(self) -> None:
+        pass
+
+
+class FakeSSHClient:
+    """Stands in for paramiko.SSHClient connected to a build server which runs
+    the build script with the given phase durations
+    """
+
+    def __init__(self, redis: FakeRedis, script_phase_ms: Dict[str, int]) -> None:
+        self.redis = redis
+        self.script_phase_ms = script_phase_ms
+        self.files: Dict[str, bytes] = dict()
+        self.channel: Optional[FakeChannel] = None
+
+    def set_missing_host_key_policy(self, policy) -> None:
+        pass
+
+    def connect(self, **kwargs) -> None:
+        pass
+
+    def open_sftp(self) -> FakeSFTP:
+        return FakeSFTP(self.files)
+
+    def get_transport(self) -> FakeTransport:
+        lines = [
+            "Cloning repo..",
+            *(f"BUILD_PHASE {n} {ms} 0" for n, ms in self.script_phase_ms.items()),
+            "All done!",
+        ]
+        self.channel = FakeChannel(
+            self.redis,
+            "\n".join(lines).encode("utf-8") + b"\n",
+            b"npm warn deprecated\n",
+        )
+        return FakeTransport(self.channel)
+
+    def close(self) -> None:
+        pass
+
+
+def make_fake_execute(
+    redis: FakeRedis, script_phase_ms: Dict[str, int], clients: List[FakeSSHClient]
+):
+    """Returns connect_and_execute using fake ssh clients, which are appended
+    to the given list as they're created
+    """
+
+    def _factory() -> FakeSSHClient:
+        client = FakeSSHClient(redis, script_phase_ms)
+        clients.append(client)
+        return client
+
+    return functools.partial(
+        trigger_build.connect_and_execute, ssh_client_factory=_factory
+    )
+
+
+async def run_fake_build(itgs: FakeItgs, script_phase_ms: Dict[str, int]) -> None:
+    session = FakeSession()
+    ssh_clients: List[FakeSSHClient] = []
+    await trigger_build.trigger_build(
+        itgs,
+        build_subnet_id="subnet-fake",
+        build_ami_id="ami-fake",
+        build_security_group_id="sg-fake",
+        build_iam_instance_profile_name="profile-fake",
+        backup_build_subnet_id="subnet-fake-backup",
+        dry_run=False,
+        session=session,
+        execute=make_fake_execute(await itgs.redis(), script_phase_ms, ssh_clients),
+    )
+    (client,) = session.clients
+    assert client.state == "terminated", client.state
+    assert not client.key_pairs, client.key_pairs
+
+    ssh_client = ssh_clients[-1]
+    assert ssh_client.channel is not None and ssh_client.channel.closed
+    assert ssh_client.channel.command == "sudo bash /home/ec2-user/initial_script.sh"
+    bundle = ssh_client.files[trigger_build.BOOTSTRAP_BUNDLE_PATH]
+    script = ssh_client.files["/home/ec2-user/initial_script.sh"].decode("utf-8")
+    assert hashlib.sha256(bundle).hexdigest() in script, script
+
+    stdout = itgs._files.objects["builds/frontend-web/build-stdout.txt"]
+    assert stdout.endswith(b"All done!\n"), stdout
+    stderr = itgs._files.objects["builds/frontend-web/build-stderr.txt"]
+    assert stderr == b"npm warn deprecated\n", stderr
+
+
+def check_record(record: BuildRecord, script_phase_ms: Dict[str, int]) -> None:
+    assert record.success is True, record
+    assert record.instance_id == "i-fake", record.instance_id
+    assert set(record.phases) == EXPECTED_PHASES, set(record.phases) ^ EXPECTED_PHASES
+    assert all(seconds >= 0 for seconds in record.phases.values()), record.phases
+    for name, ms in script_phase_ms.items():
+        assert record.phases[f"script.{name}"] == ms / 1000, (name, record.phases)
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as folder:
+        trigger_build.CONFIG_SH_PATH = os.path.join(folder, "config.sh")
+        trigger_build.REPO_SH_PATH = os.path.join(folder, "repo.sh")
+        for path in (trigger_build.CONFIG_SH_PATH, trigger_build.REPO_SH_PATH):
+            with open(path, "w") as f:
+                f.write("# fake\n")
+
+        await check_builds()
+
+
+async def check_builds():
+    trigger_build.POLL_INTERVAL_SECONDS = 0
+    itgs = FakeItgs()
+    redis = await itgs.redis()
+
+    num_normal = build_stats.REGRESSION_MIN_HISTORY
+    for _ in range(num_normal):
+        await run_fake_build(itgs, NORMAL_SCRIPT_PHASE_MS)
+
+    records = await build_stats.load_recent_build_records(itgs, 50)
+    assert len(records) == num_normal, len(records)
+    for record in records:
+        check_record(record, NORMAL_SCRIPT_PHASE_MS)
+    assert build_stats.find_regressions(records) == [], records
+    assert redis.published.count(b"updates:frontend-web:do_update") == num_normal
+    for key in (
+        "builds/frontend-web/build-stdout.txt",
+        "builds/frontend-web/build-stderr.txt",
+    ):
+        assert key in itgs._files.objects, key
+    uploaded = [k for k in itgs._files.objects if k.endswith(".json")]
+    assert uploaded and json.loads(itgs._files.objects[uploaded[-1]])["success"]
+
+    # slower, but not enough to be flagged
+    noisy = {**NORMAL_SCRIPT_PHASE_MS, "npm_install": 45000}
+    await run_fake_build(itgs, noisy)
+    records = await build_stats.load_recent_build_records(itgs, 50)
+    check_record(records[-1], noisy)
+    assert build_stats.find_regressions(records) == [], records[-1]
+
+    slow = {**NORMAL_SCRIPT_PHASE_MS, "npm_install": 100000}
+    await run_fake_build(itgs, slow)
+    records = await build_stats.load_recent_build_records(itgs, 50)
+    check_record(records[-1], slow)
+    regressions = build_stats.find_regressions(records)
+    assert regressions == ["script.npm_install"], regressions
+
+    print(build_stats.format_report(records))
+    print(f"ok: {len(records)} fake builds recorded; regressions: {regressions}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
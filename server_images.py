@@ -40,6 +40,7 @@ import argparse
 from pydantic import BaseModel, Field
 from typing import Dict, List, Set, Union, Literal, Tuple
 from itgs import Itgs
+from dataclasses import dataclass
 import traceback
 import hashlib
 import secrets
@@ -153,6 +154,30 @@ class ServerImageConfig(BaseModel):
     files: List[ServerImageFile] = Field(description="list of files to process")
 
 
+@dataclass
+class LocalServerImageFile:
+    file: ServerImageFile
+    """the configured file"""
+    sha512: str
+    """the sha512 of the source file on disk"""
+    file_size: int
+    """the size of the source file on disk, in bytes"""
+    force: bool
+    """True if the exports must be regenerated even if the source is unchanged,
+    i.e., the resolutions, transparency, or focal point changed
+    """
+
+
+@dataclass
+class ExistingImageFiles:
+    sha512_by_uid: Dict[str, str]
+    """the original_sha512 of each image file in the database whose uid was requested"""
+    uid_by_sha512: Dict[str, str]
+    """the uid of an image file in the database for each requested original_sha512
+    that is in use
+    """
+
+
 async def main():
     parser = argparse.ArgumentParser(description="Generate server-side images")
     parser.add_argument(
@@ -212,6 +237,7 @@ async def update_server_images(itgs: Itgs):
         for file in old_config.files:
             old_config_lookup[file.uid] = file
 
+    local_files: List[LocalServerImageFile] = []
     for file in config.files:
         if isinstance(file.resolutions, str):
             file.resolutions = RESOLUTION_PRESETS[file.resolutions]
@@ -234,80 +260,144 @@ async def update_server_images(itgs: Itgs):
             old_transparency = old_file.transparency
             old_focal_point = old_file.focal_point
 
-        await ensure_file_exists(
-            itgs,
-            file,
-            force=(
-                old_resolutions != file.resolutions
-                or old_transparency != file.transparency
-                or old_focal_point != file.focal_point
-            ),
+        if not os.path.exists(file.source):
+            raise Exception(f"{file.source=} does not exist")
+
+        local_files.append(
+            LocalServerImageFile(
+                file=file,
+                sha512=await hash_content(file.source),
+                file_size=os.path.getsize(file.source),
+                force=(
+                    old_resolutions != file.resolutions
+                    or old_transparency != file.transparency
+                    or old_focal_point != file.focal_point
+                ),
+            )
         )
 
+    # the batched query can't see files we're about to insert, so two
+    # configured files with the same content must be caught here
+    uid_by_local_sha512: Dict[str, str] = dict()
+    for local in local_files:
+        file, sha512 = local.file, local.sha512
+        other_uid = uid_by_local_sha512.setdefault(sha512, file.uid)
+        if other_uid != file.uid:
+            print(f"{file.source=} is also configured for {other_uid=}")
+            raise Exception(
+                f"cannot reuse an image file with a different uid ({file.source=}); "
+                "if you have a legitimate reason for this, add a comment to the file "
+                f"to get a different hash; {sha512=}"
+            )
+
+    existing = await fetch_existing_image_files(
+        itgs,
+        uids=[local.file.uid for local in local_files],
+        sha512s=[local.sha512 for local in local_files],
+    )
+
+    changed: List[Tuple[LocalServerImageFile, bool]] = []
+    for local in local_files:
+        file = local.file
+        previous_sha512 = existing.sha512_by_uid.get(file.uid)
+        if previous_sha512 is not None:
+            if previous_sha512 == local.sha512:
+                print(f"No change in {file.source=} for {file.uid=}")
+                if not local.force:
+                    print("  skipping")
+                    continue
+                print("  but update was forced")
+            else:
+                print(f"Detected change in {file.source=} for {file.uid=}...")
+            changed.append((local, True))
+            continue
+
+        if local.sha512 in existing.uid_by_sha512:
+            print(f"{file.source=} is already in use for something else, ignoring")
+            raise Exception(
+                f"cannot reuse an image file with a different uid ({file.source=}); "
+                "if you have a legitimate reason for this, add a comment to the file "
+                f"to get a different hash; {local.sha512=}"
+            )
+
+        changed.append((local, False))
+
+    print(f"{len(changed)}/{len(local_files)} server images need processing")
+    for local, replace in changed:
+        await ensure_file_exists(itgs, local, replace=replace)
+
     if old_config is not None:
         existing_uids: Set[str] = set()
         for file in config.files:
             existing_uids.add(file.uid)
 
-        for file in old_config.files:
-            if file.uid not in existing_uids:
-                await delete_file(itgs, file)
+        await delete_files(
+            itgs, [file for file in old_config.files if file.uid not in existing_uids]
+        )
 
     new_config_bytes = config.json().encode("utf-8")
     await redis.set(b"frontend-web:server_images:config", new_config_bytes)
 
 
-async def ensure_file_exists(itgs: Itgs, file: ServerImageFile, force: bool = False):
-    if not os.path.exists(file.source):
-        raise Exception(f"{file.source=} does not exist")
-
-    ext = os.path.splitext(file.source)[1]
-
-    file_size = os.path.getsize(file.source)
-    sha512 = await hash_content(file.source)
+async def fetch_existing_image_files(
+    itgs: Itgs, *, uids: List[str], sha512s: List[str]
+) -> ExistingImageFiles:
+    """Fetches the state of the image files with the given uids or original
+    hashes in a single query, so that the diff against the configuration can
+    be done in memory rather than with a round trip per file.
+    """
+    result = ExistingImageFiles(sha512_by_uid=dict(), uid_by_sha512=dict())
+    if not uids and not sha512s:
+        return result
 
     conn = await itgs.conn()
     cursor = conn.cursor("weak")
 
-    existing_by_uid = await cursor.execute(
-        "SELECT original_sha512 FROM image_files WHERE uid=?", (file.uid,)
+    uid_placeholders = ", ".join("?" for _ in uids) if uids else "NULL"
+    sha512_placeholders = ", ".join("?" for _ in sha512s) if sha512s else "NULL"
+    response = await cursor.execute(
+        "SELECT uid, original_sha512 FROM image_files "
+        f"WHERE uid IN ({uid_placeholders}) OR original_sha512 IN ({sha512_placeholders})",
+        (*uids, *sha512s),
     )
 
-    if existing_by_uid.results:
-        previous_sha512 = existing_by_uid.results[0][0]
-        if previous_sha512 == sha512:
-            print(f"No change in {file.source=} for {file.uid=}")
-            if not force:
-                print("  skipping")
-                return
-            else:
-                print("  but update was forced")
-        else:
-            print(f"Detected change in {file.source=} for {file.uid=}...")
+    requested_uids = set(uids)
+    requested_sha512s = set(sha512s)
+    for uid, original_sha512 in response.results or []:
+        if uid in requested_uids:
+            result.sha512_by_uid[uid] = original_sha512
+        if original_sha512 in requested_sha512s:
+            result.uid_by_sha512.setdefault(original_sha512, uid)
+
+    return result
+
+
+async def ensure_file_exists(
+    itgs: Itgs, local: LocalServerImageFile, *, replace: bool
+) -> None:
+    """Uploads the given file and generates its exports. If replace is True,
+    the existing image file with the same uid is deleted first.
 
-        print("  deleting old exports..")
+    The caller is responsible for determining that this file actually needs
+    processing, see `fetch_existing_image_files`
+    """
+    file = local.file
+    ext = os.path.splitext(file.source)[1]
+
+    if replace:
+        print(f"Deleting old exports for {file.uid=}..")
         jobs = await itgs.jobs()
+        job_waiter = await itgs.job_waiter()
         job_uid = secrets.token_urlsafe(16)
-        job_done_task = asyncio.create_task(wait_job_done(itgs, job_uid, 120))
+        job_waiter.register(job_uid)
         await jobs.enqueue(
             "runners.delete_image_file", uid=file.uid, job_uid=job_uid, force=True
         )
-        await job_done_task
+        await job_waiter.wait(job_uid, timeout=120)
         print("  done")
-    else:
-        existing_by_sha512 = await cursor.execute(
-            "SELECT uid, original_sha512 FROM image_files WHERE original_sha512=?",
-            (sha512,),
-        )
-
-        if existing_by_sha512.results:
-            print(f"{file.source=} is already in use for something else, ignoring")
-            raise Exception(
-                f"cannot reuse an image file with a different uid ({file.source=}); "
-                "if you have a legitimate reason for this, add a comment to the file "
-                f"to get a different hash; {sha512=}"
-            )
 
+    conn = await itgs.conn()
+    cursor = conn.cursor("weak")
     files = await itgs.files()
     s3_uid = f"oseh_s3f_{secrets.token_urlsafe(16)}"
     s3_key = f"s3_files/images/exports/{file.uid}/{secrets.token_urlsafe(8)}{ext}"
@@ -319,7 +409,7 @@ async def ensure_file_exists(itgs: Itgs, file: ServerImageFile, force: bool = Fa
         )
         VALUES (?, ?, ?, ?, ?)
         """,
-        (s3_uid, s3_key, file_size, f"images/{ext}", time.time()),
+        (s3_uid, s3_key, local.file_size, f"images/{ext}", time.time()),
     )
 
     print(f"Uploading {file.source=} to {s3_key}...")
@@ -327,10 +417,10 @@ async def ensure_file_exists(itgs: Itgs, file: ServerImageFile, force: bool = Fa
         await files.upload(f, bucket=files.default_bucket, key=s3_key, sync=True)
 
     print(f"Queuing job for {file.source=}...")
-    job_uid = secrets.token_urlsafe(16)
-    job_done_task = asyncio.create_task(wait_job_done(itgs, job_uid, 120))
-
     jobs = await itgs.jobs()
+    job_waiter = await itgs.job_waiter()
+    job_uid = secrets.token_urlsafe(16)
+    job_waiter.register(job_uid)
     await jobs.enqueue(
         "runners.generate_server_image",
         file_uid=file.uid,
@@ -342,14 +432,17 @@ async def ensure_file_exists(itgs: Itgs, file: ServerImageFile, force: bool = Fa
         focal_point=file.focal_point,
     )
 
-    await job_done_task
+    await job_waiter.wait(job_uid, timeout=120)
     print(f"Finished processing {file.source=}")
 
 
-async def delete_file(itgs: Itgs, file: ServerImageFile):
-    print(f"Deleting {file.uid=} ({file.name=}) which is no longer needed")
+async def delete_files(itgs: Itgs, files: List[ServerImageFile]):
+    for file in files:
+        print(f"Deleting {file.uid=} ({file.name=}) which is no longer needed")
     jobs = await itgs.jobs()
-    await jobs.enqueue("runners.delete_image_file", uid=file.uid)
+    await jobs.enqueue_many(
+        ("runners.delete_image_file", {"uid": file.uid}) for file in files
+    )
 
 
 async def hash_content(local_filepath: str) -> str:
@@ -364,19 +457,5 @@ async def hash_content(local_filepath: str) -> str:
     return sha512.hexdigest()
 
 
-async def wait_job_done(itgs: Itgs, job_uid: str, timeout: float) -> None:
-    redis = await itgs.redis()
-    pubsub = redis.pubsub()
-    await pubsub.subscribe(f"ps:job:{job_uid}")
-
-    timeout_at = time.time() + timeout
-    while (await pubsub.get_message(ignore_subscribe_messages=True, timeout=5)) is None:
-        if time.time() > timeout_at:
-            await pubsub.aclose()
-            raise Exception(f"timed out waiting for {job_uid=} to finish")
-
-    await pubsub.aclose()
-
-
 if __name__ == "__main__":
     asyncio.run(main())
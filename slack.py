@@ -1,4 +1,7 @@
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
+from dataclasses import dataclass
+from loguru import logger
+import asyncio
 import aiohttp
 import os
 
@@ -115,3 +118,251 @@ class Slack:
         await self.send_message(
             os.environ.get("SLACK_OPS_URL"), message, preview, markdown
         )
+
+    async def send_oseh_bot_blocks(self, blocks: list, preview: str) -> None:
+        """sends the given blocks to the oseh-bot channel
+
+        Args:
+            blocks (list): see https://api.slack.com/messaging/webhooks#advanced_message_formatting
+            preview (str): the text for notifications
+        """
+
+        await self.send_blocks(os.environ.get("SLACK_OSEH_BOT_URL"), blocks, preview)
+
+    async def send_oseh_bot_message(
+        self, message: str, preview: Optional[str] = None, markdown: bool = True
+    ) -> None:
+        """sends the given markdown text to the oseh-bot channel
+
+        Args:
+            message (str): the markdown formatted message to send
+            preview (str, None): the text for notifications or None to use the message
+            markdown (bool): True for markdown format, False for raw text
+        """
+
+        await self.send_message(
+            os.environ.get("SLACK_OSEH_BOT_URL"), message, preview, markdown
+        )
+
+
+@dataclass
+class _QueuedMessage:
+    url: str
+    """the incoming webhook url"""
+    message: str
+    """the markdown formatted message"""
+    preview: str
+    """the text for notifications"""
+    repeats: int
+    """how many additional times this exact message was enqueued while it was pending"""
+
+
+class SlackDispatcher:
+    """Sends slack messages from a background task using a single long-lived
+    session, so that the callers only have to enqueue. Identical messages which
+    are enqueued while the first is still pending are coalesced, and messages
+    which arrive within `batch_window` seconds of each other are sent to the same
+    channel as a single payload. If the queue is full, messages are dropped and
+    counted rather than blocking the caller.
+
+    Generally there is one dispatcher per process, started with `start_dispatcher`
+    and retrieved with `get_dispatcher`.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_queue_size: int = 100,
+        batch_window: float = 2,
+        max_batch_size: int = 10,
+    ) -> None:
+        self.max_queue_size = max_queue_size
+        """the maximum number of distinct messages waiting to be sent"""
+
+        self.batch_window = batch_window
+        """how long in seconds to wait for more messages after the first before sending"""
+
+        self.max_batch_size = max_batch_size
+        """the maximum number of messages to combine into a single payload"""
+
+        self.dropped: int = 0
+        """how many messages were dropped because the queue was full"""
+
+        self.coalesced: int = 0
+        """how many messages were merged into an identical pending message"""
+
+        self._queue: Optional[asyncio.Queue] = None
+        """the messages waiting to be sent, if we have been started"""
+
+        self._pending: Dict[Tuple[str, str], _QueuedMessage] = dict()
+        """the messages which have been enqueued but not yet sent, by url and message"""
+
+        self._slack: Optional[Slack] = None
+        """the slack connection, if we have been started"""
+
+        self._task: Optional[asyncio.Task] = None
+        """the background task sending messages, if we have been started"""
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        """the event loop we were started on"""
+
+    async def start(self) -> None:
+        """starts the background task; must be called from the event loop that
+        will be enqueueing messages
+        """
+        assert self._task is None, "already started"
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(self.max_queue_size)
+        self._slack = Slack()
+        await self._slack.__aenter__()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 5) -> None:
+        """waits up to timeout seconds for queued messages to be sent, then
+        stops the background task and closes the session
+        """
+        if self._task is None:
+            return
+
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"slack dispatcher stopping with {self._queue.qsize()} unsent messages"
+            )
+
+        task = self._task
+        self._task = None
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+        sl = self._slack
+        self._slack = None
+        await sl.__aexit__(None, None, None)
+        self._loop = None
+
+    def enqueue(self, url: str, message: str, preview: Optional[str] = None) -> bool:
+        """queues the given markdown message to be sent to the given incoming webhook
+        url, without waiting for it to be sent
+
+        Returns:
+            bool: True if the message was queued or coalesced or dropped, False if the
+                dispatcher can't be used from here (not running, or on a different
+                event loop) and the caller should send the message itself
+        """
+        if self._task is None or self._task.done():
+            return False
+
+        try:
+            if asyncio.get_running_loop() is not self._loop:
+                return False
+        except RuntimeError:
+            return False
+
+        key = (url, message)
+        existing = self._pending.get(key)
+        if existing is not None:
+            existing.repeats += 1
+            self.coalesced += 1
+            return True
+
+        queued = _QueuedMessage(
+            url=url,
+            message=message,
+            preview=preview if preview is not None else message,
+            repeats=0,
+        )
+        try:
+            self._queue.put_nowait(queued)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning(
+                f"slack dispatcher queue full, dropped message ({self.dropped} dropped total)"
+            )
+            return True
+
+        self._pending[key] = queued
+        return True
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch: List[_QueuedMessage] = [await self._queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(
+                        await asyncio.wait_for(self._queue.get(), timeout=remaining)
+                    )
+                except asyncio.TimeoutError:
+                    break
+
+            # once rendered, duplicates must start a new message to be counted
+            for queued in batch:
+                key = (queued.url, queued.message)
+                if self._pending.get(key) is queued:
+                    del self._pending[key]
+
+            by_url: Dict[str, List[_QueuedMessage]] = dict()
+            for queued in batch:
+                by_url.setdefault(queued.url, []).append(queued)
+
+            for url, messages in by_url.items():
+                try:
+                    await self._send_batch(url, messages)
+                except Exception:
+                    logger.exception("slack dispatcher failed to send batch")
+
+            for _ in batch:
+                self._queue.task_done()
+
+    async def _send_batch(self, url: str, messages: List[_QueuedMessage]) -> None:
+        blocks = []
+        for idx, queued in enumerate(messages):
+            if idx > 0:
+                blocks.append({"type": "divider"})
+            text = queued.message
+            if queued.repeats > 0:
+                text += f"\n\n_(repeated {queued.repeats} more time{'s' if queued.repeats != 1 else ''})_"
+            blocks.append({"type": "section", "text": {"type": "mrkdwn", "text": text}})
+
+        preview = messages[0].preview
+        if len(messages) > 1:
+            preview += f" (+{len(messages) - 1} more)"
+        await self._slack.send_blocks(url, blocks, preview)
+
+
+_dispatcher: Optional[SlackDispatcher] = None
+"""the process-wide slack dispatcher, if it has been started"""
+
+
+async def start_dispatcher() -> SlackDispatcher:
+    """starts the process-wide slack dispatcher, if it's not already running"""
+    global _dispatcher
+
+    if _dispatcher is None:
+        dispatcher = SlackDispatcher()
+        await dispatcher.start()
+        _dispatcher = dispatcher
+    return _dispatcher
+
+
+async def stop_dispatcher() -> None:
+    """flushes and stops the process-wide slack dispatcher, if it's running"""
+    global _dispatcher
+
+    dispatcher = _dispatcher
+    _dispatcher = None
+    if dispatcher is not None:
+        await dispatcher.stop()
+
+
+def get_dispatcher() -> Optional[SlackDispatcher]:
+    """returns the process-wide slack dispatcher, if it has been started"""
+    return _dispatcher
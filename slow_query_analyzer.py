@@ -0,0 +1,304 @@
+"""Handles slow queries reported by rqdb. Rather than opening new integrations
+for every slow query, a single per-process analyzer groups queries by their
+shape (the query with literals and parameter lists normalized away), keeps
+rolling latency stats for each shape, and explains each shape at most once
+using one long-lived rqlite connection.
+
+Usage is via `get_analyzer().on_slow_query(...)`, which is suitable as the
+rqdb slow query log method. `report_forever()` posts the slowest shapes to
+slack periodically, whenever there were new slow queries.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import socket
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, List, Optional, Tuple
+import rqdb
+import rqdb.async_connection
+import rqdb.logging
+from loguru import logger
+from error_middleware import handle_warning, send_slack_message
+
+
+MAX_TRACKED_SHAPES = 256
+"""The maximum number of query shapes we keep stats and plans for; the least
+recently seen shapes are forgotten first
+"""
+
+RECENT_DURATIONS_PER_SHAPE = 128
+"""How many of the most recent durations we keep for each shape for percentiles"""
+
+MAX_QUEUED_EXPLAINS = 32
+"""The maximum number of shapes waiting to be explained; more are dropped"""
+
+REPORT_INTERVAL_SECONDS = 60 * 60 * 6
+"""How often the report of the slowest query shapes is posted to slack"""
+
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PARAMETER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """Normalizes the given query such that queries which differ only in their
+    literals, whitespace, or the length of parameter lists (e.g., `IN (?, ?)`)
+    are the same
+    """
+    result = _STRING_LITERAL.sub("?", query)
+    result = _NUMBER_LITERAL.sub("?", result)
+    result = _WHITESPACE.sub(" ", result).strip().lower()
+    return _PARAMETER_LIST.sub("(?...)", result)
+
+
+def fingerprint_query(query: str) -> Tuple[str, str]:
+    """Returns the fingerprint and normalized form of the given query"""
+    normalized = normalize_query(query)
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()[:16], normalized
+
+
+@dataclass
+class QueryShapeStats:
+    fingerprint: str
+    """the fingerprint of the normalized query"""
+    normalized: str
+    """the normalized query"""
+    count: int = 0
+    """how many times a query of this shape was slow"""
+    total_seconds: float = 0
+    """the total time spent in slow queries of this shape"""
+    max_seconds: float = 0
+    """the slowest query of this shape"""
+    last_seen_at: float = 0
+    """when we last saw a slow query of this shape"""
+    recent_seconds: deque = field(
+        default_factory=lambda: deque(maxlen=RECENT_DURATIONS_PER_SHAPE)
+    )
+    """the durations of the most recent slow queries of this shape"""
+    plan: Optional[str] = None
+    """the explained query plan, once it's available"""
+
+    def percentile(self, p: float) -> float:
+        """Returns the given percentile (0-1) of the recent durations"""
+        if not self.recent_seconds:
+            return 0
+        ordered = sorted(self.recent_seconds)
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+@dataclass
+class _PendingExplain:
+    stats: QueryShapeStats
+    """the shape to explain"""
+    query: str
+    """an example of the query, as it was sent"""
+    params: List[Any]
+    """the parameters for the example query"""
+    host: str
+    """the host the example query was sent to"""
+    duration_seconds: float
+    """how long the example query took"""
+    response_size_bytes: int
+    """how large the response to the example query was"""
+
+
+class SlowQueryAnalyzer:
+    """Collects slow queries by shape and explains each new shape once in the
+    background. Must only be used from the event loop it was created on.
+    """
+
+    def __init__(self) -> None:
+        self.shapes: "OrderedDict[str, QueryShapeStats]" = OrderedDict()
+        """the stats for each shape by fingerprint, least recently seen first"""
+
+        self.dropped: int = 0
+        """how many explains were skipped because too many were queued"""
+
+        self.total_count: int = 0
+        """how many slow queries were recorded, including forgotten shapes"""
+
+        self._reported_count: int = 0
+        """the total_count as of the last report"""
+
+        self._queue: asyncio.Queue = asyncio.Queue(MAX_QUEUED_EXPLAINS)
+        """the shapes waiting to be explained"""
+
+        self._worker: Optional[asyncio.Task] = None
+        """the task explaining shapes, once started"""
+
+        self._conn: Optional[rqdb.async_connection.AsyncConnection] = None
+        """the rqlite connection used for explaining, once opened"""
+
+    def on_slow_query(
+        self,
+        info: rqdb.logging.QueryInfo,
+        /,
+        *,
+        duration_seconds: float,
+        host: str,
+        response_size_bytes: int,
+        started_at: float,
+        ended_at: float,
+    ) -> None:
+        """Records the given slow query; matches the signature expected by the
+        rqdb slow query log method
+        """
+        now = time.time()
+        for op, params in zip(info.operations, info.params):
+            fingerprint, normalized = fingerprint_query(op)
+            stats = self.shapes.get(fingerprint)
+            is_new = stats is None
+            if is_new:
+                stats = QueryShapeStats(fingerprint=fingerprint, normalized=normalized)
+                self.shapes[fingerprint] = stats
+                while len(self.shapes) > MAX_TRACKED_SHAPES:
+                    self.shapes.popitem(last=False)
+            else:
+                self.shapes.move_to_end(fingerprint)
+
+            self.total_count += 1
+            stats.count += 1
+            stats.total_seconds += duration_seconds
+            stats.max_seconds = max(stats.max_seconds, duration_seconds)
+            stats.last_seen_at = now
+            stats.recent_seconds.append(duration_seconds)
+
+            if not is_new:
+                continue
+
+            try:
+                self._queue.put_nowait(
+                    _PendingExplain(
+                        stats=stats,
+                        query=op,
+                        params=list(params),
+                        host=host,
+                        duration_seconds=duration_seconds,
+                        response_size_bytes=response_size_bytes,
+                    )
+                )
+            except asyncio.QueueFull:
+                self.dropped += 1
+                continue
+
+            if self._worker is None or self._worker.done():
+                self._worker = asyncio.create_task(self._explain_forever())
+
+    async def _explain_forever(self) -> None:
+        while True:
+            pending: _PendingExplain = await self._queue.get()
+            try:
+                await self._explain(pending)
+            except Exception:
+                logger.exception("Failed to explain slow query")
+
+    async def _explain(self, pending: _PendingExplain) -> None:
+        stats = pending.stats
+        pretty_query = f"query: {pending.query}\nargs: {json.dumps(pending.params)}\n"
+        if not await handle_warning(
+            "backend:slow_query",
+            f"new slow query shape `{stats.fingerprint}`: query to {pending.host} took "
+            f"{pending.duration_seconds:.3f}s to return {pending.response_size_bytes} bytes:"
+            f"\n\n```\n{pretty_query}\n```",
+        ):
+            return
+
+        conn = await self._get_conn()
+        cursor = conn.cursor("none")
+        stats.plan = await cursor.explain(pending.query, pending.params, out="str")
+        await send_slack_message(
+            "web_errors",
+            f"Slow query `{stats.fingerprint}` to {pending.host} explain query plan:"
+            f"\n```\n{pretty_query}{stats.plan}\n```",
+            f"Slow query {stats.fingerprint} explain query plan",
+        )
+
+    async def _get_conn(self) -> rqdb.async_connection.AsyncConnection:
+        if self._conn is not None:
+            return self._conn
+
+        rqlite_ips = os.environ["RQLITE_IPS"].split(",")
+        if not rqlite_ips:
+            raise ValueError("RQLITE_IPS not set -> cannot connect to rqlite")
+
+        # slow explains must not be reported as slow queries
+        c = rqdb.connect_async(
+            hosts=rqlite_ips, log=rqdb.LogConfig(slow_query={"enabled": False})
+        )
+        await c.__aenter__()
+        self._conn = c
+        return c
+
+    def format_report(self, limit: int = 10) -> str:
+        """Formats the query shapes which have taken the most total time as markdown"""
+        if not self.shapes:
+            return "No slow queries recorded"
+
+        ordered = sorted(
+            self.shapes.values(), key=lambda s: s.total_seconds, reverse=True
+        )
+        lines = [
+            f"Slow query shapes ({len(self.shapes)} tracked, {self.dropped} explains dropped):",
+            "```",
+        ]
+        for stats in ordered[:limit]:
+            lines.append(
+                f"{stats.fingerprint}: count={stats.count} total={stats.total_seconds:.3f}s "
+                f"mean={stats.total_seconds / stats.count:.3f}s p50={stats.percentile(0.5):.3f}s "
+                f"p95={stats.percentile(0.95):.3f}s max={stats.max_seconds:.3f}s"
+            )
+            lines.append(f"  {stats.normalized}")
+        lines.append("```")
+        return "\n".join(lines)
+
+    async def send_report(self) -> None:
+        """Logs the report and posts it to slack, unless there were no slow
+        queries since the last report
+        """
+        if self.total_count == self._reported_count:
+            return
+
+        new_count = self.total_count - self._reported_count
+        self._reported_count = self.total_count
+        report = self.format_report()
+        logger.info(f"{new_count} new slow queries; {report}")
+        await send_slack_message(
+            "web_errors",
+            f"{socket.gethostname()} - pid {os.getpid()}: {new_count} new slow queries\n\n{report}",
+            f"{new_count} new slow queries",
+        )
+
+
+_analyzer: Optional[SlowQueryAnalyzer] = None
+"""the analyzer for the current process"""
+
+_analyzer_loop: Optional[asyncio.AbstractEventLoop] = None
+"""the event loop the analyzer was created on"""
+
+
+def get_analyzer() -> SlowQueryAnalyzer:
+    """Gets or creates the slow query analyzer for the running event loop"""
+    global _analyzer, _analyzer_loop
+
+    loop = asyncio.get_running_loop()
+    if _analyzer is None or _analyzer_loop is not loop:
+        _analyzer = SlowQueryAnalyzer()
+        _analyzer_loop = loop
+    return _analyzer
+
+
+async def report_forever() -> None:
+    """Sends the slow query report for this process periodically"""
+    while True:
+        await asyncio.sleep(REPORT_INTERVAL_SECONDS)
+        try:
+            await get_analyzer().send_report()
+        except Exception:
+            logger.exception("Failed to send slow query report")
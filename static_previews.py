@@ -0,0 +1,192 @@
+"""Preview pages whose content depends only on the build, e.g., /favorites, are
+rendered once per build into files alongside gzip (and, if the brotli package
+is installed, brotli) compressed siblings. Routes serve those files directly,
+leaving runtime rendering for pages which are genuinely dynamic.
+
+The files are stored under `tmp/static_previews/<index.html hash>/`, so a new
+build can never be served stale previews. They are built when the server
+starts, which happens after every update.
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import os
+import secrets
+import shutil
+from dataclasses import dataclass
+from typing import Dict, Optional
+import anyio
+from fastapi.responses import FileResponse
+from loguru import logger
+from lib.index_html import IndexHtmlTemplate
+import routes.journey_public_links
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+@dataclass(frozen=True)
+class StaticPreview:
+    meta: Dict[str, str]
+    """the content for the meta tags to replace, by property or name"""
+    title: str
+    """the title of the page"""
+
+
+STATIC_PREVIEWS: Dict[str, StaticPreview] = {
+    "favorites": StaticPreview(
+        meta={
+            "og:title": "Oseh: Favorites",
+            "og:description": "View your history and your favorite classes on Oseh",
+        },
+        title="Oseh: Favorites",
+    ),
+    "example": StaticPreview(
+        meta={
+            "og:title": "Oseh: Example Link",
+            "og:description": "Look at this custom description!",
+        },
+        title="Oseh: Example Link",
+    ),
+    "unsubscribe": StaticPreview(
+        meta={
+            "og:title": "Oseh: Unsubscribe",
+            "og:description": "Unsubscribe from this list",
+        },
+        title="Oseh: Unsubscribe",
+    ),
+}
+"""The previews which are rendered at build time, by name"""
+
+PREVIEWS_ROOT = os.path.join("tmp", "static_previews")
+"""The folder containing one folder of previews per build"""
+
+_current_dir: Optional[str] = None
+"""The folder containing the previews for the current build, once built"""
+
+_current_manifest: Dict[str, Dict[str, str]] = dict()
+"""The file names within _current_dir for each preview by content encoding"""
+
+
+def build_static_previews(index_html_path: str, out_root: str = PREVIEWS_ROOT) -> str:
+    """Renders every static preview for the index.html at the given path into
+    a folder within out_root named after the hash of the index.html, unless
+    that folder already exists. The folder is populated atomically, so this is
+    safe to call from multiple processes at once.
+
+    Returns:
+        str: the folder containing the previews
+    """
+    with open(index_html_path, "rb") as f:
+        index_html = f.read()
+
+    build_hash = hashlib.sha256(index_html).hexdigest()[:16]
+    out_dir = os.path.join(out_root, build_hash)
+    if os.path.exists(os.path.join(out_dir, "manifest.json")):
+        return out_dir
+
+    os.makedirs(out_root, exist_ok=True)
+    tmp_dir = os.path.join(out_root, f".tmp-{secrets.token_hex(8)}")
+    os.makedirs(tmp_dir)
+    try:
+        template = IndexHtmlTemplate(io.BytesIO(index_html))
+        manifest: Dict[str, Dict[str, str]] = dict()
+        for name, preview in STATIC_PREVIEWS.items():
+            rendered = template.render(preview.meta, preview.title)
+
+            files = {"identity": f"{name}.html", "gzip": f"{name}.html.gz"}
+            with open(os.path.join(tmp_dir, files["identity"]), "wb") as f:
+                f.write(rendered)
+            with open(os.path.join(tmp_dir, files["gzip"]), "wb") as f:
+                f.write(gzip.compress(rendered, compresslevel=9, mtime=0))
+            if brotli is not None:
+                files["br"] = f"{name}.html.br"
+                with open(os.path.join(tmp_dir, files["br"]), "wb") as f:
+                    f.write(brotli.compress(rendered, quality=11))
+            manifest[name] = files
+
+        with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+
+        try:
+            os.rename(tmp_dir, out_dir)
+        except OSError:
+            # another process finished first; theirs is equivalent
+            if not os.path.exists(os.path.join(out_dir, "manifest.json")):
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return out_dir
+
+
+def _remove_other_builds(keep_dir: str, out_root: str = PREVIEWS_ROOT) -> None:
+    keep_name = os.path.basename(keep_dir)
+    for name in os.listdir(out_root):
+        if name != keep_name and not name.startswith(".tmp-"):
+            shutil.rmtree(os.path.join(out_root, name), ignore_errors=True)
+
+
+async def ensure_built() -> None:
+    """Builds the static previews for the current index.html, if they haven't
+    been built already, and serves them from now on. When index.html is
+    fetched from nginx, as it may be in development, previews are rendered at
+    runtime instead.
+    """
+    global _current_dir, _current_manifest
+
+    if routes.journey_public_links.use_fetch_for_index_html:
+        return
+
+    index_html_path = routes.journey_public_links.base_index_html
+    try:
+        out_dir = await anyio.to_thread.run_sync(build_static_previews, index_html_path)
+        await anyio.to_thread.run_sync(_remove_other_builds, out_dir)
+        with open(os.path.join(out_dir, "manifest.json")) as f:
+            manifest = json.load(f)
+    except Exception:
+        logger.exception("Failed to build static previews; rendering at runtime")
+        return
+
+    _current_dir = out_dir
+    _current_manifest = manifest
+    logger.info(f"Serving static previews from {out_dir}")
+
+
+_ENCODINGS = ("br", "gzip")
+"""the content encodings we may serve, most preferred first"""
+
+
+def get_static_preview_response(
+    name: str, accept_encoding: Optional[str]
+) -> Optional[FileResponse]:
+    """Returns the response for the static preview with the given name, using
+    the best available encoding accepted by the client, or None if the static
+    previews have not been built, in which case the caller should render it
+    """
+    files = _current_manifest.get(name)
+    if _current_dir is None or files is None:
+        return None
+
+    accepted = (
+        set(e.split(";")[0].strip() for e in accept_encoding.split(","))
+        if accept_encoding
+        else set()
+    )
+    for encoding in _ENCODINGS:
+        if encoding in accepted and encoding in files:
+            return FileResponse(
+                os.path.join(_current_dir, files[encoding]),
+                media_type="text/html",
+                headers={"Content-Encoding": encoding, "Vary": "Accept-Encoding"},
+            )
+
+    return FileResponse(
+        os.path.join(_current_dir, files["identity"]),
+        media_type="text/html",
+        headers={"Vary": "Accept-Encoding"},
+    )
@@ -0,0 +1,326 @@
+"""Lightweight request tracing. Integrations handed out by `Itgs` are wrapped
+with `traced`, which times each call into a span on the current request's
+trace (if there is one). The `TracingMiddleware` starts a trace for each
+request, emits a `Server-Timing` header summarizing it, and folds the totals
+into the per-route latency histograms in `metrics`.
+
+Outside of a request (e.g., in scripts or background tasks) there is no trace
+and the wrappers just call through, so the overhead is a single context
+variable lookup per call.
+"""
+
+import inspect
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterator,
+    List,
+    Optional,
+    TypeVar,
+)
+from loguru import logger
+import metrics
+
+
+MAX_SPANS_PER_TRACE = 256
+"""The maximum number of spans we keep in the tree for a single request. Spans
+past this are still included in the totals, but not in the tree
+"""
+
+SLOW_REQUEST_SECONDS = 1.0
+"""Requests which take at least this long have their span tree logged"""
+
+
+@dataclass
+class Span:
+    name: str
+    """what this span is timing, e.g., `rqlite` or `redis`"""
+    started_at: float
+    """time.perf_counter() when the span started"""
+    ended_at: Optional[float] = None
+    """time.perf_counter() when the span ended, if it has ended"""
+    children: List["Span"] = field(default_factory=list)
+    """the spans started while this span was the innermost active span"""
+
+    @property
+    def duration_seconds(self) -> float:
+        """how long this span took, or has taken so far"""
+        end = self.ended_at if self.ended_at is not None else time.perf_counter()
+        return end - self.started_at
+
+
+@dataclass
+class SpanTotals:
+    count: int = 0
+    """how many spans with this name ended"""
+    seconds: float = 0
+    """the total duration of the spans with this name"""
+
+
+class Trace:
+    """The spans for a single request"""
+
+    def __init__(self) -> None:
+        self.started_at: float = time.perf_counter()
+        """time.perf_counter() when the request started"""
+
+        self.roots: List[Span] = []
+        """the spans started while no other span was active"""
+
+        self.totals: Dict[str, SpanTotals] = dict()
+        """the totals for each span name, including spans not kept in the tree"""
+
+        self.num_spans: int = 0
+        """how many spans are in the tree"""
+
+        self.dropped: int = 0
+        """how many spans were not kept in the tree due to MAX_SPANS_PER_TRACE"""
+
+    def start(self, name: str, parent: Optional[Span]) -> Span:
+        """Starts a new span with the given name under the given parent"""
+        span = Span(name=name, started_at=time.perf_counter())
+        if self.num_spans >= MAX_SPANS_PER_TRACE:
+            self.dropped += 1
+            return span
+
+        self.num_spans += 1
+        if parent is None:
+            self.roots.append(span)
+        else:
+            parent.children.append(span)
+        return span
+
+    def end(self, span: Span) -> None:
+        """Ends the given span, adding it to the totals"""
+        span.ended_at = time.perf_counter()
+        totals = self.totals.get(span.name)
+        if totals is None:
+            totals = SpanTotals()
+            self.totals[span.name] = totals
+        totals.count += 1
+        totals.seconds += span.ended_at - span.started_at
+
+    def server_timing(self) -> str:
+        """Formats the totals of this trace as a Server-Timing header value"""
+        parts = [
+            f'{name};dur={totals.seconds * 1000:.1f};desc="{totals.count}x"'
+            for name, totals in self.totals.items()
+        ]
+        parts.append(f"total;dur={(time.perf_counter() - self.started_at) * 1000:.1f}")
+        return ", ".join(parts)
+
+    def format_tree(self) -> str:
+        """Formats the span tree of this trace, one span per line"""
+        lines: List[str] = []
+
+        def _visit(span: Span, depth: int) -> None:
+            offset_ms = (span.started_at - self.started_at) * 1000
+            lines.append(
+                f"{'  ' * depth}{span.name} +{offset_ms:.1f}ms {span.duration_seconds * 1000:.1f}ms"
+            )
+            for child in span.children:
+                _visit(child, depth + 1)
+
+        for root in self.roots:
+            _visit(root, 0)
+        if self.dropped:
+            lines.append(f"({self.dropped} more spans not shown)")
+        return "\n".join(lines)
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar(
+    "tracing_current_trace", default=None
+)
+"""the trace for the request being handled, if any"""
+
+_current_span: ContextVar[Optional[Span]] = ContextVar(
+    "tracing_current_span", default=None
+)
+"""the innermost active span within the current trace, if any"""
+
+
+def current_trace() -> Optional[Trace]:
+    """Returns the trace for the request being handled, if any"""
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Times the body of the with statement as a span with the given name on
+    the current trace, if there is one. Works in both sync and async code.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    s = trace.start(name, _current_span.get())
+    token = _current_span.set(s)
+    try:
+        yield
+    finally:
+        _current_span.reset(token)
+        trace.end(s)
+
+
+def observe_route(route: str, name: str, seconds: float) -> None:
+    """Records that a request to the given route spent the given amount of time
+    in spans with the given name
+    """
+    metrics.REQUEST_SPAN_SECONDS.labels(route, name).observe(seconds)
+
+
+T = TypeVar("T")
+
+
+class _TracedProxy:
+    """Forwards attribute access to the target, timing calls as spans"""
+
+    def __init__(
+        self,
+        target: Any,
+        name: str,
+        *,
+        time_sync: bool,
+        wrap_results: FrozenSet[str],
+    ) -> None:
+        self._tracing_target = target
+        self._tracing_name = name
+        self._tracing_time_sync = time_sync
+        self._tracing_wrap_results = wrap_results
+
+    def __getattr__(self, attr: str) -> Any:
+        value = getattr(self._tracing_target, attr)
+        if not callable(value):
+            return value
+
+        wrapper = _timed(
+            value,
+            self._tracing_name,
+            time_sync=self._tracing_time_sync,
+            wrap_result=attr in self._tracing_wrap_results,
+        )
+        # cache so that later lookups skip __getattr__ entirely
+        self.__dict__[attr] = wrapper
+        return wrapper
+
+    def __repr__(self) -> str:
+        return f"traced({self._tracing_target!r}, {self._tracing_name!r})"
+
+
+def _timed(
+    fn: Callable[..., Any], name: str, *, time_sync: bool, wrap_result: bool
+) -> Callable[..., Any]:
+    async def _timed_await(trace: Trace, awaitable: Awaitable[Any]) -> Any:
+        s = trace.start(name, _current_span.get())
+        token = _current_span.set(s)
+        try:
+            return await awaitable
+        finally:
+            _current_span.reset(token)
+            trace.end(s)
+
+    def wrapper(*args, **kwargs) -> Any:
+        trace = _current_trace.get()
+        if trace is None or not time_sync:
+            result = fn(*args, **kwargs)
+            if trace is not None and inspect.isawaitable(result):
+                return _timed_await(trace, result)
+        else:
+            s = trace.start(name, _current_span.get())
+            token = _current_span.set(s)
+            try:
+                result = fn(*args, **kwargs)
+            finally:
+                _current_span.reset(token)
+                trace.end(s)
+
+        if wrap_result:
+            return _TracedProxy(
+                result, name, time_sync=time_sync, wrap_results=frozenset()
+            )
+        return result
+
+    return wrapper
+
+
+def traced(
+    target: T,
+    name: str,
+    *,
+    time_sync: bool = False,
+    wrap_results: FrozenSet[str] = frozenset(),
+) -> T:
+    """Wraps the given integration such that calls made on it while handling a
+    request are timed as spans with the given name.
+
+    Args:
+        target (T): The integration to wrap
+        name (str): The span name, e.g., `rqlite`. Should be a valid
+            Server-Timing metric name.
+        time_sync (bool): If True, synchronous calls are timed as well, which
+            is appropriate for blocking integrations like diskcache. If False,
+            only calls which return awaitables are timed.
+        wrap_results (FrozenSet[str]): The names of methods whose return
+            values should be wrapped as well, e.g., `cursor` for rqlite. Their
+            calls use the same span name.
+
+    Returns:
+        T: The wrapped integration. This is a proxy, not a T, so it must not
+            be used with `async with` or `isinstance`
+    """
+    return _TracedProxy(target, name, time_sync=time_sync, wrap_results=wrap_results)  # type: ignore
+
+
+class TracingMiddleware:
+    """ASGI middleware which traces each http request, adds a Server-Timing
+    header to the response, and records the per-route request metrics
+    """
+
+    def __init__(self, app: Callable[..., Awaitable[None]]) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace()
+        token = _current_trace.set(trace)
+        status = "500"
+
+        async def _send(message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+                headers = list(message.get("headers", []))
+                headers.append(
+                    (b"server-timing", trace.server_timing().encode("latin-1"))
+                )
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            _current_trace.reset(token)
+            elapsed = time.perf_counter() - trace.started_at
+            endpoint = scope.get("endpoint")
+            route = getattr(endpoint, "__name__", "unmatched")
+            metrics.HTTP_REQUESTS.labels(route, status).inc()
+            observe_route(route, "total", elapsed)
+            for name, totals in trace.totals.items():
+                observe_route(route, name, totals.seconds)
+
+            if elapsed >= SLOW_REQUEST_SECONDS:
+                logger.info(
+                    f"Slow request to {scope.get('path')} ({route}) took {elapsed:.3f}s:\n"
+                    + trace.format_tree()
+                )
@@ -1,30 +1,36 @@
 """Triggers a build by spawning the appropriate EC2 instance, configuring it,
 uploading scripts/build/, /home/ec2-user/config.sh, and /home/ec2-user/repo.sh
-into /home/ec2-user/bootstrap/ then invoking /home/ec2-user/scripts/build/main.sh
+as a single compressed archive, extracting it into /usr/local/src/bootstrap/
+after verifying its checksum, then invoking main.sh within it
 
 This is a seperate file to allow for manually running this for testing purposes.
 Pass --dry-run to avoid actually spawning the instance
 """
 
 import asyncio
+import hashlib
 import json
 import secrets
 import time
-from typing import Awaitable, Callable, List
+from dataclasses import dataclass
+from typing import Awaitable, Callable, List, Optional, Tuple
 import aioboto3
 from error_middleware import handle_error
 from itgs import Itgs
+from jobs import JobWaiter
 import argparse
 import datetime
 import os
-from contextlib import asynccontextmanager
+from contextlib import AsyncExitStack, ExitStack, asynccontextmanager
 import paramiko
 import anyio
 import io
+import tarfile
 from temp_files import temp_file
+from build_stats import BuildRecord, recording
 from remote_executor import (
-    write_echo_commands_for_file,
-    write_echo_commands_for_folder,
+    build_tar_gz_bundle,
+    write_extract_commands,
     exec_simple,
 )
 from loguru import logger
@@ -33,6 +39,47 @@ import botocore.exceptions
 
 INSTANCE_TYPE = "c7g.2xlarge"
 
+BOOTSTRAP_BUNDLE_PATH = "/home/ec2-user/bootstrap.tar.gz"
+"""Where the bootstrap bundle is uploaded to on the build server"""
+
+CONFIG_SH_PATH = "/home/ec2-user/config.sh"
+"""The local config file which is included in the bootstrap bundle"""
+
+REPO_SH_PATH = "/home/ec2-user/repo.sh"
+"""The local repository setup file which is included in the bootstrap bundle"""
+
+POLL_INTERVAL_SECONDS = 5
+"""How long we wait between checks on the state of the build server"""
+
+
+@dataclass
+class ScriptPhase:
+    """A phase of the build script, as reported by timed_phase in
+    scripts/build/timing.sh
+    """
+
+    name: str
+    """the name of the phase, e.g., npm_install"""
+    seconds: float
+    """how long the phase took"""
+    exit_code: int
+    """the exit code of the phase"""
+
+
+def parse_script_phase(line: str) -> Optional[ScriptPhase]:
+    """Parses the given line of build script output as a ScriptPhase, if it
+    is one, otherwise returns None
+    """
+    parts = line.strip().split(" ")
+    if len(parts) != 4 or parts[0] != "BUILD_PHASE":
+        return None
+    try:
+        return ScriptPhase(
+            name=parts[1], seconds=int(parts[2]) / 1000, exit_code=int(parts[3])
+        )
+    except ValueError:
+        return None
+
 
 async def main():
     parser = argparse.ArgumentParser()
@@ -79,33 +126,60 @@ async def trigger_build(
     build_iam_instance_profile_name: str,
     backup_build_subnet_id: str,
     dry_run: bool,
+    session: Optional[aioboto3.Session] = None,
+    execute: Optional[Callable[..., List[ScriptPhase]]] = None,
 ) -> None:
+    """Runs a build, recording how long each phase took. The session used to
+    reach EC2 and the function used to run the script on the build server
+    (with the same signature as connect_and_execute) can be replaced, e.g.,
+    with fakes to exercise this locally.
+    """
     slack = await itgs.slack()
-    session = aioboto3.Session()
+    if session is None:
+        session = aioboto3.Session()
+    if execute is None:
+        execute = connect_and_execute
 
-    single_file_script = await anyio.to_thread.run_sync(generate_single_file_script)
+    bootstrap_bundle, bootstrap_sha256 = await anyio.to_thread.run_sync(
+        generate_bootstrap_bundle
+    )
+    single_file_script = generate_single_file_script(bootstrap_sha256)
     if dry_run:
+        logger.info(
+            f"Would have uploaded a {len(bootstrap_bundle)} byte bootstrap bundle "
+            f"(sha256 {bootstrap_sha256}) to {BOOTSTRAP_BUNDLE_PATH} containing:"
+        )
+        with tarfile.open(fileobj=io.BytesIO(bootstrap_bundle), mode="r:gz") as tar:
+            for member in tar.getmembers():
+                logger.info(f"  {member.name} ({member.size} bytes)")
         logger.info(f"Would have executed the following script:")
         logger.info(single_file_script)
         return
 
-    with temp_file(".pem") as key_file_path:
-        async with session.client("ec2") as client, cleanup_functions() as cleanup:
+    with ExitStack() as stack:
+        key_file_path = stack.enter_context(temp_file(".pem"))
+        stdout_path = stack.enter_context(temp_file())
+        stderr_path = stack.enter_context(temp_file())
+        async with AsyncExitStack() as async_stack:
+            record = await async_stack.enter_async_context(recording(itgs))
+            client = await async_stack.enter_async_context(session.client("ec2"))
+            cleanup = await async_stack.enter_async_context(cleanup_functions())
             logger.info("Generating key pair...")
             suggested_build_key_name = (
                 f"key-frontend-web-build-{secrets.token_urlsafe(6)}"
             )
-            response = await client.create_key_pair(
-                KeyName=suggested_build_key_name,
-                KeyType="rsa",
-                TagSpecifications=[
-                    {
-                        "ResourceType": "key-pair",
-                        "Tags": [{"Key": "Name", "Value": "frontend-web build"}],
-                    }
-                ],
-                KeyFormat="pem",
-            )
+            with record.phase("create_key_pair"):
+                response = await client.create_key_pair(
+                    KeyName=suggested_build_key_name,
+                    KeyType="rsa",
+                    TagSpecifications=[
+                        {
+                            "ResourceType": "key-pair",
+                            "Tags": [{"Key": "Name", "Value": "frontend-web build"}],
+                        }
+                    ],
+                    KeyFormat="pem",
+                )
 
             key_material = response["KeyMaterial"]
             with open(key_file_path, "w") as f:
@@ -118,7 +192,8 @@ async def trigger_build(
 
             async def _cleanup_key():
                 logger.info("Deleting key pair...")
-                await client.delete_key_pair(KeyName=build_key_name)
+                with record.phase("delete_key_pair"):
+                    await client.delete_key_pair(KeyName=build_key_name)
                 await slack.send_ops_message(
                     f"Frontend-Web deleted build key pair: {build_key_name}"
                 )
@@ -157,26 +232,28 @@ async def trigger_build(
                 "Launching instance in target availability zone...\n"
                 + json.dumps(run_instances_params, indent=2)
             )
-            try:
-                response = await client.run_instances(**run_instances_params)
-            except botocore.exceptions.ClientError as e:
-                logger.exception("Failed to launch instance")
-                if e.response["Error"]["Code"] == "InsufficientInstanceCapacity":
-                    await slack.send_ops_message(
-                        "Frontend-Web failed to launch build server due to insufficient capacity; retrying with backup subnet"
-                    )
-                    run_instances_params["NetworkInterfaces"][0][
-                        "SubnetId"
-                    ] = backup_build_subnet_id
-                    logger.info(
-                        "Launching instance in backup availability zone...\n"
-                        + json.dumps(run_instances_params, indent=2)
-                    )
+            with record.phase("launch"):
+                try:
                     response = await client.run_instances(**run_instances_params)
-                else:
-                    raise
+                except botocore.exceptions.ClientError as e:
+                    logger.exception("Failed to launch instance")
+                    if e.response["Error"]["Code"] == "InsufficientInstanceCapacity":
+                        await slack.send_ops_message(
+                            "Frontend-Web failed to launch build server due to insufficient capacity; retrying with backup subnet"
+                        )
+                        run_instances_params["NetworkInterfaces"][0][
+                            "SubnetId"
+                        ] = backup_build_subnet_id
+                        logger.info(
+                            "Launching instance in backup availability zone...\n"
+                            + json.dumps(run_instances_params, indent=2)
+                        )
+                        response = await client.run_instances(**run_instances_params)
+                    else:
+                        raise
 
             instance_id = response["Instances"][0]["InstanceId"]
+            record.instance_id = instance_id
             instance_private_ip = response["Instances"][0]["PrivateIpAddress"]
             status = response["Instances"][0]["State"]["Name"]
             await slack.send_ops_message(
@@ -184,6 +261,10 @@ async def trigger_build(
             )
 
             async def _cleanup_instance():
+                with record.phase("terminate"):
+                    await _terminate_instance()
+
+            async def _terminate_instance():
                 logger.info("Terminating instance...")
                 response = await client.terminate_instances(InstanceIds=[instance_id])
                 status = (
@@ -199,7 +280,7 @@ async def trigger_build(
                     if time.time() - started_waiting_at > 600:
                         raise Exception("Timed out waiting for instance to terminate")
 
-                    await asyncio.sleep(5)
+                    await asyncio.sleep(POLL_INTERVAL_SECONDS)
                     response = await client.describe_instances(
                         InstanceIds=[instance_id]
                     )
@@ -221,59 +302,50 @@ async def trigger_build(
             cleanup.append(_cleanup_instance)
 
             started_waiting_at = time.time()
-            while status != "running":
-                if time.time() - started_waiting_at > 600:
-                    raise Exception("Timed out waiting for instance to start")
-
-                await asyncio.sleep(5)
-                response = await client.describe_instances(InstanceIds=[instance_id])
-                new_status = response["Reservations"][0]["Instances"][0]["State"][
-                    "Name"
-                ]
-
-                if new_status != status:
-                    status = new_status
-                    await slack.send_ops_message(
-                        f"Frontend-Web build server {instance_id} status: {status}"
-                    )
+            with record.phase("wait_running"):
+                while status != "running":
+                    if time.time() - started_waiting_at > 600:
+                        raise Exception("Timed out waiting for instance to start")
 
-            seen_build_ready = asyncio.Event()
+                    await asyncio.sleep(POLL_INTERVAL_SECONDS)
+                    response = await client.describe_instances(
+                        InstanceIds=[instance_id]
+                    )
+                    new_status = response["Reservations"][0]["Instances"][0]["State"][
+                        "Name"
+                    ]
 
-            async def _wait_for_build_ready():
-                try:
-                    async with Itgs() as itgs:
-                        redis = await itgs.redis()
-                        pubsub = redis.pubsub()
-                        await pubsub.subscribe("updates:frontend-web:build_ready")
-                        while (
-                            await pubsub.get_message(
-                                ignore_subscribe_messages=True, timeout=5
-                            )
-                        ) is None:
-                            pass
+                    if new_status != status:
+                        status = new_status
                         await slack.send_ops_message(
-                            "Frontend-Web detected build ready"
+                            f"Frontend-Web build server {instance_id} status: {status}"
                         )
-                        seen_build_ready.set()
-                except Exception as e:
-                    await handle_error(e, extra_info="in _wait_for_build_ready")
-                    raise e
 
-            build_ready_task = asyncio.create_task(_wait_for_build_ready())
+            # registered before the script runs, since the build server publishes
+            # build_ready as its last step
+            build_ready_waiter = JobWaiter(
+                await itgs.redis(), channel_prefix=b"updates:frontend-web:"
+            )
+            await build_ready_waiter.__aenter__()
 
-            async def cancel_build_ready_task():
-                build_ready_task.cancel()
+            async def _cleanup_build_ready_waiter():
+                await build_ready_waiter.__aexit__(None, None, None)
 
-            cleanup.append(cancel_build_ready_task)
+            cleanup.append(_cleanup_build_ready_waiter)
+            build_ready_waiter.register("build_ready")
 
             logger.info("Executing script on instance...")
             try:
-                stdout, stderr = await asyncio.wait_for(
+                script_phases = await asyncio.wait_for(
                     anyio.to_thread.run_sync(
-                        connect_and_execute,
+                        execute,
                         instance_private_ip,
                         key_file_path,
                         single_file_script,
+                        bootstrap_bundle,
+                        stdout_path,
+                        stderr_path,
+                        record,
                     ),
                     timeout=1800,
                 )
@@ -285,9 +357,18 @@ async def trigger_build(
                 raise
 
             logger.info("Script finished normally, waiting for build_ready...")
+            await slack.send_ops_message(
+                "Frontend-Web build script phases:\n"
+                + "\n".join(
+                    f"• {phase.name}: {phase.seconds:.1f}s"
+                    + (f" (exit code {phase.exit_code})" if phase.exit_code else "")
+                    for phase in script_phases
+                )
+            )
 
             try:
-                await asyncio.wait_for(seen_build_ready.wait(), timeout=300)
+                with record.phase("wait_build_ready"):
+                    await build_ready_waiter.wait("build_ready", timeout=300)
             except asyncio.TimeoutError:
                 logger.warning("build_ready timed out (5m)")
                 await slack.send_ops_message(
@@ -295,16 +376,12 @@ async def trigger_build(
                 )
                 raise
 
+            await slack.send_ops_message("Frontend-Web detected build ready")
             logger.info("build_ready detected, storing build logs...")
             await slack.send_ops_message("frontend-web storing build logs...")
 
-            with temp_file() as stdout_path, temp_file() as stderr_path:
-                with open(stdout_path, "w") as f:
-                    f.write(stdout)
-                with open(stderr_path, "w") as f:
-                    f.write(stderr)
-
-                files = await itgs.files()
+            files = await itgs.files()
+            with record.phase("upload_logs"):
                 with open(stdout_path, "rb") as f:
                     await files.upload(
                         f,
@@ -355,20 +432,50 @@ async def cleanup_functions():
             raise last_e
 
 
-def generate_single_file_script() -> str:
+def generate_bootstrap_bundle() -> Tuple[bytes, str]:
+    """Packs the files the build server needs into a compressed archive,
+    returning the archive and its sha256 hex digest
+    """
+    bundle = build_tar_gz_bundle(
+        [
+            ("scripts/build", "bootstrap"),
+            (CONFIG_SH_PATH, "bootstrap/config.sh"),
+            (REPO_SH_PATH, "bootstrap/repo.sh"),
+        ]
+    )
+    return bundle, hashlib.sha256(bundle).hexdigest()
+
+
+def generate_single_file_script(bootstrap_sha256: str) -> str:
     res = io.StringIO()
-    res.write("cd /usr/local/src\n")
-    write_echo_commands_for_folder("scripts/build", "bootstrap", res)
-    write_echo_commands_for_file("/home/ec2-user/config.sh", "bootstrap/config.sh", res)
-    write_echo_commands_for_file("/home/ec2-user/repo.sh", "bootstrap/repo.sh", res)
+    write_extract_commands(
+        BOOTSTRAP_BUNDLE_PATH, bootstrap_sha256, "/usr/local/src", res
+    )
     res.write("cd /usr/local/src/bootstrap\n")
     res.write("bash main.sh\n")
     return res.getvalue()
 
 
-def connect_and_execute(ip: str, key_file_path: str, script: str) -> None:
+def connect_and_execute(
+    ip: str,
+    key_file_path: str,
+    script: str,
+    bootstrap_bundle: bytes,
+    stdout_path: str,
+    stderr_path: str,
+    record: BuildRecord,
+    *,
+    ssh_client_factory: Callable[[], paramiko.SSHClient] = paramiko.SSHClient,
+) -> List[ScriptPhase]:
+    """Connects to the instance at the given ip, uploads the bootstrap bundle,
+    then runs the given script on it, logging its output as it arrives and
+    writing all of it to the given paths. Returns the phases the script
+    reported, in the order they finished, which are also added to the record.
+    The ssh client can be replaced, e.g., with a fake to exercise this locally
+    """
+    connect_started_at = time.perf_counter()
     for attempt in range(150):
-        client = paramiko.SSHClient()
+        client = ssh_client_factory()
         client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         try:
             client.connect(
@@ -380,6 +487,7 @@ def connect_and_execute(ip: str, key_file_path: str, script: str) -> None:
                 banner_timeout=5,
             )
             sftp = client.open_sftp()
+            sftp.putfo(io.BytesIO(bootstrap_bundle), BOOTSTRAP_BUNDLE_PATH)
             with sftp.open("/home/ec2-user/initial_script.sh", "w") as remote_file:
                 remote_file.write(script)
 
@@ -397,14 +505,30 @@ def connect_and_execute(ip: str, key_file_path: str, script: str) -> None:
             continue
         break
 
+    record.add_phase("connect", time.perf_counter() - connect_started_at)
     logger.info(f"Successfully connected to {ip}, executing script...")
-    stdout, stderr = exec_simple(client, "sudo bash /home/ec2-user/initial_script.sh")
+    phases: List[ScriptPhase] = []
+
+    def on_line(stream: str, line: str) -> None:
+        logger.debug(f"[build {stream}] {line}")
+        if stream == "stdout":
+            phase = parse_script_phase(line)
+            if phase is not None:
+                phases.append(phase)
+                record.add_phase(f"script.{phase.name}", phase.seconds)
+
+    with record.phase("script"):
+        exec_simple(
+            client,
+            "sudo bash /home/ec2-user/initial_script.sh",
+            on_line=on_line,
+            stdout_path=stdout_path,
+            stderr_path=stderr_path,
+        )
     client.close()
 
-    logger.trace(f"stdout: {stdout}")
-    logger.trace(f"stderr: {stderr}")
     logger.info(f"Done executing script on {ip}")
-    return stdout, stderr
+    return phases
 
 
 if __name__ == "__main__":
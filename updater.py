@@ -1,6 +1,14 @@
-"""Handles updating when the repository is updated"""
+"""Handles updating when the repository is updated.
+
+Instances update one at a time. A single token circulates through the redis
+list `updates:frontend-web:tokens`; each instance blocks on that list until it
+receives the token, so waiting instances are served in order without polling.
+The holder drains its traffic, restarts, and its replacement returns the token
+once it's ready for traffic. If the holder dies, its lease expires and the
+token is reissued.
+"""
 import time
-from typing import Union
+from typing import Optional, Union
 from itgs import Itgs
 from error_middleware import handle_error, handle_warning
 import asyncio
@@ -11,9 +19,39 @@ import socket
 import os
 import loguru
 import anyio
+import readiness
 import trigger_build
 
 
+TOKENS_KEY = b"updates:frontend-web:tokens"
+"""The list containing the update token while nobody holds it"""
+
+HOLDER_KEY = b"updates:frontend-web:holder"
+"""The list containing the update token while an instance holds it"""
+
+LOCK_KEY = b"updates:frontend-web:lock"
+"""The identifier of the instance holding the update token"""
+
+LEASE_SECONDS = 600
+"""How long an instance may hold the update token before it's reissued"""
+
+WAIT_SECONDS = 30
+"""How long we block waiting for the token before checking if it was lost"""
+
+READY_TIMEOUT_SECONDS = 300
+"""How long after starting up we wait to be ready before returning the token
+regardless, so one broken instance can't block the others forever
+"""
+
+DRAIN_GRACE_SECONDS = float(os.environ.get("OSEH_DRAIN_GRACE_SECONDS", "15"))
+"""How long we report not ready before restarting, so that the load balancer
+stops sending us requests
+"""
+
+DRAIN_TIMEOUT_SECONDS = 30
+"""The maximum time we spend draining before restarting"""
+
+
 async def _listen_forever():
     """Subscribes to the redis channel updates:frontend-web and upon
     recieving a message, calls /home/ec2-user/update_webapp.sh
@@ -37,13 +75,26 @@ async def _listen_forever():
                 await slack.send_ops_message(
                     f"frontend-web {socket.gethostname()} restarting again"
                 )
+                await drain(itgs)
                 do_update()
                 return
 
-        await release_update_lock_if_held(itgs)
+        if not await readiness.wait_ready(READY_TIMEOUT_SECONDS):
+            await handle_warning(
+                f"{__name__}:not_ready",
+                f"frontend-web {socket.gethostname()} not ready after {READY_TIMEOUT_SECONDS}s; continuing the update anyway",
+            )
+        downtime = await release_update_lock_if_held(itgs)
 
         if os.environ.get("ENVIRONMENT") != "dev":
-            await slack.send_ops_message(f"frontend-web {socket.gethostname()} ready")
+            await slack.send_ops_message(
+                f"frontend-web {socket.gethostname()} ready"
+                + (
+                    f" after {downtime:.1f}s of downtime"
+                    if downtime is not None
+                    else ""
+                )
+            )
 
     while True:
         try:
@@ -67,55 +118,120 @@ async def _listen_forever():
     async with Itgs() as itgs:
         await acquire_update_lock(itgs)
 
-    loguru.logger.info("Lock acquired, updating...")
+        loguru.logger.info("Lock acquired, draining...")
+        await drain(itgs)
+
+    loguru.logger.info("Drained, updating...")
     do_update()
 
 
+async def drain(itgs: Itgs):
+    """Stops taking traffic ahead of restarting, and remembers when we did so
+    that our replacement can report how long we were down for
+    """
+    await readiness.drain(
+        grace_seconds=DRAIN_GRACE_SECONDS, timeout=DRAIN_TIMEOUT_SECONDS
+    )
+    local_cache = await itgs.local_cache()
+    local_cache.set(b"updater-down-at", time.time(), expire=LEASE_SECONDS + 10)
+
+
+REISSUE_TOKEN_SCRIPT = """
+local tokens_key = KEYS[1]
+local holder_key = KEYS[2]
+local lease_seconds = tonumber(ARGV[1])
+
+if redis.call("LLEN", tokens_key) > 0 then
+    return 0
+end
+
+if redis.call("EXISTS", holder_key) == 1 then
+    -- the holder may have died between taking the token and starting its lease
+    if redis.call("TTL", holder_key) == -1 then
+        redis.call("EXPIRE", holder_key, lease_seconds)
+    end
+    return 0
+end
+
+redis.call("RPUSH", tokens_key, "1")
+return 1
+"""
+
+
 async def acquire_update_lock(itgs: Itgs):
+    """Waits our turn for the update token, without polling, then starts our
+    lease on it
+    """
     our_identifier = secrets.token_urlsafe(16).encode("utf-8")
     local_cache = await itgs.local_cache()
 
     redis = await itgs.redis()
     started_at = time.time()
     while True:
-        local_cache.set(b"updater-lock-key", our_identifier, expire=610)
-        success = await redis.set(
-            b"updates:frontend-web:lock", our_identifier, nx=True, ex=600
+        reissued = await redis.eval(
+            REISSUE_TOKEN_SCRIPT, 2, TOKENS_KEY, HOLDER_KEY, LEASE_SECONDS
         )
-        if success:
-            loguru.logger.info(f"Lock acquired: {our_identifier}")
+        if reissued:
+            loguru.logger.info("Reissued the update token")
+
+        token = await redis.blmove(
+            TOKENS_KEY, HOLDER_KEY, WAIT_SECONDS, src="LEFT", dest="RIGHT"
+        )
+        if token is not None:
             break
         loguru.logger.debug(f"[{time.time() - started_at:.1f}s] still waiting...")
-        await asyncio.sleep(1)
 
+    local_cache.set(b"updater-lock-key", our_identifier, expire=LEASE_SECONDS + 10)
+    async with redis.pipeline() as pipe:
+        pipe.multi()
+        await pipe.set(LOCK_KEY, our_identifier, ex=LEASE_SECONDS)
+        await pipe.expire(HOLDER_KEY, LEASE_SECONDS)
+        await pipe.execute()
+    loguru.logger.info(
+        f"Lock acquired after {time.time() - started_at:.1f}s: {our_identifier}"
+    )
 
-DELETE_IF_MATCH_SCRIPT = """
-local key = KEYS[1]
+
+RETURN_TOKEN_SCRIPT = """
+local lock_key = KEYS[1]
+local holder_key = KEYS[2]
+local tokens_key = KEYS[3]
 local expected = ARGV[1]
 
-local current = redis.call("GET", key)
+local current = redis.call("GET", lock_key)
 if current == expected then
-    redis.call("DEL", key)
+    redis.call("DEL", lock_key)
+    redis.call("DEL", holder_key)
+    redis.call("RPUSH", tokens_key, "1")
     return 1
 end
 return 0
 """
 
 
-async def release_update_lock_if_held(itgs: Itgs):
+async def release_update_lock_if_held(itgs: Itgs) -> Optional[float]:
+    """Returns the update token if we hold it, handing it to the next
+    instance waiting for it. Returns how long we were down for, in seconds,
+    if we restarted for an update
+    """
     local_cache = await itgs.local_cache()
 
+    down_at: Optional[float] = local_cache.get(b"updater-down-at")
+    downtime = time.time() - down_at if down_at is not None else None
+    local_cache.delete(b"updater-down-at")
+
     our_identifier = local_cache.get(b"updater-lock-key")
     if our_identifier is None:
         loguru.logger.info("No lock held")
-        return
+        return downtime
 
     loguru.logger.info(f"Releasing lock: {our_identifier}")
     redis = await itgs.redis()
     await redis.eval(
-        DELETE_IF_MATCH_SCRIPT, 1, b"updates:frontend-web:lock", our_identifier
+        RETURN_TOKEN_SCRIPT, 3, LOCK_KEY, HOLDER_KEY, TOKENS_KEY, our_identifier
     )
     local_cache.delete(b"updater-lock-key")
+    return downtime
 
 
 async def check_if_rebuild_required(itgs: Itgs):